@@ -0,0 +1,195 @@
+"""
+End-to-end benchmarks for Daruma
+Runs put, get, ls, delete, load and reprovision against simulated providers for every combination
+of file size, provider count and file reconstruction threshold, and writes the results as JSON
+
+Usage: python -m benchmarks.daruma_benchmark [--profile wan] [--sizes 1024,1048576] [--output results.json]
+"""
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+from benchmarks.profiles import PROFILES, make_provider, describe_profile
+from benchmarks.stats import summarize
+from driver.Daruma import Daruma
+from managers.CredentialManager import CredentialManager
+from managers.ManifestCache import ManifestCache
+from providers.SimulatedProvider import SimulatedProvider
+from tools import tracing
+
+DEFAULT_SIZES = [1024, 64 * 1024, 1024 * 1024, 8 * 1024 * 1024]
+DEFAULT_PROVIDER_COUNTS = [3, 5, 7]
+# reprovisioning redistributes every file, so it is timed fewer times than the other operations
+REPROVISION_ITERATIONS = 3
+
+
+def timed(function, *args):
+    """
+    Returns the number of seconds function(*args) took to run
+    """
+    start = time.time()
+    function(*args)
+    return time.time() - start
+
+
+def run_configuration(credential_manager, root, profile_name, file_size, num_providers, threshold, iterations,
+                      latency_aware_reads=False, write_margin=None):
+    """
+    Benchmark one Daruma installation
+    Args:
+        credential_manager: the credential manager for the providers
+        root: an empty directory in which to keep the providers' files
+        profile_name: the key in PROFILES of the behaviour to give each provider
+        file_size: the size of each file written, in bytes
+        num_providers: the number of providers
+        threshold: the file and bootstrap reconstruction threshold
+        iterations: the number of times to time each operation
+        latency_aware_reads: whether Daruma should plan reads by provider latency
+        write_margin: (optional) the number of providers beyond the threshold that must store each file's
+            shares before a put returns; every provider if None
+    Returns:
+        a list of result dicts, one per operation
+    """
+    providers = [make_provider(credential_manager, profile_name, os.path.join(root, str(i)))
+                 for i in xrange(num_providers)]
+
+    # cached manifests are kept under root too, so they are removed with the providers' files
+    manifest_cache = ManifestCache(os.path.join(root, "manifest_cache"))
+    data = os.urandom(file_size)
+    paths = ["file" + str(i) for i in xrange(iterations)]
+    latencies = {}
+
+    start = time.time()
+    daruma = Daruma.provision(providers, threshold, threshold, latency_aware_reads=latency_aware_reads,
+                              write_margin=write_margin, manifest_cache=manifest_cache)
+    latencies["provision"] = [time.time() - start]
+    latencies["put"] = [timed(daruma.put, path, data) for path in paths]
+    # let uploads that puts didn't wait for finish, so they don't compete with later operations
+    daruma.resilience_manager.wait_for_repairs()
+    latencies["get"] = [timed(daruma.get, path) for path in paths]
+    latencies["ls"] = [timed(daruma.ls, "") for _ in xrange(iterations)]
+    def load():
+        Daruma.load(providers, latency_aware_reads=latency_aware_reads, write_margin=write_margin,
+                    manifest_cache=manifest_cache)
+    latencies["load"] = [timed(load) for _ in xrange(iterations)]
+
+    # reprovisioning with the same parameters does nothing, so alternate the order of the providers
+    latencies["reprovision"] = []
+    for i in xrange(REPROVISION_ITERATIONS):
+        providers = providers[::-1]
+        latencies["reprovision"].append(timed(daruma.reprovision, providers, threshold, threshold))
+
+    latencies["delete"] = [timed(daruma.delete, path) for path in paths]
+
+    results = []
+    for operation, samples in sorted(latencies.items()):
+        bytes_per_operation = file_size if operation in ("put", "get") else 0
+        result = {
+            "operation": operation,
+            "profile": profile_name,
+            "file_size": file_size,
+            "providers": num_providers,
+            "threshold": threshold,
+            "files": iterations
+        }
+        result.update(summarize(samples, bytes_per_operation))
+        results.append(result)
+    return results
+
+
+def run_benchmarks(profile_name, sizes, provider_counts, thresholds=None, iterations=10, log=None, latency_aware_reads=False,
+                   write_margin=None):
+    """
+    Benchmark every combination of file size, provider count and threshold
+    Args:
+        profile_name: the key in PROFILES of the behaviour to give each provider
+        sizes: a list of file sizes, in bytes
+        provider_counts: a list of numbers of providers
+        thresholds: (optional) a list of file reconstruction thresholds;
+            defaults to every valid threshold for each provider count
+        iterations: the number of times to time each operation
+        log: (optional) a file to which to write progress
+        latency_aware_reads: whether Daruma should plan reads by provider latency
+        write_margin: (optional) the number of providers beyond the threshold that must store each file's
+            shares before a put returns; every provider if None
+    Returns:
+        a dict holding the parameters of the run and a list of results
+    """
+    credential_manager = CredentialManager()
+    credential_manager.load()
+
+    results = []
+    for num_providers in provider_counts:
+        valid_thresholds = range(2, num_providers)
+        if thresholds is not None:
+            valid_thresholds = [threshold for threshold in thresholds if threshold in valid_thresholds]
+        for threshold in valid_thresholds:
+            for file_size in sizes:
+                if log is not None:
+                    log.write("benchmarking %s: size=%d, providers=%d, threshold=%d\n" %
+                              (profile_name, file_size, num_providers, threshold))
+                root = tempfile.mkdtemp(prefix="daruma-benchmark-")
+                try:
+                    results += run_configuration(credential_manager, root, profile_name, file_size,
+                                                 num_providers, threshold, iterations, latency_aware_reads, write_margin)
+                finally:
+                    shutil.rmtree(root, ignore_errors=True)
+                    credential_manager.clear_user_credentials(provider_class=SimulatedProvider)
+
+    return {
+        "timestamp": time.time(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "profile": describe_profile(profile_name),
+        "iterations": iterations,
+        "latency_aware_reads": latency_aware_reads,
+        "write_margin": write_margin,
+        "results": results
+    }
+
+
+def parse_int_list(value):
+    return [int(item) for item in value.split(",")]
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description="Benchmark Daruma operations against simulated providers")
+    parser.add_argument("--profile", choices=sorted(PROFILES.keys()), default="local",
+                        help="the simulated network behaviour of every provider")
+    parser.add_argument("--sizes", type=parse_int_list, default=DEFAULT_SIZES,
+                        help="comma-separated file sizes, in bytes")
+    parser.add_argument("--providers", type=parse_int_list, default=DEFAULT_PROVIDER_COUNTS,
+                        help="comma-separated numbers of providers")
+    parser.add_argument("--thresholds", type=parse_int_list, default=None,
+                        help="comma-separated file reconstruction thresholds (default: all valid)")
+    parser.add_argument("--iterations", type=int, default=10,
+                        help="the number of times to time each operation")
+    parser.add_argument("--output", default=None,
+                        help="the file to write JSON results to (default: stdout)")
+    parser.add_argument("--latency-aware-reads", action="store_true",
+                        help="only fetch shares from the fastest providers, hedging slow fetches")
+    parser.add_argument("--write-margin", type=int, default=None,
+                        help="return from puts once this many providers beyond the threshold store their shares")
+    parser.add_argument("--trace", default=None,
+                        help="a file to which to append a JSON line for every traced stage of every operation")
+    options = parser.parse_args(args)
+
+    if options.trace is not None:
+        tracing.add_exporter(tracing.JSONFileExporter(options.trace))
+
+    report = run_benchmarks(options.profile, options.sizes, options.providers,
+                            options.thresholds, options.iterations, log=sys.stderr,
+                            latency_aware_reads=options.latency_aware_reads, write_margin=options.write_margin)
+    if options.output is None:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write("\n")
+    else:
+        with open(options.output, "w") as output:
+            json.dump(report, output, indent=2, sort_keys=True)
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
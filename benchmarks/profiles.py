@@ -0,0 +1,37 @@
+from providers.SimulatedProvider import SimulatedProvider, UniformLatency
+
+# the simulated network behaviour of providers, as keyword arguments to SimulatedProvider
+PROFILES = {
+    "local": dict(),
+    "lan": dict(latency=UniformLatency(0.001, 0.002), bandwidth=100 * 1024 * 1024),
+    "wan": dict(latency=UniformLatency(0.05, 0.08), bandwidth=10 * 1024 * 1024),
+    "flaky": dict(latency=UniformLatency(0.05, 0.15), bandwidth=5 * 1024 * 1024, failure_rate=0.02)
+}
+for name, settings in SimulatedProvider.CLOUD_PROFILES.items():
+    PROFILES[name] = settings
+
+
+def make_provider(credential_manager, profile_name, path):
+    """
+    Args:
+        credential_manager: a credential_manager to store user credentials
+        profile_name: a key of PROFILES
+        path: the directory in which the provider keeps its files
+    Returns:
+        a connected SimulatedProvider with the named profile
+    """
+    provider = SimulatedProvider(credential_manager, **PROFILES[profile_name])
+    provider.connect(path)
+    return provider
+
+
+def describe_profile(profile_name):
+    """
+    Returns: a JSON-serializable description of the named profile
+    """
+    description = {"name": profile_name}
+    for key, value in PROFILES[profile_name].items():
+        if hasattr(value, "__dict__"):
+            value = dict(vars(value), distribution=value.__class__.__name__)
+        description[key] = value
+    return description
@@ -0,0 +1,24 @@
+from tools.metrics import percentile
+
+
+def summarize(latencies, bytes_per_operation=0):
+    """
+    Args:
+        latencies: the duration of each operation, in seconds
+        bytes_per_operation: the number of bytes of file data each operation moved, if any
+    Returns:
+        a dict of statistics for the operations
+    """
+    total = sum(latencies)
+    summary = {
+        "count": len(latencies),
+        "total_seconds": total,
+        "mean_seconds": total / len(latencies),
+        "p50_seconds": percentile(latencies, 0.5),
+        "p99_seconds": percentile(latencies, 0.99),
+        "max_seconds": max(latencies),
+        "operations_per_second": len(latencies) / total if total > 0 else None
+    }
+    if bytes_per_operation:
+        summary["bytes_per_second"] = bytes_per_operation * len(latencies) / total if total > 0 else None
+    return summary
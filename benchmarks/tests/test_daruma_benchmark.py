@@ -0,0 +1,14 @@
+from benchmarks.daruma_benchmark import run_benchmarks
+import json
+
+
+def test_run_benchmarks():
+    report = run_benchmarks("local", [1024], [3], iterations=2)
+    operations = set(result["operation"] for result in report["results"])
+    assert operations == set(["provision", "put", "get", "ls", "load", "reprovision", "delete"])
+    for result in report["results"]:
+        assert result["providers"] == 3
+        assert result["threshold"] == 2
+        assert result["p50_seconds"] <= result["p99_seconds"]
+    # the report must be serializable
+    json.dumps(report)
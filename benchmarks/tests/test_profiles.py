@@ -0,0 +1,45 @@
+from benchmarks.profiles import PROFILES, make_provider, describe_profile
+from benchmarks.stats import percentile, summarize
+from managers.CredentialManager import CredentialManager
+import json
+
+cm = CredentialManager()
+cm.load()
+
+
+def teardown_function(function):
+    cm.clear_user_credentials()
+
+
+def test_percentile():
+    samples = range(1, 101)
+    assert percentile(samples, 0.5) == 50
+    assert percentile(samples, 0.99) == 99
+    assert percentile(samples, 1) == 100
+    assert percentile([3], 0.99) == 3
+
+
+def test_summarize():
+    summary = summarize([1.0, 2.0, 3.0, 2.0], bytes_per_operation=100)
+    assert summary["count"] == 4
+    assert summary["total_seconds"] == 8.0
+    assert summary["p50_seconds"] == 2.0
+    assert summary["p99_seconds"] == 3.0
+    assert summary["operations_per_second"] == 0.5
+    assert summary["bytes_per_second"] == 50.0
+    assert "bytes_per_second" not in summarize([1.0])
+
+
+def test_make_provider():
+    provider = make_provider(cm, "lan", "tmp/profiled")
+    provider.put_async("file", "data").result()
+    assert provider.get_async("file").result() == "data"
+    assert provider.bandwidth == PROFILES["lan"]["bandwidth"]
+
+
+def test_describe_profiles():
+    for name in PROFILES:
+        description = describe_profile(name)
+        assert description["name"] == name
+        # the report must be serializable
+        json.dumps(description)
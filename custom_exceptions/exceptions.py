@@ -67,6 +67,12 @@ class ConnectionFailure(ProviderFailure):
     """
 
 
+class TimeoutFailure(ConnectionFailure):
+    """
+    Provider didn't finish an operation within its deadline
+    """
+
+
 class AuthFailure(ProviderFailure):
     """
     Failed to authenticate the API token with the provider
@@ -85,6 +91,20 @@ class InvalidShareFailure(ProviderFailure):
     """
 
 
+class RateLimitFailure(ProviderFailure):
+    """
+    The provider is throttling requests (e.g. HTTP 429 Too Many Requests)
+    """
+    def __init__(self, provider, retry_after=None, message=None):
+        """
+        Args:
+            provider: the provider that throttled the request
+            retry_after: (optional) the number of seconds the provider asked to wait before retrying
+        """
+        super(RateLimitFailure, self).__init__(provider, message)
+        self.retry_after = retry_after
+
+
 # crypto exceptions
 class DecryptError(DarumaException):
     """
@@ -1,12 +1,19 @@
 from custom_exceptions import exceptions
 from providers.UnauthenticatedProvider import UnauthenticatedProvider
 from contextlib import contextmanager
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 import requests
+import urllib
 
 
 class TestServerProvider(UnauthenticatedProvider):
     # the amount of time to wait on a request, in seconds
     TIMEOUT = 0.5
+    # the number of connections to keep open to the server, enough for every concurrent request
+    POOL_SIZE = UnauthenticatedProvider.MAX_CONCURRENT_REQUESTS
+    # the number of times to retry a request that failed to connect or was dropped
+    RETRIES = 2
 
     @classmethod
     def provider_identifier(cls):
@@ -37,12 +44,21 @@ class TestServerProvider(UnauthenticatedProvider):
             credential_manager, a credential_manager to store user credentials
         """
         super(TestServerProvider, self).__init__(credential_manager)
+        # reuse connections between requests instead of opening one per share
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.POOL_SIZE,
+                              max_retries=Retry(total=self.RETRIES, backoff_factor=0.05))
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
 
     def _do_get(self, path):
-        response = requests.get(self.host + "/" + path, timeout=self.TIMEOUT)
+        response = self.session.get(self.host + "/" + path, timeout=self.TIMEOUT)
         assert response.status_code == 200
         return response
 
+    def _file_url(self, filename):
+        return self.host + "/files/" + urllib.quote(filename, safe="")
+
     def connect(self, url):
         """
         Connect to the demo server at url
@@ -60,18 +76,22 @@ class TestServerProvider(UnauthenticatedProvider):
 
     def get(self, filename):
         with self.exception_handler():
-            response = self._do_get("get/" + filename)
+            response = self.session.get(self._file_url(filename), timeout=self.TIMEOUT)
+            assert response.status_code == 200
             return response.content
 
     def put(self, filename, data):
         with self.exception_handler():
-            response = requests.post(self.host + "/put", files={filename: data}, timeout=self.TIMEOUT)
+            # the share is sent as the raw request body, with its Content-Length
+            response = self.session.put(self._file_url(filename), data=data, timeout=self.TIMEOUT)
             assert response.status_code == 200
 
     def delete(self, filename):
         with self.exception_handler():
-            self._do_get("delete/" + filename)
+            response = self.session.delete(self._file_url(filename), timeout=self.TIMEOUT)
+            assert response.status_code == 200
 
     def wipe(self):
         with self.exception_handler():
-            self._do_get("wipe")
+            response = self.session.delete(self.host + "/files", timeout=self.TIMEOUT)
+            assert response.status_code == 200
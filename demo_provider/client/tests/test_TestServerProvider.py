@@ -1,8 +1,9 @@
 from demo_provider.client.TestServerProvider import TestServerProvider
 from managers.CredentialManager import CredentialManager
 from custom_exceptions import exceptions
-from demo_provider.server import app
+from demo_provider.server import serve, shard_path
 from threading import Thread
+import httplib
 import zlib
 import pytest
 
@@ -10,7 +11,7 @@ cm = CredentialManager()
 cm.load()
 
 # start a demo instance of a server
-server_thread = Thread(target=app.run)
+server_thread = Thread(target=serve, args=("127.0.0.1", 5000))
 server_thread.setDaemon(True)
 server_thread.start()
 
@@ -74,3 +75,68 @@ def test_multiple_sessions():
     providers, _ = TestServerProvider.load_cached_providers(cm)
     FS = providers[0]
     assert FS.get("file1") == "abc"
+
+
+def test_concurrent_roundtrip():
+    FS = TestServerProvider(cm)
+    FS.connect("http://127.0.0.1:5000")
+    FS.wipe()
+    futures = [FS.put_async("file" + str(i), "data" + str(i)) for i in xrange(32)]
+    for future in futures:
+        future.result()
+    futures = [FS.get_async("file" + str(i)) for i in xrange(32)]
+    assert [future.result() for future in futures] == ["data" + str(i) for i in xrange(32)]
+
+
+def test_binary_roundtrip_is_stored_raw():
+    FS = TestServerProvider(cm)
+    FS.connect("http://127.0.0.1:5000")
+    FS.wipe()
+    data = "".join(chr(i) for i in xrange(256)) * 64
+    FS.put("file1", data)
+    assert FS.get("file1") == data
+    # the share is stored byte for byte, not re-encoded
+    with open(shard_path("file1"), "rb") as stored:
+        assert stored.read() == data
+
+
+def test_range_get():
+    FS = TestServerProvider(cm)
+    FS.connect("http://127.0.0.1:5000")
+    FS.put("file1", "0123456789")
+    response = FS.session.get(FS.host + "/files/file1", headers={"Range": "bytes=2-5"})
+    assert response.status_code == 206
+    assert response.content == "2345"
+    assert response.headers["Content-Range"] == "bytes 2-5/10"
+    assert response.headers["Accept-Ranges"] == "bytes"
+
+    response = FS.session.get(FS.host + "/files/file1", headers={"Range": "bytes=-3"})
+    assert response.status_code == 206
+    assert response.content == "789"
+
+    response = FS.session.get(FS.host + "/files/file1", headers={"Range": "bytes=20-30"})
+    assert response.status_code == 416
+    assert response.headers["Content-Range"] == "bytes */10"
+
+    response = FS.session.get(FS.host + "/files/file1")
+    assert response.status_code == 200
+    assert response.content == "0123456789"
+
+
+def test_chunked_put():
+    FS = TestServerProvider(cm)
+    FS.connect("http://127.0.0.1:5000")
+
+    connection = httplib.HTTPConnection("127.0.0.1", 5000)
+    connection.putrequest("PUT", "/files/file1")
+    connection.putheader("Transfer-Encoding", "chunked")
+    connection.endheaders()
+    connection.send("2\r\nab\r\n1\r\nc\r\n0\r\n\r\n")
+    response = connection.getresponse()
+    assert response.status == 200
+    response.read()
+    # the connection is kept alive for the next request
+    connection.request("GET", "/files/file1")
+    assert connection.getresponse().read() == "abc"
+    connection.close()
+    assert FS.get("file1") == "abc"
@@ -1,7 +1,9 @@
-from flask import Flask, request, make_response
+from flask import Flask, request, Response
+import hashlib
 import os
 import shutil
-import base64
+import tempfile
+import waitress
 
 app = Flask(__name__)
 
@@ -9,49 +11,131 @@ UPLOAD_FOLDER = os.path.dirname(os.path.realpath(__file__)) + "/files"
 if not os.path.exists(UPLOAD_FOLDER):
     os.mkdir(UPLOAD_FOLDER)
 
+# the size of the blocks in which bodies are read from and written to disk
+BLOCK_SIZE = 1024 * 1024
+# the number of requests handled at once; connections beyond these wait, kept alive, for a thread to come free
+SERVER_THREADS = 16
+# the number of hex digits of the name's hash used for each level of shard directories
+SHARD_WIDTH = 2
+SHARD_LEVELS = 2
+
+
+def shard_path(filename):
+    """
+    Files are spread across nested directories by a hash of their name,
+    so no single directory grows too large to list or look up quickly
+    Args:
+        filename: the name of a stored file
+    Returns:
+        the path of the file on disk, or None if the name is not a valid file name
+    """
+    if filename in ("", ".", "..") or "/" in filename or "\0" in filename:
+        return None
+    digest = hashlib.sha1(filename).hexdigest()
+    shards = [digest[i * SHARD_WIDTH:(i + 1) * SHARD_WIDTH] for i in xrange(SHARD_LEVELS)]
+    return os.path.join(UPLOAD_FOLDER, *(shards + [filename]))
+
+
+def read_blocks(data_file, length):
+    """
+    Yields the next length bytes of data_file, a block at a time, and closes it once they have been sent
+    """
+    try:
+        while length > 0:
+            block = data_file.read(min(BLOCK_SIZE, length))
+            if not block:
+                return
+            length -= len(block)
+            yield block
+    finally:
+        data_file.close()
+
 
 @app.route('/')
 def home():
     return "working"
 
 
-@app.route('/put', methods=["POST"])
-def put():
-    if len(request.files) == 0:
+@app.route('/files/<filename>', methods=["PUT"])
+def put(filename):
+    path = shard_path(filename)
+    if path is None:
+        # waitress reads the whole body before handing the request over, so an unread body doesn't stop the
+        # connection being reused
         return "", 400
-    filename, file = request.files.items()[0]
-    with open(os.path.join(UPLOAD_FOLDER, filename), 'w+') as out:
-        out.write(base64.b64encode(file.read()))
-    # file.save(os.path.join(UPLOAD_FOLDER, filename))
+
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # another request may have created it concurrently
+            if not os.path.isdir(directory):
+                raise
+
+    # write to a temporary file first so readers never see a partial file
+    fd, temp_path = tempfile.mkstemp(dir=directory)
+    try:
+        with os.fdopen(fd, "wb") as out:
+            # waitress gives chunked bodies a length too, once it has read them
+            remaining = request.content_length or 0
+            while remaining > 0:
+                block = request.stream.read(min(BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                out.write(block)
+                remaining -= len(block)
+        if remaining > 0:
+            # the client disconnected before sending the whole body
+            os.remove(temp_path)
+            return "", 400
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        return "", 500
     return ""
 
 
-@app.route('/get/<filename>')
+@app.route('/files/<filename>', methods=["GET"])
 def get(filename):
-    path = os.path.join(UPLOAD_FOLDER, filename)
-    if not os.path.exists(path):
-        return "", 400
+    path = shard_path(filename)
     try:
-        return make_response(base64.b64decode(open(path, 'r').read()))
-    except Exception as e:
-        print "there was an error"
-        print e
-        return "", 400
+        data_file = open(path, "rb")
+    except (TypeError, IOError):
+        return "", 404
+    size = os.fstat(data_file.fileno()).st_size
+    start, stop = 0, size
+    status = 200
+    headers = {"Accept-Ranges": "bytes"}
+    # a single byte range is answered with 206 and only the requested bytes (other ranges get the whole file);
+    # done by hand since Response.make_conditional only handles ranges from Werkzeug 0.15
+    if request.range is not None and request.range.units == "bytes" and len(request.range.ranges) == 1:
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            data_file.close()
+            return "", 416, {"Content-Range": "bytes */%d" % size}
+        start, stop = byte_range
+        status = 206
+        headers["Content-Range"] = "bytes %d-%d/%d" % (start, stop - 1, size)
+    data_file.seek(start)
+    response = Response(read_blocks(data_file, stop - start), status, headers,
+                        mimetype="application/octet-stream", direct_passthrough=True)
+    response.content_length = stop - start
+    return response
 
 
-@app.route('/delete/<filename>')
+@app.route('/files/<filename>', methods=["DELETE"])
 def delete(filename):
-    path = os.path.join(UPLOAD_FOLDER, filename)
-    if not os.path.exists(path):
-        return "", 400
+    path = shard_path(filename)
     try:
         os.remove(path)
-        return ""
-    except:
-        return "", 400
+    except (TypeError, OSError):
+        return "", 404
+    return ""
 
 
-@app.route('/wipe')
+@app.route('/files', methods=["DELETE"])
 def wipe():
     try:
         for the_file in os.listdir(UPLOAD_FOLDER):
@@ -65,5 +149,13 @@ def wipe():
     except:
         return "", 400
 
+
+def serve(host="0.0.0.0", port=5000):
+    """
+    Run the server on waitress, which keeps HTTP/1.1 connections alive between requests
+    and handles requests on a fixed pool of SERVER_THREADS threads
+    """
+    waitress.serve(app, host=host, port=port, threads=SERVER_THREADS)
+
 if __name__ == '__main__':
-    app.run(debug=False, host="0.0.0.0", port=5000)
+    serve()
@@ -1,16 +1,16 @@
 # This is the main project
 
-# TODO note to self: think about caching
-# make a daemon to periodically garbage collect and ping / reload manifest
+# TODO make a daemon to periodically garbage collect and ping / reload manifest
 
+import hashlib
 import logging
-import threading
 from managers.ResilienceManager import ResilienceManager
 from managers.BootstrapManager import BootstrapManager, Bootstrap
 from managers.FileManager import FileManager
 from custom_exceptions import exceptions
+from tools import tracing
 from tools.encryption import generate_key
-from tools.utils import generate_random_name, run_parallel
+from tools.utils import generate_random_name, run_parallel, wait_for_failures, ReadWriteLock
 
 logger = logging.getLogger("daruma")
 
@@ -22,10 +22,13 @@ class Daruma:
         Construct a new Daruma object
         NB: In normal usage, one should use the static load or provision methods
         """
-        self.lock = threading.RLock()
+        # reads of files and of the manifest in memory share the lock; anything that changes the manifest,
+        # the providers or the keys holds it exclusively
+        self.lock = ReadWriteLock()
         self.bootstrap_manager = bootstrap_manager
         self.file_manager = file_manager
         self.resilience_manager = resilience_manager
+        self.resilience_manager.set_share_check(self._holds_share)
 
         if load_manifest:
             # ensures that we fail immediately with FatalOperationFailure if we recovered the wrong reconstruction threshold
@@ -33,10 +36,16 @@ class Daruma:
 
     def synchronized(method):
         def synchronized_method(self, *args, **kwargs):
-            with self.lock:
+            with self.lock.write_locked():
                 return method(self, *args, **kwargs)
         return synchronized_method
 
+    def shared(method):
+        def shared_method(self, *args, **kwargs):
+            with self.lock.read_locked():
+                return method(self, *args, **kwargs)
+        return shared_method
+
     @staticmethod
     def _assert_valid_params(providers, bootstrap_reconstruction_threshold, file_reconstruction_threshold):
         """
@@ -48,7 +57,47 @@ class Daruma:
             raise ValueError("Invalid parameters!")
 
     @staticmethod
-    def provision(providers, bootstrap_reconstruction_threshold, file_reconstruction_threshold):
+    def _assert_valid_write_margin(write_margin):
+        if write_margin is not None and write_margin < 0:
+            raise ValueError("Invalid write margin!")
+
+    # the options provision and load take as keyword arguments, and their defaults (see provision)
+    OPTIONS = {"threshold_first_reads": False, "latency_aware_reads": False, "write_margin": None,
+               "deduplicate": False, "manifest_cache": None}
+
+    @staticmethod
+    def _read_options(options):
+        """
+        Returns options with the default filled in for every option that wasn't given
+        Raises TypeError if an option isn't one of OPTIONS, and ValueError if the write margin is invalid
+        """
+        unknown = sorted(set(options) - set(Daruma.OPTIONS))
+        if len(unknown) > 0:
+            raise TypeError("unexpected keyword argument '%s'" % unknown[0])
+        options = dict(Daruma.OPTIONS, **options)
+        Daruma._assert_valid_write_margin(options["write_margin"])
+        return options
+
+    @staticmethod
+    def _instance_cache(manifest_cache, providers):
+        """
+        Returns the part of manifest_cache for the installation on providers, or None if manifest_cache is None
+        """
+        if manifest_cache is None:
+            return None
+        uuids = sorted("%s:%s" % provider.uuid for provider in providers)
+        return manifest_cache.for_instance(hashlib.sha256("\n".join(uuids)).hexdigest())
+
+    @staticmethod
+    def _configure(file_manager, resilience_manager, options):
+        if options["latency_aware_reads"]:
+            file_manager.set_read_planner(resilience_manager.plan_reads)
+        if options["write_margin"] is not None:
+            file_manager.set_write_margin(options["write_margin"], resilience_manager.queue_repair)
+        file_manager.set_deduplication(options["deduplicate"])
+
+    @staticmethod
+    def provision(providers, bootstrap_reconstruction_threshold, file_reconstruction_threshold, **options):
         """
         Create a new Daruma.
         Warning: Deletes all files on all providers! Even if a FatalOperationFailure is thrown, files on all providers will be unstable or deleted.
@@ -56,22 +105,41 @@ class Daruma:
             providers: a list of providers
             bootstrap_reconstruction_threshold: the number of providers that need to be up to recover the key. Between 1 and len(providers)-1, inclusive
             file_reconstruction_threshold: the number of providers that need to be up to read files, given the key. Between 1 and len(providers)-1, inclusive
+        Options, which can only be given as keyword arguments:
+            threshold_first_reads: whether reads should return as soon as file_reconstruction_threshold verified shares arrive,
+                leaving slow providers to be scored in the background
+            latency_aware_reads: whether reads should only fetch shares from the fastest healthy providers,
+                asking more providers only when a fetch fails or is unusually slow
+            write_margin: (optional) if given, file writes return once file_reconstruction_threshold + write_margin
+                providers have stored their shares, and shares that fail to upload afterwards are uploaded again
+                in the background. Non-negative
+            deduplicate: whether files should be split into content-defined chunks that are stored once however many
+                files contain them, so that only the changed parts of a rewritten file are uploaded
+            manifest_cache: (optional) a ManifestCache to keep a local copy of the manifest in, so that loads only
+                download it when another client changed it; by default the manifest isn't cached. Manifests are cached
+                separately for each set of providers, and provisioning wipes the providers, so any manifest cached for
+                them is discarded
         Returns a constructed Daruma object
         Raises:
             ValueError if arguments are invalid
+            TypeError if an option isn't one of those above
             FatalOperationFailure if provisioning failed
         """
         logger.debug("provisioning: brt=%d, frt=%d", bootstrap_reconstruction_threshold, file_reconstruction_threshold)
         Daruma._assert_valid_params(providers, bootstrap_reconstruction_threshold, file_reconstruction_threshold)
+        options = Daruma._read_options(options)
         # make a copy of providers so that changes to the external list doesn't affect this one
         providers = providers[:]
 
-        def wipe(provider):
-            provider.wipe()
-        failures = run_parallel(wipe, map(lambda provider: [provider], providers))
+        failures = wait_for_failures([provider.wipe_async() for provider in providers])
         if len(failures) > 0:
             raise exceptions.FatalOperationFailure(failures)
 
+        manifest_cache = Daruma._instance_cache(options["manifest_cache"], providers)
+        if manifest_cache is not None:
+            # the manifest of any installation that was on the providers is gone
+            manifest_cache.clear()
+
         master_key = generate_key()
         manifest_name = generate_random_name()
         bootstrap = Bootstrap(master_key, manifest_name, file_reconstruction_threshold)
@@ -85,22 +153,26 @@ class Daruma:
             # TODO check for network error
             raise
 
-        file_manager = FileManager(providers, len(providers), file_reconstruction_threshold, master_key, manifest_name, setup=True)
+        file_manager = FileManager(providers, len(providers), file_reconstruction_threshold, master_key, manifest_name, setup=True,
+                                   early_return_reads=options["threshold_first_reads"], manifest_cache=manifest_cache)
         resilience_manager = ResilienceManager(providers, file_manager, bootstrap_manager)
+        Daruma._configure(file_manager, resilience_manager, options)
         return Daruma(bootstrap_manager, file_manager, resilience_manager, load_manifest=False)
 
     @staticmethod
-    def load(providers):
+    def load(providers, **options):
         """
         Load an existing Daruma
         Args: providers, a list of providers
+              options: the same keyword-only options as provision
         Returns (Daruma, extra_providers)
             Daruma: a constructed Daruma object
             extra_providers: a list of providers that were provided but not part of the loaded installation
         The client should decide whether to discard the extra_providers or to reprovision with them
-        Raises FatalOperationFailure
+        Raises FatalOperationFailure, ValueError if write_margin is invalid, or TypeError if an option isn't known
         """
         logger.debug("loading")
+        options = Daruma._read_options(options)
         providers = providers[:]
         bootstrap_manager = BootstrapManager(providers)
         failures = []
@@ -113,9 +185,12 @@ class Daruma:
             # TODO check for network error
             raise
 
-        file_manager = FileManager(providers, num_providers, bootstrap.file_reconstruction_threshold, bootstrap.key, bootstrap.manifest_name)
+        manifest_cache = Daruma._instance_cache(options["manifest_cache"], providers)
+        file_manager = FileManager(providers, num_providers, bootstrap.file_reconstruction_threshold, bootstrap.key, bootstrap.manifest_name,
+                                   early_return_reads=options["threshold_first_reads"], manifest_cache=manifest_cache)
         # TODO this may load some cached state from disk
         resilience_manager = ResilienceManager(providers, file_manager, bootstrap_manager)
+        Daruma._configure(file_manager, resilience_manager, options)
 
         if len(failures) > 0:
             resilience_manager.diagnose_and_repair_bootstrap(failures)
@@ -181,11 +256,14 @@ class Daruma:
                 return self._reset()
             raise
 
+    @tracing.traced("daruma.reprovision")
     @synchronized
     def reprovision(self, providers, bootstrap_reconstruction_threshold, file_reconstruction_threshold):
         """
         Update the thresholds and providers for the system
         Will redistribute every file across the new provider list
+        If redistribution fails part way, even across a reload, calling this again with the same providers and
+        file_reconstruction_threshold only redistributes the files that weren't done (see FileManager.reset)
         This method is thread-safe.
         Args:
             providers: a list of provider objects across which to distribute
@@ -196,35 +274,49 @@ class Daruma:
         """
         logger.debug("reprovisioning: brt=%d, frt=%d", bootstrap_reconstruction_threshold, file_reconstruction_threshold)
         Daruma._assert_valid_params(providers, bootstrap_reconstruction_threshold, file_reconstruction_threshold)
-        # do nothing if params are the same
-        if providers == self.file_manager.providers and \
+        # do nothing if the system already uses these params. Files are compared against the layout they were all
+        # switched over to, rather than the providers and threshold of the last reprovision, which may have failed
+        adopted_layout = self.file_manager.distributor
+        if providers == adopted_layout.providers and \
            bootstrap_reconstruction_threshold == self.bootstrap_manager.bootstrap_reconstruction_threshold and \
-           file_reconstruction_threshold == self.file_manager.file_reconstruction_threshold:
+           file_reconstruction_threshold == adopted_layout.file_reconstruction_threshold:
                 return
 
-        old_providers = self.file_manager.providers
+        old_providers = adopted_layout.providers
+        old_bootstrap_reconstruction_threshold = self.bootstrap_manager.bootstrap_reconstruction_threshold
 
         self._set_all_internal_providers(providers)
 
         self.bootstrap_manager.bootstrap_reconstruction_threshold = bootstrap_reconstruction_threshold
         self.file_manager.file_reconstruction_threshold = file_reconstruction_threshold
 
-        self._reset()
+        try:
+            self._reset()
+        except Exception:
+            # the bootstrap may not have been redistributed, so make sure a retry with the same params does so
+            self.bootstrap_manager.bootstrap_reconstruction_threshold = old_bootstrap_reconstruction_threshold
+            raise
+
+        manifest_cache = self.file_manager.manifest_cache
+        if manifest_cache is not None and set(providers) != set(old_providers):
+            # the manifest is now cached for the new providers
+            manifest_cache.clear()
+            self.file_manager.manifest_cache = Daruma._instance_cache(manifest_cache, providers)
 
         # wipe the providers that were used previously but aren't any longer
         def remove(provider):
             provider.remove()
         run_parallel(remove, map(lambda provider: [provider], set(old_providers) - set(providers)))
 
+    @tracing.traced("daruma.load_manifest")
     def _load_manifest(self, discard_extra_providers=False):
         """
         Load the manifest into the file manager
-        Without caching, this should be called before every public operation
+        This should be called before every public operation; it only downloads the manifest if another client changed it
         Args: If discard_extra_providers is True, will discard any providers not in the manifest
         Raises FatalOperationFailure if the load was not successful
         """
         logger.debug("loading manifest")
-        # TODO handle manifest caching
         try:
             self.file_manager.load_manifest(discard_extra_providers)
             self.resilience_manager.log_success()
@@ -232,14 +324,15 @@ class Daruma:
             self.resilience_manager.diagnose_and_repair_bootstrap(e.failures)
         except exceptions.FatalOperationFailure as e:
             can_retry = self.resilience_manager.diagnose(e.failures)
-            if can_retry:
+            # with no failing provider to blame, a retry would fail the same way
+            if can_retry and len(e.failures) > 0:
                 return self._load_manifest(discard_extra_providers)
             raise
 
         if discard_extra_providers:
             self._set_all_internal_providers(self.file_manager.providers)
 
-    @synchronized
+    @shared
     def get_missing_providers(self):
         """
         Gets a list of the providers needed to be added before the system can be writable
@@ -250,7 +343,7 @@ class Daruma:
         logger.debug("getting missing providers")
         return self.file_manager.get_missing_providers()
 
-    @synchronized
+    @shared
     def get_providers(self):
         """
         This method is thread-safe.
@@ -258,7 +351,25 @@ class Daruma:
         logger.debug("getting providers")
         return self.file_manager.providers[:]
 
-    @synchronized
+    def get_provider_metrics(self):
+        """
+        Get the recent latency, throughput and failure rate of each provider (see ResilienceManager.get_provider_metrics)
+        This method is thread-safe, and doesn't wait for other operations to finish.
+        Returns: a map from provider to a dict of statistics
+        """
+        return self.resilience_manager.get_provider_metrics()
+
+    @shared
+    def _holds_share(self, share_name):
+        """
+        Check whether the manifest still refers to a share, for the ResilienceManager to drop repairs of shares that
+        are no longer needed. Waits for a write in progress to finish, so that a repair queued by a write isn't
+        judged before the write adds its file to the manifest
+        """
+        return self.file_manager.holds_share(share_name)
+
+    @tracing.traced("daruma.ls")
+    @shared
     def ls(self, path):
         """
         Lists information about the entries at the given path.  If the given
@@ -271,12 +382,13 @@ class Daruma:
 
         Note that this method reads a cached version of the system manifest and
         does not re-download it for verification.
-        This method is thread-safe.
+        This method is thread-safe, and runs alongside other reads.
         Raises InvalidPath.
         """
         logger.debug("ls-ing %s", path)
         return self.file_manager.ls(path)
 
+    @tracing.traced("daruma.mk_dir")
     @synchronized
     def mk_dir(self, path):
         """
@@ -289,6 +401,7 @@ class Daruma:
         self._load_manifest()
         self.file_manager.mk_dir(path)
 
+    @tracing.traced("daruma.move")
     @synchronized
     def move(self, old_path, new_path):
         """
@@ -302,7 +415,7 @@ class Daruma:
         self._load_manifest()
         self.file_manager.move(old_path, new_path)
 
-    @synchronized
+    @tracing.traced("daruma.get")
     def get(self, path):
         """
         Get the contents of a file given the file path
@@ -310,51 +423,194 @@ class Daruma:
         Note that this method reads a cached version of the system manifest and
         does not re-download it for verification.
         Upon return either all providers are stable or at least one provider is RED.
-        This method is thread-safe.
+        This method is thread-safe, and runs alongside other reads.
         Raises FileNotFound if path is invalid
         Raises FatalOperationFailure if unsuccessful
         """
         logger.debug("getting %s", path)
+        while True:
+            with self.lock.read_locked():
+                code_name = self.file_manager.get_code_name(path)
+                try:
+                    result = self.file_manager.get(path)
+                    self.resilience_manager.log_success()
+                    return result
+                except exceptions.OperationFailure as e:
+                    failure = e
+                except exceptions.FatalOperationFailure as e:
+                    can_retry = self.resilience_manager.diagnose(e.failures)
+                    if can_retry:
+                        continue
+                    raise
+            # repairing rewrites the file, so it waits for the other reads to finish
+            self._repair_file(path, code_name, failure)
+            return failure.result
+
+    @synchronized
+    def _repair_file(self, path, code_name, failure):
+        """
+        Repair a file after a read of it failed on some providers
+        Args: path - the path of the file
+              code_name - the code name of the file when it was read
+              failure - the OperationFailure raised by the read
+        """
+        try:
+            if self.file_manager.get_code_name(path) != code_name:
+                # the file was rewritten since it was read, so its shares are already fresh
+                self.resilience_manager.diagnose(failure.failures)
+                return
+        except exceptions.FileNotFound:
+            self.resilience_manager.diagnose(failure.failures)
+            return
+        self.resilience_manager.diagnose_and_repair_file(failure.failures, path, failure.result)
+
+    @tracing.traced("daruma.put")
+    @synchronized
+    def put(self, path, data):
+        """
+        Put the data to path location
+        If some providers are in error, attempts to repair them
+        Upon return either all providers are stable or at least one provider is RED
+        This method is thread-safe.
+        Raises FatalOperationFailure if unsuccessful
+        Raises ReadOnlyMode if the system is in ReadOnlyMode
+        """
+        logger.debug("putting into %s", path)
+        tracing.current_span().set("bytes", len(data))
+        self._load_manifest()
+
         try:
-            result = self.file_manager.get(path)
+            result = self.file_manager.put(path, data)
             self.resilience_manager.log_success()
             return result
         except exceptions.OperationFailure as e:
-            self.resilience_manager.diagnose_and_repair_file(e.failures, path, e.result)
+            self.resilience_manager.diagnose(e.failures)
+            self.resilience_manager.garbage_collect()
             return e.result
         except exceptions.FatalOperationFailure as e:
             can_retry = self.resilience_manager.diagnose(e.failures)
             if can_retry:
-                return self.get(path)
+                return self.put(path, data)
             raise
 
+    @tracing.traced("daruma.put_many")
     @synchronized
-    def put(self, path, data):
+    def put_many(self, files):
         """
-        Put the data to path location
+        Put several files at once, uploading them in parallel and updating the manifest only once
+        Either all of the files are put or none of them are
         If some providers are in error, attempts to repair them
         Upon return either all providers are stable or at least one provider is RED
         This method is thread-safe.
+        Args: files, a list of (path, data) pairs
+        Raises InvalidPath if any path conflicts with a directory
         Raises FatalOperationFailure if unsuccessful
         Raises ReadOnlyMode if the system is in ReadOnlyMode
         """
-        logger.debug("putting into %s", path)
+        logger.debug("putting %d files", len(files))
         self._load_manifest()
 
         try:
-            result = self.file_manager.put(path, data)
+            self.file_manager.put_many(files)
             self.resilience_manager.log_success()
-            return result
         except exceptions.OperationFailure as e:
             self.resilience_manager.diagnose(e.failures)
             self.resilience_manager.garbage_collect()
-            return e.result
         except exceptions.FatalOperationFailure as e:
             can_retry = self.resilience_manager.diagnose(e.failures)
             if can_retry:
-                return self.put(path, data)
+                return self.put_many(files)
+            raise
+
+    @tracing.traced("daruma.get_stream")
+    @shared
+    def get_stream(self, path, out):
+        """
+        Write the contents of a file to a file-like object, without holding
+        large files in memory
+        If some providers are in error, diagnoses them; unlike get, the file is
+        not repaired, since its contents aren't kept around
+        Note that this method reads a cached version of the system manifest and
+        does not re-download it for verification.
+        This method is thread-safe, and runs alongside other reads.
+        Raises FileNotFound if path is invalid
+        Raises FatalOperationFailure if unsuccessful
+        """
+        logger.debug("streaming %s", path)
+        start = out.tell()
+        try:
+            self.file_manager.get_stream(path, out)
+            self.resilience_manager.log_success()
+        except exceptions.OperationFailure as e:
+            self.resilience_manager.diagnose(e.failures)
+        except exceptions.FatalOperationFailure as e:
+            can_retry = self.resilience_manager.diagnose(e.failures)
+            if can_retry:
+                # discard anything written by the failed attempt
+                out.seek(start)
+                out.truncate()
+                return self.get_stream(path, out)
+            raise
+
+    @tracing.traced("daruma.put_stream")
+    @synchronized
+    def put_stream(self, path, stream):
+        """
+        Put the contents of a file-like object to path location, distributing it
+        in chunks so that large files are never held in memory
+        If some providers are in error, attempts to repair them
+        Upon return either all providers are stable or at least one provider is RED
+        This method is thread-safe.
+        Raises FatalOperationFailure if unsuccessful
+        Raises ReadOnlyMode if the system is in ReadOnlyMode
+        """
+        logger.debug("streaming into %s", path)
+        self._load_manifest()
+
+        start = stream.tell()
+        try:
+            self.file_manager.put_stream(path, stream)
+            self.resilience_manager.log_success()
+        except exceptions.OperationFailure as e:
+            self.resilience_manager.diagnose(e.failures)
+            self.resilience_manager.garbage_collect()
+        except exceptions.FatalOperationFailure as e:
+            can_retry = self.resilience_manager.diagnose(e.failures)
+            if can_retry:
+                stream.seek(start)
+                return self.put_stream(path, stream)
+            raise
+
+    @tracing.traced("daruma.put_delta")
+    @synchronized
+    def put_delta(self, path, stream):
+        """
+        Put a new version of the file at path from a file-like object, uploading only the
+        parts that changed since the stored version (see FileManager.put_delta)
+        If some providers are in error, attempts to repair them
+        Upon return either all providers are stable or at least one provider is RED
+        This method is thread-safe.
+        Raises FatalOperationFailure if unsuccessful
+        Raises ReadOnlyMode if the system is in ReadOnlyMode
+        """
+        logger.debug("delta streaming into %s", path)
+        self._load_manifest()
+
+        start = stream.tell()
+        try:
+            self.file_manager.put_delta(path, stream)
+            self.resilience_manager.log_success()
+        except exceptions.OperationFailure as e:
+            self.resilience_manager.diagnose(e.failures)
+            self.resilience_manager.garbage_collect()
+        except exceptions.FatalOperationFailure as e:
+            can_retry = self.resilience_manager.diagnose(e.failures)
+            if can_retry:
+                stream.seek(start)
+                return self.put_delta(path, stream)
             raise
 
+    @tracing.traced("daruma.delete")
     @synchronized
     def delete(self, path):
         """
@@ -382,13 +638,38 @@ class Daruma:
                 return self.delete(path)
             raise
 
-    @synchronized
+    @shared
     def list_all_paths(self):
         """
-        Returns a generator for the paths to all files and directories in the system.
+        Returns a list of the paths to all files and directories in the system.
         Note that this method reads a cached version of the system manifest and
         does not re-download it for verification.
-        This method is thread-safe.
+        This method is thread-safe, and runs alongside other reads.
         """
         logger.debug("listing all paths")
-        return self.file_manager.path_generator()
+        # list the paths while holding the lock, rather than as the caller iterates
+        return list(self.file_manager.path_generator())
+
+    @shared
+    def list_versions(self, paths=None):
+        """
+        Returns a map from path to version for the given paths that exist (every
+        file and directory in the system by default). The version of a file is
+        its code name, which changes whenever the file is written; the version of
+        a directory is None. (see FileManager.versions)
+        Note that this method reads a cached version of the system manifest and
+        does not re-download it for verification.
+        This method is thread-safe, and runs alongside other reads.
+        """
+        logger.debug("listing versions")
+        return self.file_manager.versions(paths)
+
+    @shared
+    def get_instance_id(self):
+        """
+        Returns a string that identifies this Daruma instance across loads and
+        reprovisioning, so that state kept about it locally can be told apart from
+        state about another instance.
+        This method is thread-safe, and runs alongside other reads.
+        """
+        return hashlib.sha256(self.file_manager.manifest_name).hexdigest()
@@ -128,10 +128,29 @@ def set_provider(line):
         print "Invalid property"
 
 
+def format_metrics(summary):
+    """
+    Describe a provider's recent performance in one line
+    """
+    if summary["operations"] == 0:
+        return "(no recent operations)"
+
+    def seconds(value):
+        return "-" if value is None else "%.0fms" % (value * 1000)
+    throughput = "-" if summary["throughput"] is None else "%.1fKB/s" % (summary["throughput"] / 1024)
+    description = "(%d ops, p50 %s, p95 %s, %s, %.0f%% failed)" % (
+        summary["operations"], seconds(summary["p50_latency"]), seconds(summary["p95_latency"]),
+        throughput, summary["failure_rate"] * 100)
+    if summary.get("slow"):
+        description += " SLOW"
+    return description
+
+
 def status():
     """
     Print the status of all providers
     """
+    metrics = daruma.get_provider_metrics() if daruma is not None else {}
     for i, provider in enumerate(providers):
         color = colorama.Fore.RESET
         if provider.status == ProviderStatus.GREEN:
@@ -142,7 +161,7 @@ def status():
             color = colorama.Fore.RED
         if provider.status == ProviderStatus.AUTH_FAIL:
             color = colorama.Fore.BLUE
-        print color + str(i) + ":", str(provider)
+        print color + str(i) + ":", str(provider), format_metrics(metrics.get(provider, provider.metrics.summary()))
     print colorama.Fore.RESET,
 
 
@@ -1,7 +1,12 @@
 from driver.Daruma import Daruma
+from managers.ManifestCache import ManifestCache
 from custom_exceptions import exceptions
 from providers.TestProvider import TestProvider, TestProviderState
 from managers.CredentialManager import CredentialManager
+from tools.encryption import generate_key
+from StringIO import StringIO
+import os
+import threading
 import pytest
 
 cm = CredentialManager()
@@ -231,6 +236,24 @@ def test_provision_bad_threshold():
         Daruma.provision(providers, 5, 5)
 
 
+def test_load_with_split_manifest_head():
+    daruma = Daruma.provision(providers[:4], 3, 3)
+    daruma.put("old", "data")
+    head_name = daruma.file_manager._head_name()
+    old_head = providers[0].get(head_name)
+    daruma.put("new", "data")
+    # a head write that only reached half the providers
+    for provider in providers[:2]:
+        provider.put(head_name, old_head)
+
+    daruma, _ = Daruma.load(providers[:4])
+    assert daruma.get("new") == "data"
+    daruma.put("newer", "data")
+
+    daruma, _ = Daruma.load(providers[:4])
+    assert daruma.get("newer") == "data"
+
+
 def test_reprovision_bad_threshold():
     daruma = Daruma.provision(providers[:3], 2, 2)
     with pytest.raises(ValueError):
@@ -277,6 +300,26 @@ def test_reprovision_add_bad():
         daruma.reprovision(providers, 4, 4)
 
 
+def test_reprovision_retry_after_failure():
+    daruma = Daruma.provision(providers[:-1], 3, 3)
+    daruma.put("test", "data")
+
+    providers[-1].set_state(TestProviderState.OFFLINE)
+    with pytest.raises(exceptions.FatalOperationFailure):
+        daruma.reprovision(providers, 4, 4)
+
+    # retrying with the same params finishes the reprovision, rather than finding nothing to change
+    providers[-1].set_state(TestProviderState.ACTIVE)
+    daruma.reprovision(providers, 4, 4)
+    assert daruma.get("test") == "data"
+
+    daruma, _ = Daruma.load(providers)
+    assert daruma.get("test") == "data"
+    # check that the files were switched over to the new providers and k
+    assert daruma.file_manager.distributor.providers == providers
+    assert daruma.file_manager.distributor.file_reconstruction_threshold == 4
+
+
 def test_extra_providers():
     Daruma.provision(providers, 4, 4)
     daruma, extra_providers = Daruma.load(providers)
@@ -298,3 +341,129 @@ def test_list_paths():
     expected_paths = ["file1", "file2", "dir1", "dir1/file3", "dir1/dir2"]
 
     assert sorted(daruma.list_all_paths()) == sorted(expected_paths)
+
+
+def test_list_versions():
+    daruma = Daruma.provision(providers, 3, 3)
+    daruma.put("file", "data")
+    daruma.mk_dir("dir")
+    versions = daruma.list_versions()
+    assert sorted(versions) == ["dir", "file"]
+    assert versions["dir"] is None
+
+    daruma.put("file", "new data")
+    assert daruma.list_versions(["file", "missing"]).keys() == ["file"]
+    assert daruma.list_versions(["file"])["file"] != versions["file"]
+
+
+def test_instance_id():
+    daruma = Daruma.provision(providers, 3, 3)
+    loaded, _ = Daruma.load(providers)
+    assert loaded.get_instance_id() == daruma.get_instance_id()
+    assert Daruma.provision(providers, 3, 3).get_instance_id() != daruma.get_instance_id()
+
+
+def test_manifest_cache(tmpdir):
+    cache_dir = str(tmpdir)
+    # a manifest cached for another installation
+    other_cache = ManifestCache(cache_dir, "other")
+    other_cache.store("other", generate_key(), "1:0", "content")
+
+    daruma = Daruma.provision(providers, 3, 3, manifest_cache=ManifestCache(cache_dir))
+    daruma.put("test", "data")
+    instance_dir = daruma.file_manager.manifest_cache.cache_dir
+    assert os.listdir(instance_dir) == [daruma.file_manager.manifest_name]
+    loaded, _ = Daruma.load(providers, manifest_cache=ManifestCache(cache_dir))
+    assert loaded.file_manager.manifest_cache.cache_dir == instance_dir
+    assert loaded.get("test") == "data"
+
+    # provisioning again wipes the providers, and the manifest cached for them with them
+    replacement = Daruma.provision(providers, 3, 3, manifest_cache=ManifestCache(cache_dir))
+    assert daruma.file_manager.manifest_name not in os.listdir(instance_dir)
+    replacement.put("test", "data")
+    assert os.listdir(instance_dir) == [replacement.file_manager.manifest_name]
+    # but other installations' manifests are left alone
+    assert os.listdir(other_cache.cache_dir) == ["other"]
+
+
+def test_manifest_cache_moves_with_providers(tmpdir):
+    daruma = Daruma.provision(providers[:4], 3, 3, manifest_cache=ManifestCache(str(tmpdir)))
+    daruma.put("test", "data")
+    old_dir = daruma.file_manager.manifest_cache.cache_dir
+    daruma.reprovision(providers, 3, 3)
+    assert os.listdir(old_dir) == []
+
+    loaded, _ = Daruma.load(providers, manifest_cache=ManifestCache(str(tmpdir)))
+    assert loaded.file_manager.manifest_cache.cache_dir == daruma.file_manager.manifest_cache.cache_dir
+    assert loaded.get("test") == "data"
+
+
+def test_unknown_option():
+    with pytest.raises(TypeError):
+        Daruma.provision(providers, 3, 3, early_return=True)
+
+
+def test_stream_roundtrip():
+    daruma = Daruma.provision(providers, 3, 3)
+    daruma.file_manager.distributor.CHUNK_SIZE = 16
+
+    data = "some data that spans several chunks"
+    daruma.put_stream("test", StringIO(data))
+    assert daruma.ls("") == [{"name": "test", "is_directory": False, "size": len(data)}]
+
+    out = StringIO()
+    daruma.get_stream("test", out)
+    assert out.getvalue() == data
+    assert daruma.get("test") == data
+
+
+def test_put_many():
+    daruma = Daruma.provision(providers, 3, 3)
+    daruma.put("file1", "old data")
+    daruma.put_many([("file1", "data1"), ("dir/file2", "data2")])
+
+    assert daruma.get("file1") == "data1"
+    assert daruma.get("dir/file2") == "data2"
+    assert sorted(daruma.list_all_paths()) == ["dir", "dir/file2", "file1"]
+
+
+def test_concurrent_gets(monkeypatch):
+    daruma = Daruma.provision(providers, 3, 3)
+    daruma.put("slow", "data1")
+    daruma.put("fast", "data2")
+
+    # hold up reads of one file on every provider
+    slow_name = daruma.file_manager.get_code_name("slow")
+    reading = threading.Event()
+    release = threading.Event()
+    for provider in providers:
+        original_get = provider.get
+
+        def blocked_get(filename, original_get=original_get):
+            if filename == slow_name:
+                reading.set()
+                release.wait(5)
+            return original_get(filename)
+        monkeypatch.setattr(provider, "get", blocked_get)
+
+    results = []
+    thread = threading.Thread(target=lambda: results.append(daruma.get("slow")))
+    thread.start()
+    try:
+        assert reading.wait(5)
+        # reads of other files don't wait for the slow read
+        assert daruma.get("fast") == "data2"
+        assert daruma.ls("") is not None
+        assert results == []
+    finally:
+        release.set()
+    thread.join(5)
+    assert results == ["data1"]
+
+
+def test_put_delta():
+    daruma = Daruma.provision(providers, 3, 3)
+    daruma.put("test", "data")
+    daruma.put_delta("test", StringIO("new data"))
+    assert daruma.get("test") == "new data"
+    assert daruma.ls("") == [{"name": "test", "is_directory": False, "size": 8}]
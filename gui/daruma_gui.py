@@ -6,6 +6,7 @@ from driver.Daruma import Daruma
 from gui.filesystem.FilesystemWatcher import FilesystemWatcher
 from gui.webview_server.server import start_ui_server
 from gui.webview_client.app import DarumaApp
+from managers.ManifestCache import ManifestCache
 from managers.ProviderManager import ProviderManager
 from tools.utils import INTERNAL_SERVER_HOST, INTERNAL_SERVER_PORT, get_app_folder, make_app_folder
 
@@ -79,7 +80,8 @@ if __name__ == "__main__":
     logger.error("loading errors:" + str(errors))
     try:
         assert len(providers) >= 2
-        app_state.daruma, extra_providers = Daruma.load(providers)
+        app_state.daruma, extra_providers = Daruma.load(providers, threshold_first_reads=True, latency_aware_reads=True,
+                                                        manifest_cache=ManifestCache())
         app_state.providers = providers
         app_state.needs_reprovision = len(extra_providers) > 0 or len(app_state.daruma.get_missing_providers()) > 0
     except (AssertionError, exceptions.FatalOperationFailure):
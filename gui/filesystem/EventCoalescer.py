@@ -0,0 +1,238 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger("daruma")
+
+# the kinds of net change to a path
+PUT = "put"
+MKDIR = "mkdir"
+DELETE = "delete"
+MOVE = "move"
+
+# the number of seconds a path must go without events before its changes are dispatched
+QUIET_PERIOD = 1.0
+# the most seconds a path's changes are held back by a steady stream of events
+MAX_DELAY = 30.0
+
+
+class Change(object):
+    """
+    The net change to a path since its changes were last dispatched
+    """
+    def __init__(self, path, operation, is_directory, now, destination=None):
+        self.path = path
+        self.operation = operation
+        self.is_directory = is_directory
+        # the path moved to, for a MOVE
+        self.destination = destination
+        # whether the path didn't exist before the first event, so that deleting it cancels the change
+        self.created = False
+        # whether the path changed between a file and a directory, so it must be deleted before it's recreated
+        self.delete_first = False
+        self.first_event = now
+        self.last_event = now
+
+    def due(self, quiet_period, max_delay):
+        """
+        Returns the time at which the change should be dispatched
+        """
+        return min(self.last_event + quiet_period, self.first_event + max_delay)
+
+    def __repr__(self):
+        return "<Change %s %s>" % (self.operation, self.path)
+
+
+def _dispatch_order(change):
+    # deletes come first, deepest paths first so that a directory is deleted after its contents,
+    # then directories are made from the top down, then files are put
+    if change.operation == DELETE or change.delete_first:
+        return 0, -len(change.path)
+    if change.operation == MKDIR:
+        return 1, len(change.path)
+    return 2, change.first_event
+
+
+class EventCoalescer(object):
+    """
+    Collects filesystem events and reduces the events of each path to the net change they make, e.g. a file
+    that is created, modified twice and deleted needs no change at all. A path's change is dispatched once the
+    path has had no events for quiet_period seconds, or at most max_delay seconds after its first event.
+    Changes that are due together are dispatched together, in one call.
+    Moves are applied in order: every other pending change is dispatched along with the move.
+    """
+    def __init__(self, dispatch, quiet_period=QUIET_PERIOD, max_delay=MAX_DELAY):
+        """
+        Args:
+            dispatch: a function to call with a list of Changes to make. Deletes are ordered first, then
+                directories made, then files put, and a move comes last
+            quiet_period: the number of seconds a path must go without events before its change is dispatched
+            max_delay: the most seconds a path's change can wait for its events to stop
+        """
+        self.dispatch = dispatch
+        self.quiet_period = quiet_period
+        self.max_delay = max_delay
+        # map from path to the pending Change of that path
+        self.changes = {}
+        self.condition = threading.Condition()
+        # held while changes are being taken and dispatched, so changes to a path are made in order
+        self.dispatch_lock = threading.Lock()
+        self.stopping = False
+        self.thread = None
+
+    def start(self):
+        """
+        Start dispatching changes on a background thread
+        """
+        self.thread = threading.Thread(target=self._run, name="event_coalescer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """
+        Stop the background thread, then dispatch every pending change
+        """
+        with self.condition:
+            self.stopping = True
+            self.condition.notify()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        self.flush()
+
+    def created(self, path, is_directory):
+        with self.condition:
+            operation = MKDIR if is_directory else PUT
+            change = self.changes.get(path)
+            if change is None:
+                change = self._add(path, operation, is_directory)
+                change.created = True
+            else:
+                if change.operation == DELETE:
+                    # the path was replaced
+                    change.delete_first = change.is_directory != is_directory
+                self._update(change, operation, is_directory)
+
+    def modified(self, path):
+        with self.condition:
+            change = self.changes.get(path)
+            if change is None:
+                self._add(path, PUT, False)
+            elif change.operation != MKDIR:
+                self._update(change, PUT, False)
+
+    def deleted(self, path, is_directory):
+        with self.condition:
+            change = self.changes.get(path)
+            if change is None:
+                self._add(path, DELETE, is_directory)
+            elif change.created:
+                # the path came and went without ever being stored
+                del self.changes[path]
+            else:
+                change.delete_first = False
+                self._update(change, DELETE, is_directory)
+
+    def moved(self, path, destination, is_directory):
+        """
+        Dispatch every pending change, followed by the move. A pending change of the moved path is carried over to
+        the destination, to be made after the move, and if the moved path was created since its changes were last
+        dispatched, there is nothing to move, so the move becomes a change replacing the destination instead,
+        e.g. when a file is saved by writing a temporary file and renaming it over the original
+        """
+        with self.dispatch_lock:
+            with self.condition:
+                change = self.changes.pop(path, None)
+                if change is not None and change.operation == DELETE:
+                    # the path was deleted before it was moved, so leave the delete to be dispatched in order
+                    self.changes[path] = change
+                    change = None
+                if change is not None and change.created:
+                    self._replace(destination, change)
+                    return
+                changes = self.changes.values()
+                self.changes = {}
+            changes.sort(key=_dispatch_order)
+            changes.append(Change(path, MOVE, is_directory, time.time(), destination))
+            self._dispatch(changes)
+            if change is not None:
+                with self.condition:
+                    self._replace(destination, change)
+
+    def flush(self):
+        """
+        Dispatch every pending change now
+        """
+        with self.dispatch_lock:
+            with self.condition:
+                changes = self.changes.values()
+                self.changes = {}
+            self._dispatch(sorted(changes, key=_dispatch_order))
+
+    def pending(self):
+        """
+        Returns the number of paths with changes waiting to be dispatched
+        """
+        with self.condition:
+            return len(self.changes)
+
+    def _add(self, path, operation, is_directory):
+        change = self.changes[path] = Change(path, operation, is_directory, time.time())
+        self.condition.notify()
+        return change
+
+    def _replace(self, destination, change):
+        """
+        Make a pending change of a moved path the change of its destination. Must be called holding the condition
+        """
+        replaced = self.changes.get(destination)
+        if replaced is None:
+            # the destination may already be stored, so it can't be dropped if it's deleted again
+            replaced = self._add(destination, change.operation, change.is_directory)
+            replaced.first_event = change.first_event
+            replaced.delete_first = change.delete_first
+            return
+        if replaced.operation == DELETE:
+            replaced.delete_first = replaced.is_directory != change.is_directory
+        replaced.first_event = min(replaced.first_event, change.first_event)
+        self._update(replaced, change.operation, change.is_directory)
+
+    def _update(self, change, operation, is_directory):
+        change.operation = operation
+        change.is_directory = is_directory
+        change.last_event = time.time()
+
+    def _take_due(self, now):
+        """
+        Remove and return the pending changes that are due. Must be called holding the condition
+        """
+        due = [change for change in self.changes.values() if change.due(self.quiet_period, self.max_delay) <= now]
+        for change in due:
+            del self.changes[change.path]
+        return sorted(due, key=_dispatch_order)
+
+    def _dispatch(self, changes):
+        if len(changes) == 0:
+            return
+        try:
+            self.dispatch(changes)
+        except Exception:
+            logger.exception("Exception dispatching filesystem changes")
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.stopping:
+                    if len(self.changes) == 0:
+                        self.condition.wait()
+                        continue
+                    next_due = min(change.due(self.quiet_period, self.max_delay) for change in self.changes.values())
+                    if next_due <= time.time():
+                        break
+                    self.condition.wait(next_due - time.time())
+                if self.stopping:
+                    return
+            with self.dispatch_lock:
+                with self.condition:
+                    changes = self._take_due(time.time())
+                self._dispatch(changes)
@@ -1,16 +1,29 @@
 import fnmatch
+import hashlib
 import os
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from watchdog.events import PatternMatchingEventHandler
 from watchdog.observers import Observer
 from custom_exceptions import exceptions
+from managers.Distributor import FileDistributor
+from managers.SyncState import SyncState, hash_file
+from gui.filesystem import EventCoalescer
 import logging
 import shutil
 
 
 logger = logging.getLogger("daruma")
 
-REJECT_PATTERNS = ["*/.DS_Store"]
+# downloads are written to the destination path with this suffix, then renamed into place once complete
+PARTIAL_SUFFIX = ".daruma-partial"
+REJECT_PATTERNS = ["*/.DS_Store", "*" + PARTIAL_SUFFIX]
+# the most file data to hold in memory while batching uploads during a bulk update
+BULK_UPLOAD_BATCH_SIZE = 16 * FileDistributor.CHUNK_SIZE
+# the number of files downloaded at once during a bulk update
+BULK_DOWNLOAD_PARALLELISM = 8
 
 
 @contextmanager
@@ -33,28 +46,321 @@ def daruma_error_handler():
         logger.info("filesystem event finished")
 
 
+def succeeded(function, *args):
+    """
+    Call function, handling daruma errors as daruma_error_handler does
+    Returns True if the call completed
+    """
+    with daruma_error_handler():
+        function(*args)
+        return True
+    return False
+
+
+def path_is_allowed(path):
+    for pattern in REJECT_PATTERNS:
+        if fnmatch.fnmatch(path, pattern):
+            return False
+    return True
+
+
+def make_directory(path):
+    """
+    Make a directory and its parents, unless it already exists (e.g. because another thread just made it)
+    """
+    try:
+        os.makedirs(path)
+    except OSError:
+        if not os.path.isdir(path):
+            raise
+
+
+def upload_file(daruma, daruma_path, system_path, delta=False):
+    """
+    Uploads a file from the local filesystem, streaming it in chunks if it is
+    too large to comfortably hold in memory.
+    If delta is True, the file is a new version of a file already in daruma, so
+    only the parts of it that changed are uploaded (see Daruma.put_delta).
+    """
+    with open(system_path, "rb") as src_file:
+        if delta:
+            daruma.put_delta(daruma_path, src_file)
+        elif os.path.getsize(system_path) > FileDistributor.CHUNK_SIZE:
+            daruma.put_stream(daruma_path, src_file)
+        else:
+            daruma.put(daruma_path, src_file.read())
+
+
+# what a bulk update must do:
+#   uploads, a list of (daruma path, system path, size, delta) of the files to upload (see UploadBatch.add)
+#   downloads, a list of the paths to download from daruma
+#   conflicts, a list of the paths changed both in the folder and in daruma since they were last synced
+#   deleted_locally, a list of the paths deleted from the folder, to delete from daruma
+#   deleted_remotely, a list of the paths deleted from daruma, to delete from the folder
+SyncPlan = namedtuple("SyncPlan", ["uploads", "downloads", "conflicts", "deleted_locally", "deleted_remotely"])
+
+
+def conflicted_copy_path(path):
+    """
+    Returns a path that doesn't exist yet to keep a conflicting version of the file at path in
+    """
+    root, extension = os.path.splitext(path)
+    conflict_path = root + " (conflicted copy)" + extension
+    copy = 2
+    while os.path.lexists(conflict_path):
+        conflict_path = root + " (conflicted copy %d)" % copy + extension
+        copy += 1
+    return conflict_path
+
+
+def plan_sync(root, sync_state, versions):
+    """
+    Work out what a bulk update must do, by walking the synced folder and
+    comparing each file with its sync state and its version in daruma.
+    Files are only read when their modification time changed but their size
+    didn't, to tell whether their contents changed.
+    The sync state is brought up to date for files that need no transfer.
+    Files found in both daruma and the folder that aren't recorded are
+    assumed to be in sync, e.g. when there was no sync state for the daruma
+    instance, and a file is only deleted from either side if it was recorded
+    as synced with the version found on the other side.
+    Args:
+        root: the synced folder
+        sync_state: the SyncState of the files synced between root and daruma
+        versions: a map from every path in daruma to its version
+            (see Daruma.list_versions)
+    Returns: a SyncPlan
+    """
+    states = sync_state.items()
+    plan = SyncPlan([], [], [], [], [])
+    local_paths = set()
+    records = []
+    for dirpath, dirnames, filenames in os.walk(root):
+        for filename in filenames:
+            system_path = os.path.join(dirpath, filename)
+            if not path_is_allowed(system_path):
+                continue
+            daruma_path = system_path[len(root) + 1:]
+            local_paths.add(daruma_path)
+            try:
+                stat = os.stat(system_path)
+                state = states.get(daruma_path)
+                changed = state is None or state.mtime != stat.st_mtime or state.size != stat.st_size
+                touched = changed and state is not None and state.size == stat.st_size and \
+                    state.hash is not None and hash_file(system_path) == state.hash
+            except (IOError, OSError):
+                # the file was deleted while walking
+                continue
+            if touched:
+                # only the modification time changed
+                changed = False
+                records.append((daruma_path, stat.st_mtime, stat.st_size, state.hash, state.code_name))
+
+            if daruma_path not in versions:
+                if state is not None and state.code_name is not None and not changed:
+                    plan.deleted_remotely.append(daruma_path)
+                else:
+                    plan.uploads.append((daruma_path, system_path, stat.st_size, False))
+            elif state is None:
+                records.append((daruma_path, stat.st_mtime, stat.st_size, None, versions[daruma_path]))
+            elif state.code_name is not None and state.code_name != versions[daruma_path]:
+                if changed:
+                    plan.conflicts.append(daruma_path)
+                else:
+                    plan.downloads.append(daruma_path)
+            elif changed:
+                plan.uploads.append((daruma_path, system_path, stat.st_size, True))
+            elif state.code_name is None:
+                records.append((daruma_path, stat.st_mtime, stat.st_size, state.hash, versions[daruma_path]))
+
+    for daruma_path, version in versions.items():
+        if daruma_path in local_paths or os.path.lexists(os.path.join(root, daruma_path)):
+            continue
+        state = states.get(daruma_path)
+        if version is not None and state is not None and state.code_name == version:
+            plan.deleted_locally.append(daruma_path)
+        else:
+            plan.downloads.append(daruma_path)
+    sync_state.record_many(records)
+    for daruma_path in states:
+        if daruma_path not in versions and daruma_path not in local_paths:
+            # deleted from both
+            sync_state.remove(daruma_path)
+    return plan
+
+
+class SyncProgress(object):
+    """
+    How far a bulk update has got. Updated from several threads at once
+    """
+    def __init__(self, handler=None):
+        """
+        Args: handler, (optional) a function to call with the SyncProgress whenever it changes
+        """
+        self.handler = handler
+        self.lock = threading.Lock()
+        self.files_total = 0
+        self.files_done = 0
+        self.files_failed = 0
+        self.bytes_total = 0
+        self.bytes_done = 0
+        self.finished = False
+
+    def add(self, files, size):
+        """
+        Add files, of size bytes in total, to the files to sync
+        """
+        with self.lock:
+            self.files_total += files
+            self.bytes_total += size
+        self._report()
+
+    def done(self, size):
+        """
+        Count a file of size bytes as synced
+        """
+        with self.lock:
+            self.files_done += 1
+            self.bytes_done += size
+        self._report()
+
+    def failed(self):
+        """
+        Count a file as having failed to sync
+        """
+        with self.lock:
+            self.files_failed += 1
+        self._report()
+
+    def finish(self):
+        with self.lock:
+            self.finished = True
+        logger.info("bulk update finished: %d of %d files synced, %d failed",
+                    self.files_done, self.files_total, self.files_failed)
+        self._report()
+
+    def to_dict(self):
+        with self.lock:
+            return {"files_total": self.files_total, "files_done": self.files_done, "files_failed": self.files_failed,
+                    "bytes_total": self.bytes_total, "bytes_done": self.bytes_done, "finished": self.finished}
+
+    def _report(self):
+        if self.handler is None:
+            return
+        try:
+            self.handler(self)
+        except Exception:
+            logger.exception("Exception reporting sync progress")
+
+
+class UploadBatch(object):
+    """
+    Uploads files, batching small ones so that they are put together with put_many and the manifest is only
+    updated once per batch. Each file is recorded in the sync state once it's uploaded.
+    flush must be called once every file has been added.
+    """
+    def __init__(self, daruma, sync_state, progress=None):
+        """
+        Args:
+            daruma: the Daruma to upload to
+            sync_state: the SyncState to record uploaded files in
+            progress: (optional) a SyncProgress to count uploaded files in
+        """
+        self.daruma = daruma
+        self.sync_state = sync_state
+        self.progress = progress
+        # (daruma path, data, (mtime, size, hash)) of the files waiting to be put
+        self.batch = []
+        self.batch_size = 0
+
+    def add(self, daruma_path, system_path, delta=False):
+        """
+        Upload a file, streaming it at once if it is large, or adding it to the batch if it isn't.
+        A small file already in daruma whose contents are the same as when it was last synced is only recorded.
+        Args:
+            daruma_path: the path to upload to
+            system_path: the path of the file to upload
+            delta: whether the file is a new version of a file already in daruma (see upload_file)
+        Returns:
+            False if the file couldn't be read, e.g. because it was deleted again
+        """
+        try:
+            stat = os.stat(system_path)
+            if stat.st_size > FileDistributor.CHUNK_SIZE:
+                file_hash = hash_file(system_path)
+                if succeeded(upload_file, self.daruma, daruma_path, system_path, delta):
+                    self._record([(daruma_path, stat.st_mtime, stat.st_size, file_hash)])
+                    self._done(stat.st_size)
+                else:
+                    self._failed()
+                return True
+            with open(system_path, "rb") as src_file:
+                data = src_file.read()
+        except (IOError, OSError):
+            return False
+
+        file_hash = hashlib.sha256(data).hexdigest()
+        state = self.sync_state.get(daruma_path) if delta else None
+        if state is not None and state.hash == file_hash:
+            # only the modification time changed
+            self.sync_state.record(daruma_path, stat.st_mtime, len(data), file_hash, state.code_name)
+            self._done(len(data))
+            return True
+        self.batch.append((daruma_path, data, (stat.st_mtime, len(data), file_hash)))
+        self.batch_size += len(data)
+        if self.batch_size >= BULK_UPLOAD_BATCH_SIZE:
+            self.flush()
+        return True
+
+    def flush(self):
+        """
+        Put the files waiting in the batch
+        """
+        if len(self.batch) == 0:
+            return
+        batch = self.batch
+        self.batch = []
+        self.batch_size = 0
+        if succeeded(self.daruma.put_many, [(daruma_path, data) for daruma_path, data, _ in batch]):
+            self._record([(daruma_path,) + state for daruma_path, _, state in batch])
+            for _, data, _ in batch:
+                self._done(len(data))
+        else:
+            for _ in batch:
+                self._failed()
+
+    def _record(self, entries):
+        # record uploaded files along with the versions they were stored as
+        versions = self.daruma.list_versions([entry[0] for entry in entries])
+        self.sync_state.record_many([entry + (versions.get(entry[0]),) for entry in entries])
+
+    def _done(self, size):
+        if self.progress is not None:
+            self.progress.done(size)
+
+    def _failed(self):
+        if self.progress is not None:
+            self.progress.failed()
+
+
 class DarumaFileSystemEventHandler(PatternMatchingEventHandler):
     """
     An internal class to handle events from the filesystem.
+    Events are coalesced per path (see EventCoalescer), and the net changes
+    are applied to daruma once each path goes quiet, with small files
+    uploaded in batches.
     """
 
-    def __init__(self, path, app_state):
+    def __init__(self, path, app_state, sync_state, quiet_period=EventCoalescer.QUIET_PERIOD):
         self.path = path
         self.app_state = app_state
+        self.sync_state = sync_state
         ignore_patterns = REJECT_PATTERNS[:]
         ignore_patterns.append(path)
         self.watching = True
+        self.coalescer = EventCoalescer.EventCoalescer(self.apply_changes, quiet_period)
         super(DarumaFileSystemEventHandler, self).__init__(ignore_patterns=ignore_patterns)
 
-    @contextmanager
-    def get_safe_daruma(self):
-        with daruma_error_handler():
-            try:
-                yield self.app_state.daruma
-            except AttributeError:
-                # daruma was None due to not being initialized yet
-                pass
-
     def sanitize(self, path):
         """
         Returns the path name without the components leading up to the search
@@ -69,17 +375,7 @@ class DarumaFileSystemEventHandler(PatternMatchingEventHandler):
 
         what = 'directory' if event.is_directory else 'file'
         logger.info("Moved " + what + " from " + event.src_path + " to " + event.dest_path)
-
-        with self.get_safe_daruma() as daruma:
-            if event.is_directory:
-                # If we get a move event on a directory from watchdog, then the
-                # directory is already empty, since watchdog notifies us of all
-                # the children first.
-                daruma.mk_dir(self.sanitize(event.dest_path))
-                daruma.delete(self.sanitize(event.src_path))
-            else:
-                daruma.move(self.sanitize(event.src_path),
-                            self.sanitize(event.dest_path))
+        self.coalescer.moved(event.src_path, event.dest_path, event.is_directory)
 
     def on_created(self, event):
         super(DarumaFileSystemEventHandler, self).on_created(event)
@@ -88,14 +384,7 @@ class DarumaFileSystemEventHandler(PatternMatchingEventHandler):
 
         what = 'directory' if event.is_directory else 'file'
         logger.info("Created " + what + " : " + event.src_path)
-
-        with self.get_safe_daruma() as daruma:
-            if event.is_directory:
-                daruma.mk_dir(self.sanitize(event.src_path))
-            else:
-                with open(event.src_path) as src_file:
-                    daruma.put(self.sanitize(event.src_path),
-                               src_file.read())
+        self.coalescer.created(event.src_path, event.is_directory)
 
     def on_deleted(self, event):
         super(DarumaFileSystemEventHandler, self).on_deleted(event)
@@ -104,9 +393,7 @@ class DarumaFileSystemEventHandler(PatternMatchingEventHandler):
 
         what = 'directory' if event.is_directory else 'file'
         logger.info("Deleted " + what + " : " + event.src_path)
-
-        with self.get_safe_daruma() as daruma:
-            daruma.delete(self.sanitize(event.src_path))
+        self.coalescer.deleted(event.src_path, event.is_directory)
 
     def on_modified(self, event):
         super(DarumaFileSystemEventHandler, self).on_modified(event)
@@ -114,11 +401,54 @@ class DarumaFileSystemEventHandler(PatternMatchingEventHandler):
             return
 
         logger.info("Modified " + event.src_path)
-        with self.get_safe_daruma() as daruma:
-            if not event.is_directory:
-                with open(event.src_path) as src_file:
-                    daruma.put(self.sanitize(event.src_path),
-                               src_file.read())
+        if not event.is_directory:
+            self.coalescer.modified(event.src_path)
+
+    def apply_changes(self, changes):
+        """
+        Make the coalesced changes to daruma, in order, keeping the sync state
+        up to date with them.
+        Small files are read into batches and put together with put_many, so
+        the manifest is only updated once per batch. Large files are streamed,
+        and files that were modified rather than created only upload the
+        parts that changed (see Daruma.put_delta).
+        Args: changes, a list of EventCoalescer.Changes
+        """
+        daruma = self.app_state.daruma
+        if daruma is None:
+            # daruma isn't initialized yet
+            return
+        uploads = UploadBatch(daruma, self.sync_state)
+        for change in changes:
+            daruma_path = self.sanitize(change.path)
+            if change.operation != EventCoalescer.PUT:
+                # keep changes in order
+                uploads.flush()
+
+            if change.delete_first and succeeded(daruma.delete, daruma_path):
+                self.sync_state.remove(daruma_path)
+
+            if change.operation == EventCoalescer.DELETE:
+                if succeeded(daruma.delete, daruma_path):
+                    self.sync_state.remove(daruma_path)
+            elif change.operation == EventCoalescer.MKDIR:
+                succeeded(daruma.mk_dir, daruma_path)
+            elif change.operation == EventCoalescer.MOVE:
+                destination = self.sanitize(change.destination)
+                if change.is_directory:
+                    # If we get a move event on a directory from watchdog, then the
+                    # directory is already empty, since watchdog notifies us of all
+                    # the children first.
+                    moved = succeeded(daruma.mk_dir, destination) and succeeded(daruma.delete, daruma_path)
+                else:
+                    moved = succeeded(daruma.move, daruma_path, destination)
+                if moved:
+                    self.sync_state.move(daruma_path, destination)
+            elif change.operation == EventCoalescer.PUT:
+                if not uploads.add(daruma_path, change.path, delta=not change.created):
+                    # the file is gone again; its deletion will be a change of its own
+                    logger.info("skipped vanished file " + change.path)
+        uploads.flush()
 
 
 class FilesystemWatcher():
@@ -128,15 +458,23 @@ class FilesystemWatcher():
     This thread must be stopped after use by calling the object's stop method.
     """
 
-    def __init__(self, path, app_state):
+    def __init__(self, path, app_state, quiet_period=EventCoalescer.QUIET_PERIOD, sync_state=None):
         """
         Args:
             path: the file path to recursively watch for changes on.
             app_state: the currently ApplicationState instance.
+            quiet_period: the number of seconds a path must go without
+                filesystem events before its changes are made in daruma.
+            sync_state: (optional) the SyncState recording the files synced
+                between path and daruma; the one in the user's data
+                directory by default.
         """
         self.path = path
         self.app_state = app_state
-        self.event_handler = DarumaFileSystemEventHandler(path, app_state)
+        self.sync_state = sync_state if sync_state is not None else SyncState()
+        # the SyncProgress of the latest bulk update
+        self.progress = SyncProgress()
+        self.event_handler = DarumaFileSystemEventHandler(path, app_state, self.sync_state, quiet_period)
         self.observer = Observer()
         self.observer.schedule(self.event_handler, path, recursive=True)
 
@@ -144,14 +482,17 @@ class FilesystemWatcher():
         """
         Starts running the observer in the given thread.
         """
+        self.event_handler.coalescer.start()
         self.observer.start()
 
     def stop(self):
         """
-        De-registers the filesystem watcher and ends the thread.
+        De-registers the filesystem watcher and ends the thread, after making
+        any changes still waiting for their paths to go quiet.
         """
         self.observer.stop()
         self.observer.join()
+        self.event_handler.coalescer.stop()
 
     def pause(self):
         self.event_handler.watching = False
@@ -161,8 +502,9 @@ class FilesystemWatcher():
 
     def wipe_filesystem(self):
         """
-        Removes all files in the watched directory
+        Removes all files in the watched directory, and forgets they were synced
         """
+        self.sync_state.clear()
         for the_file in os.listdir(self.path):
             file_path = os.path.join(self.path, the_file)
             if os.path.isfile(file_path):
@@ -176,51 +518,130 @@ class FilesystemWatcher():
                 except:
                     pass
 
-    def bulk_update_filesystem(self):
+    def refresh_versions(self):
+        """
+        Record the current versions of the synced files, after daruma stored
+        them again without changing them (e.g. when reprovisioning), so that
+        they aren't taken for files changed elsewhere.
+        """
+        daruma = self.app_state.daruma
+        if daruma is None:
+            return
+        with daruma_error_handler():
+            self.sync_state.set_code_names(daruma.list_versions(self.sync_state.paths()))
+
+    def bulk_update_filesystem(self, progress_handler=None):
         """
         Syncs Daruma state with filesystem state
+        The folder and daruma are compared with the sync state, which records
+        every file as it was when last synced, so that only the files that
+        changed since are read or transferred (see plan_sync):
+            - files deleted from the folder are deleted from daruma, and files
+              deleted from daruma are deleted from the folder
+            - new and changed files are uploaded, small ones in batches
+            - new and changed files in daruma are downloaded,
+              BULK_DOWNLOAD_PARALLELISM at a time
+            - a file changed in both is kept in daruma, and the local version is
+              uploaded next to it as a conflicted copy
+        Each file is recorded as soon as it is synced, so a bulk update that was
+        interrupted only transfers the files it hadn't reached.
+        Args: progress_handler, (optional) a function to call with the
+            SyncProgress of the update (also kept as self.progress) as it
+            progresses
         """
-        def to_daruma_path(system_path):
-            return system_path[len(self.path) + 1:]
+        daruma = self.app_state.daruma
+        if daruma is None:
+            return
+        self.pause()
+        self.progress = SyncProgress(progress_handler)
+        try:
+            with daruma_error_handler():
+                if not self.sync_state.claim(daruma.get_instance_id()):
+                    logger.info("no sync state for this daruma instance, assuming files in both are in sync")
+                versions = daruma.list_versions()
+                plan = plan_sync(self.path, self.sync_state, versions)
+                self.progress.add(len(plan.uploads) + len(plan.downloads) + 2 * len(plan.conflicts) +
+                                  len(plan.deleted_locally) + len(plan.deleted_remotely),
+                                  sum(size for _, _, size, _ in plan.uploads))
+
+                # First make the changes made in the folder
+                for daruma_path in plan.deleted_locally:
+                    if succeeded(daruma.delete, daruma_path):
+                        self.sync_state.remove(daruma_path)
+                        self.progress.done(0)
+                    else:
+                        self.progress.failed()
+                uploads = UploadBatch(daruma, self.sync_state, self.progress)
+                downloads = plan.downloads[:]
+                for daruma_path in plan.conflicts:
+                    system_path = self._to_system_path(daruma_path)
+                    try:
+                        conflict_path = conflicted_copy_path(system_path)
+                        os.rename(system_path, conflict_path)
+                    except OSError:
+                        logger.exception("failed to set aside conflicting file " + system_path)
+                        self.progress.failed()
+                        self.progress.failed()
+                        continue
+                    logger.info("both versions of %s changed, keeping the local one as %s", system_path, conflict_path)
+                    downloads.append(daruma_path)
+                    if not uploads.add(self._to_daruma_path(conflict_path), conflict_path):
+                        self.progress.failed()
+                for daruma_path, system_path, _, delta in plan.uploads:
+                    if not uploads.add(daruma_path, system_path, delta):
+                        self.progress.failed()
+                uploads.flush()
+
+                # Then the changes made in daruma
+                for daruma_path in plan.deleted_remotely:
+                    try:
+                        os.remove(self._to_system_path(daruma_path))
+                        self.sync_state.remove(daruma_path)
+                        self.progress.done(0)
+                    except OSError:
+                        logger.exception("failed to delete " + daruma_path)
+                        self.progress.failed()
+                executor = ThreadPoolExecutor(max_workers=BULK_DOWNLOAD_PARALLELISM)
+                try:
+                    for _ in executor.map(lambda path: self._download(daruma, path, versions[path]), downloads):
+                        pass
+                finally:
+                    executor.shutdown()
+        finally:
+            self.progress.finish()
+            self.resume()
 
-        def to_system_path(daruma_path):
-            return os.path.join(self.path, daruma_path)
+    def _to_daruma_path(self, system_path):
+        return system_path[len(self.path) + 1:]
 
-        def path_is_allowed(path):
-            for pattern in REJECT_PATTERNS:
-                if fnmatch.fnmatch(path, pattern):
-                    return False
-            return True
-        if self.app_state.daruma is not None:
-            self.pause()
-            daruma = self.app_state.daruma
-            with daruma_error_handler():
-                all_paths = set(daruma.list_all_paths())
-
-                # First upload new files
-                for dirpath, dirnames, filenames in os.walk(self.path):
-                    for filename in filenames:
-                        system_path = os.path.join(dirpath, filename)
-                        if not path_is_allowed(system_path):
-                            continue
-                        daruma_path = to_daruma_path(system_path)
-                        if daruma_path not in all_paths:
-                            with open(system_path) as src_file:
-                                daruma.put(to_daruma_path(system_path), src_file.read())
-
-                # Then download existing files
-                for filepath in all_paths:
-                    system_path = to_system_path(filepath)
-                    if not os.path.exists(system_path):
-                        system_parent = os.path.dirname(system_path)
-                        if not os.path.isdir(system_parent):
-                            os.makedirs(system_parent)
-                        try:
-                            file_contents = daruma.get(filepath)
-                        except exceptions.FileNotFound:
-                            pass
-                        else:
-                            with open(system_path, "w") as dst_file:
-                                dst_file.write(file_contents)
+    def _to_system_path(self, daruma_path):
+        return os.path.join(self.path, daruma_path)
 
-            self.resume()
+    def _download(self, daruma, daruma_path, version):
+        """
+        Download a file from daruma into the watched directory and record it
+        in the sync state with its version, or make the directory if
+        daruma_path is one
+        """
+        system_path = self._to_system_path(daruma_path)
+        partial_path = system_path + PARTIAL_SUFFIX
+        try:
+            make_directory(os.path.dirname(system_path))
+            try:
+                with open(partial_path, "wb") as dst_file:
+                    daruma.get_stream(daruma_path, dst_file)
+            except exceptions.FileNotFound:
+                # this path is a directory
+                os.remove(partial_path)
+                make_directory(system_path)
+                self.progress.done(0)
+                return
+            os.rename(partial_path, system_path)
+            stat = os.stat(system_path)
+            self.sync_state.record(daruma_path, stat.st_mtime, stat.st_size, hash_file(system_path), version)
+            self.progress.done(stat.st_size)
+        except (exceptions.FatalOperationFailure, IOError, OSError):
+            logger.exception("failed to download " + daruma_path)
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            self.progress.failed()
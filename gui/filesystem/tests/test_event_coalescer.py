@@ -0,0 +1,148 @@
+from gui.filesystem import EventCoalescer
+from gui.filesystem.EventCoalescer import PUT, MKDIR, DELETE, MOVE
+import pytest
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(EventCoalescer, "time", clock)
+    return clock
+
+
+@pytest.fixture
+def dispatched():
+    return []
+
+
+@pytest.fixture
+def coalescer(clock, dispatched):
+    return EventCoalescer.EventCoalescer(dispatched.append, quiet_period=1, max_delay=5)
+
+
+def summary(changes):
+    return [(change.operation, change.path) for change in changes]
+
+
+def test_create_modify_delete_collapses(coalescer, dispatched):
+    coalescer.created("a", False)
+    coalescer.modified("a")
+    coalescer.modified("a")
+    coalescer.deleted("a", False)
+    assert coalescer.pending() == 0
+    coalescer.flush()
+    assert dispatched == []
+
+
+def test_create_and_modify_is_one_put(coalescer, dispatched):
+    coalescer.created("a", False)
+    coalescer.modified("a")
+    coalescer.modified("a")
+    coalescer.flush()
+    assert summary(dispatched[0]) == [(PUT, "a")]
+    assert dispatched[0][0].created
+
+
+def test_modify_then_delete_deletes(coalescer, dispatched):
+    coalescer.modified("a")
+    coalescer.deleted("a", False)
+    coalescer.flush()
+    assert summary(dispatched[0]) == [(DELETE, "a")]
+
+
+def test_replace_across_types(coalescer, dispatched):
+    coalescer.deleted("file", False)
+    coalescer.created("file", True)
+    coalescer.deleted("dir", True)
+    coalescer.created("dir", False)
+    coalescer.deleted("same", False)
+    coalescer.created("same", False)
+    coalescer.flush()
+
+    changes = dict((change.path, change) for change in dispatched[0])
+    assert (changes["file"].operation, changes["file"].is_directory) == (MKDIR, True)
+    assert changes["file"].delete_first
+    assert (changes["dir"].operation, changes["dir"].is_directory) == (PUT, False)
+    assert changes["dir"].delete_first
+    assert changes["same"].operation == PUT
+    assert not changes["same"].delete_first
+    assert not changes["same"].created
+
+
+def test_dispatch_order(coalescer, dispatched):
+    coalescer.modified("file")
+    coalescer.created("dir/sub", True)
+    coalescer.created("dir", True)
+    coalescer.deleted("old", True)
+    coalescer.deleted("old/file", False)
+    coalescer.flush()
+    assert summary(dispatched[0]) == [(DELETE, "old/file"), (DELETE, "old"), (MKDIR, "dir"), (MKDIR, "dir/sub"),
+                                      (PUT, "file")]
+
+
+def test_move(coalescer, dispatched):
+    coalescer.modified("other")
+    coalescer.moved("a", "b", False)
+    assert summary(dispatched[0]) == [(PUT, "other"), (MOVE, "a")]
+    assert dispatched[0][1].destination == "b"
+    assert coalescer.pending() == 0
+
+
+def test_move_of_created_file_replaces_destination(coalescer, dispatched):
+    # a file saved by writing a temporary file and renaming it over the original
+    coalescer.created("a.tmp", False)
+    coalescer.modified("a.tmp")
+    coalescer.moved("a.tmp", "a", False)
+    assert dispatched == []
+
+    coalescer.flush()
+    assert summary(dispatched[0]) == [(PUT, "a")]
+    # the original may be stored, so its new version replaces it
+    assert not dispatched[0][0].created
+
+
+def test_move_of_created_file_over_deleted_destination(coalescer, dispatched):
+    coalescer.deleted("a", False)
+    coalescer.created("a.tmp", False)
+    coalescer.moved("a.tmp", "a", False)
+    coalescer.flush()
+    assert summary(dispatched[0]) == [(PUT, "a")]
+    assert not dispatched[0][0].delete_first
+
+
+def test_move_carries_pending_change(coalescer, dispatched):
+    coalescer.modified("a")
+    coalescer.moved("a", "b", False)
+    # the stored version is moved first, then the change is made to the destination
+    assert summary(dispatched[0]) == [(MOVE, "a")]
+    coalescer.flush()
+    assert summary(dispatched[1]) == [(PUT, "b")]
+    assert not dispatched[1][0].created
+
+
+def test_quiet_period(coalescer, clock):
+    coalescer.modified("a")
+    clock.now += 0.9
+    assert coalescer._take_due(clock.now) == []
+    clock.now += 0.1
+    assert summary(coalescer._take_due(clock.now)) == [(PUT, "a")]
+
+
+def test_max_delay(coalescer, clock):
+    coalescer.modified("a")
+    # a steady stream of events holds the change back, but only up to max_delay
+    for _ in xrange(9):
+        clock.now += 0.5
+        coalescer.modified("a")
+        assert coalescer._take_due(clock.now) == []
+    clock.now += 0.5
+    coalescer.modified("a")
+    assert summary(coalescer._take_due(clock.now)) == [(PUT, "a")]
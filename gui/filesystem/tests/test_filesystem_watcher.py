@@ -0,0 +1,273 @@
+from gui.filesystem.FilesystemWatcher import FilesystemWatcher, UploadBatch, plan_sync, PARTIAL_SUFFIX
+from managers.Distributor import FileDistributor
+from managers.SyncState import SyncState, FileState
+from custom_exceptions import exceptions
+import hashlib
+import os
+import pytest
+
+
+class FakeDaruma(object):
+    """
+    An in-memory stand-in for Daruma, holding a version number for each file
+    """
+    def __init__(self):
+        # map from path to contents, or None for a directory
+        self.files = {}
+        self.versions = {}
+        self.next_version = 0
+        # the paths that were uploaded, in order, and the number of times put_many was called
+        self.uploads = []
+        self.batches = 0
+        # the paths that fail to download part way through
+        self.failing_downloads = set()
+
+    def store(self, path, data):
+        self.files[path] = data
+        self.versions[path] = str(self.next_version)
+        self.next_version += 1
+
+    def get_instance_id(self):
+        return "instance"
+
+    def list_versions(self, paths=None):
+        if paths is None:
+            paths = self.files.keys()
+        return {path: self.versions.get(path) for path in paths if path in self.files}
+
+    def put(self, path, data):
+        self.uploads.append(path)
+        self.store(path, data)
+
+    def put_many(self, files):
+        self.batches += 1
+        for path, data in files:
+            self.put(path, data)
+
+    def put_stream(self, path, stream):
+        self.put(path, stream.read())
+
+    def put_delta(self, path, stream):
+        self.put(path, stream.read())
+
+    def mk_dir(self, path):
+        self.files[path] = None
+
+    def delete(self, path):
+        if path not in self.files:
+            raise exceptions.InvalidPath
+        del self.files[path]
+        self.versions.pop(path, None)
+
+    def get_stream(self, path, out):
+        if self.files[path] is None:
+            raise exceptions.FileNotFound
+        if path in self.failing_downloads:
+            out.write(self.files[path][:1])
+            raise exceptions.FatalOperationFailure([])
+        out.write(self.files[path])
+
+
+class FakeApplicationState(object):
+    def __init__(self, daruma):
+        self.daruma = daruma
+
+
+@pytest.fixture
+def root(tmpdir):
+    return str(tmpdir.mkdir("folder"))
+
+
+@pytest.fixture
+def sync_state(tmpdir):
+    state = SyncState(str(tmpdir.join("sync_state.db")))
+    yield state
+    state.close()
+
+
+def write(root, path, data, mtime=1000):
+    system_path = os.path.join(root, path)
+    if not os.path.isdir(os.path.dirname(system_path)):
+        os.makedirs(os.path.dirname(system_path))
+    with open(system_path, "wb") as dst_file:
+        dst_file.write(data)
+    os.utime(system_path, (mtime, mtime))
+    return system_path
+
+
+def record(sync_state, path, data, code_name, mtime=1000):
+    sync_state.record(path, mtime, len(data), hashlib.sha256(data).hexdigest(), code_name)
+
+
+def test_plan_new_and_deleted_files(root, sync_state):
+    new_path = write(root, "new", "data")
+    write(root, "deleted remotely", "data")
+    record(sync_state, "deleted remotely", "data", "1")
+    # a file recorded without a version wasn't known to be in daruma, so it's uploaded rather than deleted
+    unversioned_path = write(root, "unversioned", "data")
+    record(sync_state, "unversioned", "data", None)
+    record(sync_state, "deleted locally", "data", "2")
+    record(sync_state, "deleted from both", "data", "3")
+
+    plan = plan_sync(root, sync_state, {"deleted locally": "2", "only in daruma": "4"})
+    assert sorted(plan.uploads) == [("new", new_path, 4, False), ("unversioned", unversioned_path, 4, False)]
+    assert plan.deleted_remotely == ["deleted remotely"]
+    assert plan.deleted_locally == ["deleted locally"]
+    assert plan.downloads == ["only in daruma"]
+    assert plan.conflicts == []
+    assert sync_state.get("deleted from both") is None
+
+
+def test_plan_deletes_only_synced_versions(root, sync_state):
+    # a file changed since it was synced is uploaded rather than deleted
+    changed_path = write(root, "changed locally", "new data")
+    record(sync_state, "changed locally", "data", "1")
+    # a file changed in daruma since it was synced is downloaded rather than deleted
+    record(sync_state, "changed remotely", "data", "2")
+
+    plan = plan_sync(root, sync_state, {"changed remotely": "3"})
+    assert plan.uploads == [("changed locally", changed_path, 8, False)]
+    assert plan.downloads == ["changed remotely"]
+    assert plan.deleted_locally == []
+    assert plan.deleted_remotely == []
+
+
+def test_plan_files_in_both(root, sync_state):
+    write(root, "unrecorded", "data")
+    write(root, "unchanged", "data")
+    record(sync_state, "unchanged", "data", "1")
+    write(root, "changed remotely", "data")
+    record(sync_state, "changed remotely", "data", "2")
+    write(root, "conflict", "new data")
+    record(sync_state, "conflict", "data", "3")
+    modified_path = write(root, "modified", "new data")
+    record(sync_state, "modified", "data", "4")
+    # the same size, but different contents
+    rewritten_path = write(root, "rewritten", "atad", mtime=2000)
+    record(sync_state, "rewritten", "data", "5")
+
+    plan = plan_sync(root, sync_state, {"unrecorded": "0", "unchanged": "1", "changed remotely": "new",
+                                        "conflict": "new", "modified": "4", "rewritten": "5"})
+    assert plan.downloads == ["changed remotely"]
+    assert plan.conflicts == ["conflict"]
+    assert sorted(plan.uploads) == [("modified", modified_path, 8, True), ("rewritten", rewritten_path, 4, True)]
+    assert plan.deleted_locally == [] and plan.deleted_remotely == []
+    # files in both that weren't recorded are assumed to be in sync
+    assert sync_state.get("unrecorded") == FileState(1000, 4, None, "0")
+
+
+def test_plan_touched_file(root, sync_state):
+    write(root, "touched", "data", mtime=2000)
+    record(sync_state, "touched", "data", "1")
+    write(root, "unversioned", "data")
+    record(sync_state, "unversioned", "data", None)
+
+    plan = plan_sync(root, sync_state, {"touched": "1", "unversioned": "2"})
+    assert plan == ([], [], [], [], [])
+    # only the modification time changed, so the file is recorded rather than uploaded
+    assert sync_state.get("touched") == FileState(2000, 4, hashlib.sha256("data").hexdigest(), "1")
+    assert sync_state.get("unversioned").code_name == "2"
+
+
+def test_plan_directories(root, sync_state):
+    os.makedirs(os.path.join(root, "existing"))
+    write(root, "partial" + PARTIAL_SUFFIX, "data")
+
+    plan = plan_sync(root, sync_state, {"existing": None, "new": None, "new/file": "1"})
+    assert sorted(plan.downloads) == ["new", "new/file"]
+    # partially downloaded files aren't uploaded
+    assert plan.uploads == []
+
+
+def test_bulk_update_keeps_conflicting_copy(root, sync_state):
+    daruma = FakeDaruma()
+    daruma.store("file.txt", "remote")
+    sync_state.claim(daruma.get_instance_id())
+    write(root, "file.txt", "local data")
+    record(sync_state, "file.txt", "data", "old version")
+
+    watcher = FilesystemWatcher(root, FakeApplicationState(daruma), sync_state=sync_state)
+    watcher.bulk_update_filesystem()
+
+    with open(os.path.join(root, "file.txt"), "rb") as src_file:
+        assert src_file.read() == "remote"
+    with open(os.path.join(root, "file (conflicted copy).txt"), "rb") as src_file:
+        assert src_file.read() == "local data"
+    assert daruma.files["file (conflicted copy).txt"] == "local data"
+    assert daruma.files["file.txt"] == "remote"
+    assert sync_state.get("file.txt").code_name == daruma.versions["file.txt"]
+    assert watcher.progress.to_dict()["files_done"] == 2
+
+
+def test_upload_batch(root, sync_state):
+    daruma = FakeDaruma()
+    uploads = UploadBatch(daruma, sync_state)
+    for name in ["a", "b", "c"]:
+        assert uploads.add(name, write(root, name, "data " + name))
+    assert not uploads.add("missing", os.path.join(root, "missing"))
+    # small files wait for the batch to be flushed, and are put together
+    assert daruma.uploads == []
+    uploads.flush()
+    assert sorted(daruma.uploads) == ["a", "b", "c"]
+    assert daruma.batches == 1
+    assert sync_state.get("b") == FileState(1000, 6, hashlib.sha256("data b").hexdigest(), daruma.versions["b"])
+
+
+def test_upload_batch_streams_large_files(root, sync_state, monkeypatch):
+    monkeypatch.setattr(FileDistributor, "CHUNK_SIZE", 4)
+    daruma = FakeDaruma()
+    uploads = UploadBatch(daruma, sync_state)
+    assert uploads.add("large", write(root, "large", "large data"))
+    assert daruma.files["large"] == "large data"
+    assert daruma.batches == 0
+    assert sync_state.get("large").code_name == daruma.versions["large"]
+
+
+def test_upload_batch_skips_unchanged_contents(root, sync_state):
+    daruma = FakeDaruma()
+    daruma.store("touched", "data")
+    record(sync_state, "touched", "data", daruma.versions["touched"])
+    system_path = write(root, "touched", "data", mtime=2000)
+
+    uploads = UploadBatch(daruma, sync_state)
+    assert uploads.add("touched", system_path, delta=True)
+    uploads.flush()
+    assert daruma.uploads == []
+    assert sync_state.get("touched").mtime == 2000
+
+
+def test_interrupted_bulk_update_resumes(root, sync_state):
+    daruma = FakeDaruma()
+    daruma.store("remote a", "a")
+    daruma.store("remote b", "b")
+    write(root, "local", "data")
+    daruma.failing_downloads.add("remote b")
+
+    watcher = FilesystemWatcher(root, FakeApplicationState(daruma), sync_state=sync_state)
+    watcher.bulk_update_filesystem()
+    assert watcher.progress.to_dict()["files_failed"] == 1
+    assert daruma.uploads == ["local"]
+    assert os.path.exists(os.path.join(root, "remote a"))
+    assert not os.path.exists(os.path.join(root, "remote b"))
+
+    # the next bulk update only transfers the file the first didn't finish
+    daruma.failing_downloads.clear()
+    watcher.bulk_update_filesystem()
+    assert watcher.progress.to_dict()["files_total"] == 1
+    assert watcher.progress.to_dict()["files_done"] == 1
+    assert daruma.uploads == ["local"]
+    with open(os.path.join(root, "remote b"), "rb") as src_file:
+        assert src_file.read() == "b"
+
+
+def test_failed_download_removes_partial_file(root, sync_state):
+    daruma = FakeDaruma()
+    daruma.store("dir/file", "data")
+    daruma.failing_downloads.add("dir/file")
+
+    watcher = FilesystemWatcher(root, FakeApplicationState(daruma), sync_state=sync_state)
+    watcher.bulk_update_filesystem()
+    assert os.listdir(os.path.join(root, "dir")) == []
+    assert not os.path.exists(os.path.join(root, "dir", "file" + PARTIAL_SUFFIX))
+    assert sync_state.get("dir/file") is None
+    assert watcher.progress.to_dict()["files_failed"] == 1
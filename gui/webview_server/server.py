@@ -5,6 +5,7 @@ from custom_exceptions import exceptions
 import gui
 from tools.utils import INTERNAL_SERVER_HOST, INTERNAL_SERVER_PORT, get_resource_path
 from driver.Daruma import Daruma
+from managers.ManifestCache import ManifestCache
 import logging
 
 
@@ -148,7 +149,8 @@ def try_load_instance():
         return redirect("setup.html")
     try:
         # TODO handle extra providers
-        global_app_state.daruma, extra_providers = Daruma.load(global_app_state.providers)
+        global_app_state.daruma, extra_providers = Daruma.load(global_app_state.providers, threshold_first_reads=True, latency_aware_reads=True,
+                                                               manifest_cache=ManifestCache())
         return redirect("dashboard.html")
     except exceptions.FatalOperationFailure:
         return redirect("modal/show/confirm_provision")
@@ -177,12 +179,17 @@ def get_provider_list():
     providers = []
     overall_status = "GREEN"
 
+    metrics = {}
+    if global_app_state.daruma is not None:
+        metrics = global_app_state.daruma.get_provider_metrics()
+
     for provider in global_app_state.providers:
         provider_dict = {
             "name": provider.provider_name(),
             "identifier": provider.provider_identifier(),
             "id": provider.uid,
             "status": provider.status,
+            "metrics": metrics.get(provider, provider.metrics.summary())
         }
         providers.append(provider_dict)
 
@@ -233,7 +240,9 @@ def try_provision_instance():
     try:
         global_app_state.daruma = Daruma.provision(global_app_state.providers,
                                                    len(global_app_state.providers) - 1,
-                                                   len(global_app_state.providers) - 1)
+                                                   len(global_app_state.providers) - 1,
+                                                   threshold_first_reads=True, latency_aware_reads=True,
+                                                   manifest_cache=ManifestCache())
         global_native_app.mark_setup_complete()
         global_app_state.filesystem_watcher.bulk_update_filesystem()
         return jsonify({"success": True})
@@ -249,6 +258,8 @@ def reprovision():
     try:
         logger.info("reprovisioning")
         global_app_state.daruma.reprovision(global_app_state.providers, len(global_app_state.providers) - 1, len(global_app_state.providers) - 1)
+        # reprovisioning stores every file again under a new code name
+        global_app_state.filesystem_watcher.refresh_versions()
     except Exception as e:
         logger.error("reprovision failed")
         logger.error(e)
@@ -269,6 +280,11 @@ def get_icon_statuses():
     return jsonify(status_dict)
 
 
+@app.route('/sync_progress')
+def get_sync_progress():
+    return jsonify(global_app_state.filesystem_watcher.progress.to_dict())
+
+
 @app.route('/resync')
 def resync():
     global_app_state.filesystem_watcher.wipe_filesystem()
@@ -32,6 +32,14 @@ function buildProviderString(provider){
             statusMessage = "Offline"
             break;
     }
+    var metrics = provider["metrics"]
+    if (metrics["slow"] && provider["status"] == "GREEN")
+        statusMessage = "Operational but Slow"
+    var metricsMessage = ""
+    if (metrics["p50_latency"] != null)
+        metricsMessage = Math.round(metrics["p50_latency"] * 1000) + " ms"
+    if (metrics["throughput"] != null)
+        metricsMessage += " &middot; " + (metrics["throughput"] / (1024 * 1024)).toFixed(1) + " MB/s"
     var div = '<div class="provider-tile status-' + provider["status"].toLowerCase() + '">' +
               '<button type="button" class="remove-provider-button" onclick="onRemoveProviderButtonClick(this)">X</button>' +
               '<img class="provider-icon-square" src="static/logos/square/' + provider["identifier"] + '.png"><br>' +
@@ -39,6 +47,7 @@ function buildProviderString(provider){
               '<span class="provider-identifier" style="display:none">' + provider['identifier'] + '</span>' + 
               '<span class="provider-username">' + provider['id'] + '</span>' + 
               '<p class="provider-status">' + statusMessage + '</p>' +
+              '<p class="provider-metrics">' + metricsMessage + '</p>' +
               '</div>';
     return div
 }
@@ -1,7 +1,7 @@
 # This file handles keys using SSSS
 from tools import shamir_secret_sharing
 from tools.encryption import KEY_SIZE
-from tools.utils import FILENAME_SIZE, run_parallel, generate_random_name
+from tools.utils import FILENAME_SIZE, generate_random_name, wait_for_failures
 from collections import defaultdict
 from custom_exceptions import exceptions
 from itertools import product
@@ -110,9 +110,9 @@ class BootstrapManager:
         shares_map = {}  # maps provider to bootstrap share
         vote_map = defaultdict(list)  # maps (threshold, n) vote to providers that voted
 
-        def get_bootstrap_plaintext(provider):
+        def parse_bootstrap_plaintext(provider, compressed_plaintext):
             try:
-                bootstrap_plaintext = zlib.decompress(provider.get(self.BOOTSTRAP_PLAINTEXT_FILE_NAME))
+                bootstrap_plaintext = zlib.decompress(compressed_plaintext)
                 threshold_vote, n_vote, provider_id, version = self._parse_bootstrap_plaintext(bootstrap_plaintext)
 
                 # track provider votes for bootstrap threshold, n values, and version
@@ -121,21 +121,24 @@ class BootstrapManager:
             except ValueError:
                 raise exceptions.InvalidShareFailure(provider, "Got invalid boostrap share from " + str(provider))
 
-        def get_bootstrap_share(provider):
+        def parse_bootstrap_share(provider, compressed_share):
             try:
-                shares_map[provider] = zlib.decompress(provider.get(self.BOOTSTRAP_FILE_NAME))
+                shares_map[provider] = zlib.decompress(compressed_share)
             except zlib.error:
                 raise exceptions.InvalidShareFailure(provider)
 
-        def run_on_provider(func, provider):
-            return func(provider)
-
-        args = []
+        # start all of the downloads before parsing any of them
+        downloads = []
         for provider in self.providers:
-            args.append([get_bootstrap_plaintext, provider])
-            args.append([get_bootstrap_share, provider])
+            downloads.append((parse_bootstrap_plaintext, provider, provider.get_async(self.BOOTSTRAP_PLAINTEXT_FILE_NAME)))
+            downloads.append((parse_bootstrap_share, provider, provider.get_async(self.BOOTSTRAP_FILE_NAME)))
 
-        failures = run_parallel(run_on_provider, args)
+        failures = []
+        for parse, provider, future in downloads:
+            try:
+                parse(provider, future.result())
+            except Exception as e:
+                failures.append(e)
 
         # we don't want to double penalize if a provider fails in the same way on both files
         failures = list(set(failures))
@@ -275,18 +278,15 @@ class BootstrapManager:
         shares_map = shamir_secret_sharing.share(string, provider_ids, self.bootstrap_reconstruction_threshold)
 
         # write shares to providers
-        def put_to_provider(provider, filename, data):
-            provider.put(filename, data)
-
-        args = []
+        futures = []
         for provider, provider_id in zip(self.providers, provider_ids):
             share = shares_map[provider_id]
             bootstrap_plaintext = self._make_bootstrap_plaintext(self.bootstrap_reconstruction_threshold, self.num_providers, provider_id, version)
 
-            args.append([provider, self.BOOTSTRAP_PLAINTEXT_FILE_NAME, zlib.compress(bootstrap_plaintext)])
-            args.append([provider, self.BOOTSTRAP_FILE_NAME, zlib.compress(share)])
+            futures.append(provider.put_async(self.BOOTSTRAP_PLAINTEXT_FILE_NAME, zlib.compress(bootstrap_plaintext)))
+            futures.append(provider.put_async(self.BOOTSTRAP_FILE_NAME, zlib.compress(share)))
 
-        failures = run_parallel(put_to_provider, args)
+        failures = wait_for_failures(futures)
 
         if len(failures) > 0:
             raise exceptions.FatalOperationFailure(failures)
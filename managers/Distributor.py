@@ -1,7 +1,11 @@
 from custom_exceptions import exceptions
 from tools import encryption, erasure_encoding
-from tools.utils import run_parallel
+from tools.utils import submit_task, wait_for_failures
+from concurrent.futures import as_completed, wait, FIRST_COMPLETED
+from collections import defaultdict, deque
 import itertools
+import time
+import nacl.utils
 
 # For RS distributing files
 
@@ -12,29 +16,81 @@ class FileDistributor:
     If a different set of providers and threshold is needed, a new FileDistributor
     object should be constructed
     """
-    def __init__(self, providers, num_providers, file_reconstruction_threshold):
+    # the default plaintext size of each stripe of a chunked file
+    CHUNK_SIZE = 4 * 1024 * 1024
+    # the max number of stripes in flight (beyond the one being processed) during streaming
+    PIPELINE_DEPTH = 2
+    # the size of the random version identifier embedded in each tagged share
+    SHARE_VERSION_SIZE = 16
+    # the size of the share digests recorded in the manifest
+    SHARE_DIGEST_SIZE = 16
+
+    def __init__(self, providers, num_providers, file_reconstruction_threshold, early_return=False, straggler_handler=None,
+                 read_planner=None, write_quorum=None, repair_handler=None):
         """
         Create a FileDistributor
         Args:
             providers: a list of providers to use
             num_providers: the total number of providers that have been configured with this system before
             file_reconstruction_threshold: the threshold for file file_reconstruction_threshold
+            early_return: whether gets with share digests should decode as soon
+                as file_reconstruction_threshold verified shares arrive,
+                rather than waiting for every provider
+            straggler_handler: (optional) a function called with (provider, failure)
+                when a fetch or upload that an early return didn't wait for finishes;
+                failure is None if the provider returned a valid share or stored its share
+            read_planner: (optional) a function that takes the list of providers and returns a list of
+                (provider, hedge_delay) pairs, most preferred provider first. If given, gets with share digests
+                only ask the first file_reconstruction_threshold providers for shares, and ask the next provider
+                whenever a fetch fails or takes longer than its hedge_delay in seconds
+            write_quorum: (optional) the number of providers that must store their shares before a put with
+                quorum=True returns, between file_reconstruction_threshold and num_providers
+            repair_handler: (optional) a function called with (provider, filename, share, failure) for each
+                upload that failed after a put with quorum=True returned, so that the share can be uploaded again
+                later; quorum puts wait for every provider unless both this and write_quorum are given
         """
         # make a copy of the provider list
         self.providers = providers[:]
         self.num_providers = num_providers
         self.file_reconstruction_threshold = file_reconstruction_threshold
+        self.early_return = early_return
+        self.straggler_handler = straggler_handler
+        self.read_planner = read_planner
+        self.write_quorum = write_quorum
+        self.repair_handler = repair_handler
 
-    def put(self, filename, data, key=None):
+    def put(self, filename, data, key=None, quorum=False):
         """
         Args:
             filename: string
             data: bytestring
             key: an optional key used to encrypt
+            quorum: whether to return once write_quorum providers have stored their shares, leaving the
+                remaining uploads to finish in the background and passing any that fail to repair_handler.
+                Only safe for files that are never overwritten, since a late upload may land after a newer one
         Returns:
             key: bytestring of the key used for encryption
         Raises:
-            FatalOperationFailure if any provider failed
+            FatalOperationFailure if any provider failed, or with quorum, if write_quorum can't be reached
+        """
+        key, _ = self.put_with_digests(filename, data, key, quorum)
+        return key
+
+    def put_with_digests(self, filename, data, key=None, quorum=False):
+        """
+        Like put, but also returns a keyed digest of each uploaded share. These
+        can be passed to get to reject bad shares before decoding.
+        Args:
+            filename: string
+            data: bytestring
+            key: an optional key used to encrypt
+            quorum: whether to return once write_quorum providers have stored their shares (see put)
+        Returns:
+            (key, digests)
+            key: bytestring of the key used for encryption
+            digests: a list of bytestrings, one per share
+        Raises:
+            FatalOperationFailure if any provider failed, or with quorum, if write_quorum can't be reached
         """
         # encrypt
         if key is None:
@@ -43,29 +99,144 @@ class FileDistributor:
 
         # compute RS
         shares = erasure_encoding.share(ciphertext, self.file_reconstruction_threshold, self.num_providers)
+        shares = self._tag_shares(shares, key)
 
         # upload to each provider
-        def upload(provider, share):
-            provider.put(filename, share)
+        futures = [provider.put_async(filename, share) for provider, share in zip(self.providers, shares)]
+        if quorum and self.write_quorum is not None and self.repair_handler is not None:
+            self._wait_for_write_quorum(filename, futures, shares)
+        else:
+            failures = wait_for_failures(futures)
+            if len(failures) > 0:
+                raise exceptions.FatalOperationFailure(failures)
 
-        failures = run_parallel(upload, zip(self.providers, shares))
+        digest_key = self._share_digest_key(key)
+        return key, [self._share_digest(share, digest_key) for share in shares]
 
-        if len(failures) > 0:
-            raise exceptions.FatalOperationFailure(failures)
+    def _wait_for_write_quorum(self, filename, futures, shares):
+        """
+        Wait until write_quorum of the uploads have succeeded. Uploads still running at that point finish in
+        the background; those that fail, and those that failed before the quorum was reached, are passed to
+        repair_handler rather than failing the put, and those that succeed are passed to straggler_handler.
+        Raises:
+            FatalOperationFailure if so many uploads failed that write_quorum can't be reached
+        """
+        uploads = dict((future, (provider, share)) for future, provider, share in zip(futures, self.providers, shares))
 
-        return key
+        def report_upload(future):
+            provider, share = uploads[future]
+            if future.exception() is not None:
+                self.repair_handler(provider, filename, share, future.exception())
+            elif self.straggler_handler is not None:
+                self.straggler_handler(provider, None)
+
+        pending = set(futures)
+        failed = []
+        stored = 0
+        for future in as_completed(futures):
+            pending.remove(future)
+            if future.exception() is not None:
+                failed.append(future)
+                if len(failed) > len(futures) - self.write_quorum:
+                    # report every failure, as a put without a quorum would
+                    failures = [future.exception() for future in failed] + wait_for_failures(list(pending))
+                    raise exceptions.FatalOperationFailure(failures)
+                continue
+            stored += 1
+            if stored == self.write_quorum:
+                break
+
+        for future in failed:
+            report_upload(future)
+        for straggler in pending:
+            straggler.add_done_callback(report_upload)
+
+    def _share_tag_key(self, key):
+        return encryption.derive_key(key, "share-tag")
+
+    def _share_digest_key(self, key):
+        return encryption.derive_key(key, "share-digest")
+
+    def _share_digest(self, share, digest_key):
+        return encryption.keyed_digest(share, digest_key)[:self.SHARE_DIGEST_SIZE]
+
+    def _tag_shares(self, shares, key):
+        """
+        Prefix each share with a tag that authenticates it (and the version of
+        the file it belongs to) under the file key, so that bad shares can be
+        located without decoding.
+        Tagged share format: tag | version | share
+        """
+        tag_key = self._share_tag_key(key)
+        version = nacl.utils.random(self.SHARE_VERSION_SIZE)
+        return [encryption.keyed_digest(version + share, tag_key) + version + share for share in shares]
+
+    def _untag_share(self, tagged_share, tag_key):
+        """
+        Returns:
+            (version, share) if the tag is valid, or None otherwise
+        """
+        tag = tagged_share[:encryption.DIGEST_SIZE]
+        versioned_share = tagged_share[encryption.DIGEST_SIZE:]
+        if len(versioned_share) <= self.SHARE_VERSION_SIZE or \
+           not encryption.verify_digest(versioned_share, tag, tag_key):
+            return None
+        return versioned_share[:self.SHARE_VERSION_SIZE], versioned_share[self.SHARE_VERSION_SIZE:]
+
+    def _attempt_recovery(self, shares, key):
+        ciphertext = erasure_encoding.reconstruct(shares, self.file_reconstruction_threshold, self.num_providers)
+        data = encryption.decrypt(ciphertext, key)
+        return data
 
     def _recover(self, shares, key):
         """
+        Verifies each share's tag, and decodes once from shares of the best
+        supported version.  Shares with invalid tags, or from another version
+        of the file, are cheaters.
+        Returns:
+            (result, bad_shares)
+            result: A byte representation of the reconstructed message if the reconstruction was successful, or None otherwise
+            bad_shares: the shares that were deemed cheaters
+        """
+        tag_key = self._share_tag_key(key)
+
+        # map from version to the valid (tagged share, share) pairs of that version
+        versions = defaultdict(list)
+        for tagged_share in shares:
+            untagged = self._untag_share(tagged_share, tag_key)
+            if untagged is not None:
+                version, share = untagged
+                versions[version].append((tagged_share, share))
+
+        if len(versions) == 0:
+            # either every share is bad, or these shares predate tagging
+            return self._recover_untagged(shares, key)
+
+        # try the versions with the most support first
+        for version_shares in sorted(versions.values(), key=len, reverse=True):
+            if len(version_shares) < self.file_reconstruction_threshold:
+                break
+            try:
+                data = self._attempt_recovery([share for (_, share) in version_shares[:self.file_reconstruction_threshold]], key)
+            except (exceptions.DecodeError, exceptions.DecryptError):
+                continue
+            good_shares = [tagged_share for (tagged_share, _) in version_shares]
+            return data, [share for share in shares if share not in good_shares]
+
+        # cannot recover, but shares with invalid tags are certainly bad
+        valid_shares = [tagged_share for version_shares in versions.values() for (tagged_share, _) in version_shares]
+        return None, [share for share in shares if share not in valid_shares]
+
+    def _recover_untagged(self, shares, key):
+        """
+        Recover from shares without tags by searching for a working set of shares
         Returns:
             (result, bad_shares)
             result: A byte representation of the reconstructed message if the reconstruction was successful, or None otherwise
             bad_shares: the shares that were deemed cheaters
         """
         def attempt_recovery(shares):
-            ciphertext = erasure_encoding.reconstruct(shares, self.file_reconstruction_threshold, self.num_providers)
-            data = encryption.decrypt(ciphertext, key)
-            return data
+            return self._attempt_recovery(shares, key)
 
         def find_minimal_working_set():
             """
@@ -90,7 +261,7 @@ class FileDistributor:
         bad_shares = []
 
         # split shares into groups of size threshold
-        groups = zip(*[iter(shares)]*self.file_reconstruction_threshold)
+        groups = map(list, zip(*[iter(shares)]*self.file_reconstruction_threshold))
 
         # if not all shares made it (threshold doesn't divide n), also test the last (threshold) shares
         if len(groups) * self.file_reconstruction_threshold < len(shares):
@@ -126,26 +297,50 @@ class FileDistributor:
 
         return data, bad_shares
 
-    def get(self, filename, key):
+    def get(self, filename, key, digests=None):
         """
         Args:
             filename: string
             key: bytestring
+            digests: (optional) the share digests returned by put_with_digests;
+                shares that don't match one of them are rejected without decoding
         Returns:
             result: bytestring
         Raises:
              FileReconstructionError
              OperationFailure if any provider failed
         """
+        if self.read_planner is not None and digests is not None:
+            return self._get_planned(filename, key, digests)
+        if self.early_return and digests is not None:
+            return self._get_threshold_first(filename, key, digests)
+
+        futures = [provider.get_async(filename) for provider in self.providers]
+        failures = wait_for_failures(futures)
+
         # map from share to provider returning that share
         shares_map = {}
+        for future, provider in zip(futures, self.providers):
+            if future.exception() is None:
+                shares_map[future.result()] = provider
 
-        def get_share(provider):
-            shares_map[provider.get(filename)] = provider
+        if digests is not None:
+            digest_key = self._share_digest_key(key)
+            for share, provider in shares_map.items():
+                if self._share_digest(share, digest_key) not in digests:
+                    failures.append(exceptions.InvalidShareFailure(provider, "distributor share digest mismatch"))
+                    del shares_map[share]
 
-        args = map(lambda provider: [provider], self.providers)
-        failures = run_parallel(get_share, args)
+        return self._finish_get(shares_map, failures, key)
 
+    def _finish_get(self, shares_map, failures, key):
+        """
+        Recover the data from all of the fetched shares
+        Args:
+            shares_map: a map from share to the provider that returned it
+            failures: the failures encountered so far
+            key: bytestring
+        """
         shares = shares_map.keys()
 
         if len(shares) < self.file_reconstruction_threshold:
@@ -164,11 +359,282 @@ class FileDistributor:
 
         return data
 
+    def _get_threshold_first(self, filename, key, digests):
+        """
+        Get a file, decoding as soon as file_reconstruction_threshold shares
+        have arrived and matched their digests.  The remaining fetches finish in
+        the background, and their outcomes are only passed to straggler_handler.
+        Only failures that arrived before decoding are reported.
+        """
+        digest_key = self._share_digest_key(key)
+
+        def check_share(future, provider):
+            return self._check_share(future, provider, digest_key, digests)
+
+        def report_straggler(future):
+            _, failure = check_share(future, providers_map[future])
+            if self.straggler_handler is not None:
+                self.straggler_handler(providers_map[future], failure)
+
+        futures = [provider.get_async(filename) for provider in self.providers]
+        providers_map = dict(zip(futures, self.providers))
+        pending = set(futures)
+
+        shares_map = {}
+        failures = []
+        for future in as_completed(futures):
+            pending.remove(future)
+            share, failure = check_share(future, providers_map[future])
+            if failure is not None:
+                failures.append(failure)
+                continue
+
+            shares_map[share] = providers_map[future]
+            if len(shares_map) != self.file_reconstruction_threshold:
+                continue
+
+            # verified shares all come from the same upload, so this should only fail on a bad key
+            data, bad_shares = self._recover(shares_map.keys(), key)
+            if data is None or len(bad_shares) > 0:
+                continue
+
+            for straggler in pending:
+                straggler.add_done_callback(report_straggler)
+
+            if len(failures) > 0:
+                raise exceptions.OperationFailure(failures, data)
+            return data
+
+        # we couldn't return early; use everything we got
+        return self._finish_get(shares_map, failures, key)
+
+    def _check_share(self, future, provider, digest_key, digests):
+        """
+        Returns (share, failure) for a finished fetch, exactly one of which is None
+        """
+        if future.exception() is not None:
+            return None, future.exception()
+        share = future.result()
+        if self._share_digest(share, digest_key) not in digests:
+            return None, exceptions.InvalidShareFailure(provider, "distributor share digest mismatch")
+        return share, None
+
+    def _get_planned(self, filename, key, digests):
+        """
+        Get a file by fetching shares from only as many providers as needed, in the order given by read_planner.
+        Another provider is asked whenever a fetch fails, or takes longer than its hedge delay, until
+        file_reconstruction_threshold verified shares have arrived. Fetches still running at that point
+        finish in the background, and their outcomes are only passed to straggler_handler.
+        Only failures that arrived before decoding are reported.
+        """
+        digest_key = self._share_digest_key(key)
+        unasked = deque(self.read_planner(self.providers))
+        # map from each fetch to its provider, and from each fetch not yet hedged to the time to hedge it
+        providers_map = {}
+        deadlines = {}
+        pending = set()
+
+        def ask_next():
+            provider, hedge_delay = unasked.popleft()
+            future = provider.get_async(filename)
+            providers_map[future] = provider
+            deadlines[future] = time.time() + hedge_delay
+            pending.add(future)
+
+        def report_straggler(future):
+            _, failure = self._check_share(future, providers_map[future], digest_key, digests)
+            if self.straggler_handler is not None:
+                self.straggler_handler(providers_map[future], failure)
+
+        while len(unasked) > 0 and len(pending) < self.file_reconstruction_threshold:
+            ask_next()
+
+        shares_map = {}
+        failures = []
+        while len(pending) > 0:
+            timeout = None
+            if len(unasked) > 0 and len(deadlines) > 0:
+                timeout = max(0, min(deadlines.values()) - time.time())
+            done, _ = wait(pending, timeout, FIRST_COMPLETED)
+
+            if len(done) == 0:
+                # the most overdue fetch is late; hedge it with a request to the next provider
+                del deadlines[min(deadlines, key=deadlines.get)]
+                ask_next()
+                continue
+
+            for future in done:
+                pending.remove(future)
+                deadlines.pop(future, None)
+                share, failure = self._check_share(future, providers_map[future], digest_key, digests)
+                if failure is None:
+                    shares_map[share] = providers_map[future]
+                    continue
+                failures.append(failure)
+                if len(unasked) > 0:
+                    ask_next()
+
+            if len(shares_map) < self.file_reconstruction_threshold:
+                continue
+
+            # verified shares all come from the same upload, so this should only fail on a bad key
+            data, bad_shares = self._recover(shares_map.keys(), key)
+            if data is None or len(bad_shares) > 0:
+                # fall back to fetching everything
+                while len(unasked) > 0:
+                    ask_next()
+                wait(pending)
+                for future in pending:
+                    share, failure = self._check_share(future, providers_map[future], digest_key, digests)
+                    if failure is None:
+                        shares_map[share] = providers_map[future]
+                    else:
+                        failures.append(failure)
+                break
+
+            for straggler in pending:
+                straggler.add_done_callback(report_straggler)
+
+            if len(failures) > 0:
+                raise exceptions.OperationFailure(failures, data)
+            return data
+
+        # we couldn't return early; use everything we got
+        return self._finish_get(shares_map, failures, key)
+
     def delete(self, filename):
-        def delete_share(provider):
-            provider.delete(filename)
-        args = map(lambda provider: [provider], self.providers)
-        failures = run_parallel(delete_share, args)
+        futures = [provider.delete_async(filename) for provider in self.providers]
+        failures = wait_for_failures(futures)
 
         if len(failures) > 0:
             raise exceptions.FatalOperationFailure(failures)
+
+    @staticmethod
+    def _chunk_name(filename, index):
+        return filename + "-" + str(index)
+
+    @staticmethod
+    def _chunk_key(key, index):
+        # binding each stripe to its own key means that stripes can't be reordered
+        return encryption.derive_key(key, "chunk-" + str(index))
+
+    def put_stream(self, filename, stream, key=None, chunk_size=None, quorum=False):
+        """
+        Distribute the contents of a stream as a series of fixed-size stripes,
+        each encrypted, shared and uploaded separately. Stripes are processed in
+        a pipeline, so only a few stripes are held in memory at once.
+        Args:
+            filename: string
+            stream: a file-like object to read from
+            key: an optional key used to encrypt
+            chunk_size: an optional stripe size, defaults to CHUNK_SIZE
+            quorum: whether each stripe's put returns once write_quorum providers have stored it (see put)
+        Returns:
+            (key, size)
+            key: bytestring of the key used for encryption
+            size: the number of bytes read from the stream
+        Raises:
+            FatalOperationFailure if any provider failed, after deleting the
+                stripes that were stored
+        """
+        if key is None:
+            key = encryption.generate_key()
+        if chunk_size is None:
+            chunk_size = self.CHUNK_SIZE
+
+        def upload_chunk(index, data):
+            try:
+                self.put(self._chunk_name(filename, index), data, self._chunk_key(key, index), quorum)
+            except exceptions.FatalOperationFailure as e:
+                return e.failures
+            return []
+
+        failures = []
+        size = 0
+        in_flight = deque()
+        index = 0
+        while len(failures) == 0:
+            data = stream.read(chunk_size)
+            if len(data) == 0:
+                break
+            size += len(data)
+            in_flight.append(submit_task(upload_chunk, index, data))
+            index += 1
+            # bound the number of stripes held in memory
+            while len(in_flight) > self.PIPELINE_DEPTH:
+                failures += in_flight.popleft().result()
+
+        while len(in_flight) > 0:
+            failures += in_flight.popleft().result()
+
+        if len(failures) > 0:
+            # the stripes that were stored are garbage now
+            try:
+                self.delete_stream(filename, index)
+            except exceptions.FatalOperationFailure:
+                # this isn't reported - we just have some extra garbage floating around
+                pass
+            # don't double-penalize providers that failed on several stripes
+            raise exceptions.FatalOperationFailure(list(set(failures)))
+
+        return key, size
+
+    def get_stream(self, filename, key, out, num_chunks):
+        """
+        Recover a file distributed by put_stream, writing it stripe by stripe to
+        a stream. Stripes are fetched ahead in a pipeline.
+        Args:
+            filename: string
+            key: bytestring
+            out: a file-like object to write to
+            num_chunks: the number of stripes in the file
+        Raises:
+            OperationFailure with None result if any provider failed, after the
+                whole file was written
+            FatalOperationFailure if some stripe was unrecoverable (the stream
+                may have been partially written)
+        """
+        def get_chunk(index):
+            try:
+                return self.get(self._chunk_name(filename, index), self._chunk_key(key, index)), []
+            except exceptions.OperationFailure as e:
+                return e.result, e.failures
+
+        failures = []
+        in_flight = deque()
+        try:
+            for index in xrange(num_chunks):
+                in_flight.append(submit_task(get_chunk, index))
+                # write out the oldest stripe once the read-ahead window is full
+                if len(in_flight) > self.PIPELINE_DEPTH:
+                    data, chunk_failures = in_flight.popleft().result()
+                    out.write(data)
+                    failures += chunk_failures
+
+            while len(in_flight) > 0:
+                data, chunk_failures = in_flight.popleft().result()
+                out.write(data)
+                failures += chunk_failures
+        except exceptions.FatalOperationFailure as e:
+            # don't bother fetching stripes we won't use, and wait for the rest so none outlive this call
+            for future in in_flight:
+                future.cancel()
+            wait_for_failures([future for future in in_flight if not future.cancelled()])
+            raise exceptions.FatalOperationFailure(list(set(failures + e.failures)), e.message)
+
+        if len(failures) > 0:
+            raise exceptions.OperationFailure(list(set(failures)), None)
+
+    def delete_stream(self, filename, num_chunks):
+        """
+        Delete all stripes of a file distributed by put_stream
+        Raises:
+            FatalOperationFailure if any provider failed
+        """
+        # start every deletion at once, rather than stripe by stripe
+        futures = [provider.delete_async(self._chunk_name(filename, index))
+                   for index in xrange(num_chunks) for provider in self.providers]
+
+        failures = wait_for_failures(futures)
+        if len(failures) > 0:
+            raise exceptions.FatalOperationFailure(list(set(failures)))
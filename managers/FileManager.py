@@ -3,8 +3,13 @@
 from custom_exceptions import exceptions
 from Distributor import FileDistributor
 from manifest import Manifest
-from tools.utils import generate_random_name, run_parallel
-# TODO cache the manifest intelligently
+from tools import chunking, encryption, tracing
+from tools.utils import generate_random_name, run_parallel, wait_for_failures, submit_task
+from concurrent.futures import wait, FIRST_COMPLETED
+from collections import deque
+from StringIO import StringIO
+import tempfile
+import threading
 
 
 class FileManager:
@@ -13,7 +18,21 @@ class FileManager:
     Detects errors in providers, and raises them as OperationFailure or FatalOperationFailure. Also detects missing providers.
     Does not attempt to do any recovery or repair of broken providers.
     """
-    def __init__(self, providers, num_providers, file_reconstruction_threshold, master_key, manifest_name, setup=False):
+    # the number of delta records written after a manifest snapshot before the next snapshot
+    COMPACTION_THRESHOLD = 64
+    # the most bytes of file contents a reset holds in memory at once
+    RESET_MEMORY_BUDGET = 256 * 1024 * 1024
+    # the most files a reset copies at once
+    RESET_PARALLELISM = 8
+    # the number of files a reset copies between checkpoints of its progress
+    RESET_CHECKPOINT_INTERVAL = 16
+    # the most blocks of a deduplicated file uploaded or fetched ahead at once
+    BLOCK_PIPELINE_DEPTH = 4
+    # the number of bytes of a block id, a keyed digest of the block's contents
+    BLOCK_ID_SIZE = 16
+
+    def __init__(self, providers, num_providers, file_reconstruction_threshold, master_key, manifest_name, setup=False, early_return_reads=False,
+                 manifest_cache=None):
         """
         Create a FileManager
         Args:
@@ -23,12 +42,35 @@ class FileManager:
             master_key: the master key used to decrypt files
             manifest_name: the name of the manifest file on the providers
             setup: whether this FileManager should setup a new system (True) or load an existing one (False)
+            early_return_reads: whether file reads should decode as soon as enough verified shares arrive
+                instead of waiting for every provider (see FileDistributor.get)
+            manifest_cache: (optional) a ManifestCache; if given, the manifest is only downloaded
+                when its version on the providers differs from the cached copy
         """
         self.providers = providers
+        # map from uuid to every provider this FileManager has been given, including ones only used by pending layouts
+        self.known_providers = {}
+        self._remember_providers(providers)
         self.file_reconstruction_threshold = file_reconstruction_threshold
         self.master_key = master_key
         self.manifest_name = manifest_name
-        self.distributor = FileDistributor(providers, num_providers, file_reconstruction_threshold)
+        self.early_return_reads = early_return_reads
+        self.straggler_handler = None
+        self.read_planner = None
+        self.write_margin = None
+        self.repair_handler = None
+        self.deduplicate = False
+        # the ids of blocks some provider failed to return a valid share for, which are uploaded again when next put
+        self.damaged_blocks = set()
+        self.manifest_cache = manifest_cache
+        self.manifest = None
+        # the head of the manifest held in memory, and the number of delta records after its snapshot
+        # both are None if the manifest in memory might not match the providers
+        self.manifest_head = None
+        self.manifest_deltas = None
+        # the futures of the deletions of the delta records replaced by the latest snapshot
+        self.delta_cleanup = []
+        self.distributor = FileDistributor(providers, num_providers, file_reconstruction_threshold, early_return_reads)
 
         if setup:
             self.manifest = Manifest(self.providers)
@@ -37,24 +79,51 @@ class FileManager:
         # else:
         # self.load_manifest()
 
+    @tracing.traced("file_manager.load_manifest")
     def load_manifest(self, discard_extra_providers=False):
         """
         Loads the manifest into memory
+        Reads the manifest head from every provider, then only downloads the parts of the manifest
+        (the snapshot and/or delta records) that aren't already held in memory or in the manifest cache
+        Heads are authenticated, so a provider can't make one up, only hold an old one, e.g. when a head write
+        didn't reach every provider. So the manifest is loaded at the newest head whose records can be loaded,
+        and the providers holding any other head are reported as failures, for their heads to be rewritten
         Also compiles a list of missing providers for later use
         Args: If discard_extra_providers is True, will internally discard any providers not in the manifest
         Raises:
             OperationFailure with None result if any provider fails
             FatalOperationFailure if we couldn't load
         """
-        self.manifest = None
-        failures = None
-        try:
-            manifest_str = self.distributor.get(self.manifest_name, self.master_key)
-        except exceptions.OperationFailure as e:
-            manifest_str = e.result
-            failures = e.failures
+        heads, failures = self._probe_manifest_heads()
+        # if no head was found, this is probably a manifest from before heads were written
+        if heads is None:
+            failures = []
+        newest = self._newest_heads(heads)[0] if heads is not None else None
+
+        # changes left in the journal were never distributed, so the manifest in memory is unreliable
+        if newest is None or newest != self.manifest_head or self.manifest is None or len(self.manifest.journal) > 0:
+            self.manifest = None
+            self.manifest_head = None
+            self.manifest_deltas = None
+            if heads is None:
+                head = None
+                manifest, deltas, load_failures = self._load_manifest_at(None)
+            else:
+                head, manifest, deltas, load_failures = self._load_newest_manifest(heads)
+            failures += load_failures
+
+            self.manifest = manifest
+            if deltas is not None:
+                self.manifest_head = head
+                self.manifest_deltas = deltas
+        else:
+            head = newest
+
+        if heads is not None:
+            for other_head, holders in heads.items():
+                if other_head != head:
+                    failures += [exceptions.InvalidShareFailure(provider, "stale manifest head") for provider in holders]
 
-        self.manifest = Manifest.deserialize(manifest_str)
         providers_uuids = set(map(lambda provider: provider.uuid, self.providers))
         expected_providers = set(self.manifest.get_provider_strings())
         self.missing_providers = list(expected_providers - providers_uuids)
@@ -64,9 +133,255 @@ class FileManager:
             self.providers = filter(lambda provider: provider.uuid in expected_providers, self.providers)
             self.distributor.providers = self.providers[:]
 
-        if failures is not None:
+        if len(failures) > 0:
             raise exceptions.OperationFailure(failures, None)
 
+    def _load_newest_manifest(self, heads):
+        """
+        Load the manifest at the newest head whose records can all be loaded. A head is written alongside its
+        last delta record (see _distribute_delta), so the head before it is tried too, even if no provider holds it
+        Args: heads, a map from each authentic head to the providers holding it (see _probe_manifest_heads)
+        Returns (head, manifest, deltas, failures), as for _load_manifest_at
+        Raises FatalOperationFailure if the manifest can't be loaded at any of the heads
+        """
+        candidates = set(heads)
+        for head in heads:
+            generation, deltas = self._parse_head(head)
+            if deltas > 0:
+                candidates.add(self._make_head(generation, deltas - 1))
+
+        failures = []
+        for head in self._newest_heads(candidates):
+            try:
+                return (head,) + self._load_manifest_at(head)
+            except exceptions.FatalOperationFailure as e:
+                failures += e.failures
+        if len(failures) == 0:
+            # no provider is known to have failed, so blame the providers holding the heads
+            failures = [exceptions.InvalidShareFailure(provider, "manifest head refers to missing records")
+                        for holders in heads.values() for provider in holders]
+        raise exceptions.FatalOperationFailure(failures, "the manifest can't be loaded at any head")
+
+    def _load_manifest_at(self, head):
+        """
+        Rebuild the manifest described by a head, from the manifest cache if possible
+        Args: head, the head read from the providers, or None if there was no agreed head
+        Returns (manifest, deltas, failures)
+            manifest: the loaded Manifest
+            deltas: the number of delta records in the manifest's generation, or None if
+                head doesn't describe the stored snapshot (so the next change must write a new snapshot)
+            failures: a list of ProviderFailures encountered while downloading
+        Raises FatalOperationFailure if a part of the manifest couldn't be downloaded
+        """
+        failures = []
+        generation, deltas = self._parse_head(head) if head is not None else (None, None)
+        manifest = None
+        applied = 0
+
+        if self.manifest_cache is not None and head is not None:
+            cached = self.manifest_cache.load(self.manifest_name, self.master_key)
+            cached_head = self._parse_head(cached[0]) if cached is not None else None
+            if cached_head is not None and cached_head[0] == generation and cached_head[1] <= deltas:
+                manifest = Manifest.deserialize(cached[1])
+                applied = cached_head[1]
+
+        if manifest is None:
+            try:
+                manifest_str = self.distributor.get(self.manifest_name, self.master_key)
+            except exceptions.OperationFailure as e:
+                manifest_str = e.result
+                failures += e.failures
+            manifest = Manifest.deserialize(manifest_str)
+
+            if manifest.generation != generation:
+                # the head doesn't describe this snapshot, so its deltas don't apply to it
+                return manifest, None, failures
+
+        # map from delta index to serialized delta record
+        delta_strs = {}
+
+        def get_delta(index):
+            try:
+                delta_strs[index] = self.distributor.get(self._delta_name(generation, index), self.master_key)
+            except exceptions.OperationFailure as e:
+                delta_strs[index] = e.result
+                raise
+        delta_failures = run_parallel(get_delta, map(lambda index: [index], xrange(applied, deltas)))
+        for failure in delta_failures:
+            if type(failure) is not exceptions.OperationFailure:
+                raise failure
+            failures += failure.failures
+
+        for index in xrange(applied, deltas):
+            manifest.apply_journal(delta_strs[index])
+
+        if self.manifest_cache is not None and applied < deltas:
+            self.manifest_cache.store(self.manifest_name, self.master_key, head, manifest.serialize())
+
+        return manifest, deltas, failures
+
+    def set_straggler_handler(self, straggler_handler):
+        """
+        Register a function to be called with (provider, failure) when a read returns early
+        without waiting for a provider, once that provider's share arrives.  failure is None
+        if the provider returned a valid share
+        """
+        self.straggler_handler = straggler_handler
+        self.distributor.straggler_handler = straggler_handler
+
+    def set_read_planner(self, read_planner):
+        """
+        Register a function that chooses the providers file reads fetch shares from (see FileDistributor),
+        or None to fetch shares from every provider
+        """
+        self.read_planner = read_planner
+        self.distributor.read_planner = read_planner
+
+    def set_write_margin(self, write_margin, repair_handler):
+        """
+        Make file writes return once write_margin more providers than the file reconstruction threshold have
+        stored their shares, passing uploads that fail afterwards to repair_handler (see FileDistributor);
+        write_margin None makes file writes wait for every provider. Manifest writes always wait for every provider
+        """
+        self.write_margin = write_margin
+        self.repair_handler = repair_handler
+        self.distributor.write_quorum = self._write_quorum(self.distributor.num_providers)
+        self.distributor.repair_handler = repair_handler
+
+    def set_deduplication(self, deduplicate):
+        """
+        Make put, put_many and put_stream split files into content-defined chunks (see tools.chunking) and store
+        each distinct chunk once, as a deduplicated block shared by every file containing it, if deduplicate is True
+        Only the blocks that aren't already stored are uploaded, so rewriting a file after a small edit or storing
+        a copy of a file uploads little. Files already stored are read as they were written either way
+        """
+        self.deduplicate = deduplicate
+
+    def _write_quorum(self, num_providers, file_reconstruction_threshold=None):
+        if self.write_margin is None:
+            return None
+        if file_reconstruction_threshold is None:
+            file_reconstruction_threshold = self.file_reconstruction_threshold
+        return min(file_reconstruction_threshold + self.write_margin, num_providers)
+
+    def _remember_providers(self, providers):
+        for provider in providers:
+            self.known_providers[provider.uuid] = provider
+
+    def _layout_distributor(self, layout_id):
+        """
+        Returns a distributor for the providers and threshold of a pending layout in the manifest
+        """
+        layout = self.manifest.layouts[layout_id]
+        providers = [self.known_providers[uuid] for uuid in layout["providers"] if uuid in self.known_providers]
+        num_providers = len(layout["providers"])
+        return FileDistributor(providers, num_providers, layout["threshold"], self.early_return_reads,
+                               self.straggler_handler, self.read_planner,
+                               self._write_quorum(num_providers, layout["threshold"]), self.repair_handler)
+
+    def _distributor_for(self, layout_id):
+        """
+        Returns the distributor for the layout a file or block was distributed with:
+        the id of a pending layout, or None for the manifest's providers
+        """
+        if layout_id is None:
+            return self.distributor
+        return self._layout_distributor(layout_id)
+
+    def _head_name(self):
+        """
+        Returns the name of the small object on each provider that records the current manifest
+        generation and number of delta records
+        """
+        return self.manifest_name + "-head"
+
+    def _delta_name(self, generation, index):
+        """
+        Returns the name of a delta record of the manifest
+        """
+        return "%s-%d-%d" % (self.manifest_name, generation, index)
+
+    def _head_key(self):
+        return encryption.derive_key(self.master_key, "manifest-head")
+
+    def _make_head(self, generation, deltas):
+        """
+        Returns an authenticated head for the given snapshot generation and number of delta records
+        """
+        head = "%d:%d" % (generation, deltas)
+        return head + encryption.keyed_digest(head, self._head_key())
+
+    def _parse_head(self, head):
+        """
+        Returns (generation, deltas) from a head made by _make_head, or None if it isn't authentic
+        """
+        payload, digest = head[:-encryption.DIGEST_SIZE], head[-encryption.DIGEST_SIZE:]
+        if not encryption.verify_digest(payload, digest, self._head_key()):
+            return None
+        generation, deltas = payload.split(":")
+        return int(generation), int(deltas)
+
+    def _probe_manifest_heads(self):
+        """
+        Read the manifest head from every provider
+        Returns (heads, failures)
+            heads: a map from each authentic head to the list of providers holding it, or None if no provider
+                has a head (the manifest is from before heads were written)
+            failures: a list of ProviderFailures for the providers that failed or hold a head that isn't authentic
+        Raises FatalOperationFailure if some provider has a head, but fewer than file_reconstruction_threshold
+            providers hold an authentic head
+        """
+        # the manifest is kept by the distributor's providers, which differ from self.providers during a reset
+        providers = self.distributor.providers
+        futures = [provider.get_async(self._head_name()) for provider in providers]
+        failures = wait_for_failures(futures)
+
+        heads = {}
+        found = False
+        for future, provider in zip(futures, providers):
+            if future.exception() is not None:
+                continue
+            found = True
+            if self._parse_head(future.result()) is None:
+                failures.append(exceptions.InvalidShareFailure(provider, "invalid manifest head"))
+            else:
+                heads.setdefault(future.result(), []).append(provider)
+
+        if not found:
+            return None, failures
+        if sum(len(holders) for holders in heads.values()) < self.distributor.file_reconstruction_threshold:
+            # too few providers are working for the manifest to be read
+            raise exceptions.FatalOperationFailure(failures, "too few providers hold an authentic manifest head")
+        return heads, failures
+
+    def _newest_heads(self, heads):
+        """
+        Returns the heads in heads, newest first
+        """
+        return sorted(heads, key=self._parse_head, reverse=True)
+
+    def _put_head(self, generation, deltas, record=None):
+        """
+        Write the manifest head to every provider
+        Args: record, (optional) the future of the upload of the delta record the head refers to, to wait for
+            along with the head
+        Raises FatalOperationFailure if any provider fails
+        """
+        head = self._make_head(generation, deltas)
+
+        futures = [provider.put_async(self._head_name(), head) for provider in self.distributor.providers]
+        failures = wait_for_failures(futures)
+        if record is not None:
+            for failure in wait_for_failures([record]):
+                if type(failure) is not exceptions.FatalOperationFailure:
+                    raise failure
+                failures += failure.failures
+        if len(failures) > 0:
+            raise exceptions.FatalOperationFailure(failures)
+
+        self.manifest_head = head
+        self.manifest_deltas = deltas
+
     def get_missing_providers(self):
         """
         Returns a list of unique identifier tuples for providers that are expected but missing
@@ -91,79 +406,213 @@ class FileManager:
 
         self.providers.append(missing_provider)
         self.distributor.providers.append(missing_provider)
+        self._remember_providers([missing_provider])
 
         return True
 
-    def distribute_manifest(self):
+    @tracing.traced("file_manager.distribute_manifest")
+    def distribute_manifest(self, snapshot=False):
+        """
+        Commit the changes made to the manifest since it was last distributed
+        The changes are appended as a small delta record, unless snapshot is True or COMPACTION_THRESHOLD
+        delta records have accumulated, in which case the whole manifest is written as a new snapshot
+        Raises FatalOperationFailure if any provider fails
+        """
+        journal = self.manifest.take_journal()
+
+        try:
+            if snapshot or self.manifest_deltas is None or self.manifest_deltas >= self.COMPACTION_THRESHOLD:
+                self._distribute_snapshot()
+            elif len(journal) > 0:
+                self._distribute_delta(journal)
+        except exceptions.FatalOperationFailure:
+            # the providers may now disagree with the manifest in memory, so reload it from scratch
+            self.manifest_head = None
+            self.manifest_deltas = None
+            if self.manifest_cache is not None:
+                self.manifest_cache.invalidate(self.manifest_name)
+            raise
+
+    def _distribute_snapshot(self):
         """
+        Write the whole manifest as a new generation, then garbage collect the delta records it replaces
         Raises FatalOperationFailure if any provider fails
         """
+        old_generation = self.manifest.generation
+        old_deltas = self.manifest_deltas
+
+        self.manifest.generation = old_generation + 1
         content = self.manifest.serialize()
+        tracing.current_span().set("snapshot_bytes", len(content))
         self.distributor.put(self.manifest_name, content, self.master_key)
+        self._put_head(self.manifest.generation, 0)
+
+        if self.manifest_cache is not None:
+            self.manifest_cache.store(self.manifest_name, self.master_key, self.manifest_head, content)
+
+        if old_deltas is not None:
+            # leftover delta records are just garbage, so their deletion isn't waited for, and failures are ignored
+            self.delta_cleanup = [provider.delete_async(self._delta_name(old_generation, index))
+                                  for index in xrange(old_deltas) for provider in self.distributor.providers]
+
+    def _distribute_delta(self, journal):
+        """
+        Append a delta record holding the given changes to the current generation
+        Raises FatalOperationFailure if any provider fails
+        """
+        # the record is written alongside the head that refers to it rather than before it, saving a round trip:
+        # if the record doesn't reach enough providers, load_manifest passes over the head for the one before
+        delta_str = Manifest.serialize_journal(journal)
+        tracing.current_span().set("delta_bytes", len(delta_str))
+        record = submit_task(self.distributor.put, self._delta_name(self.manifest.generation, self.manifest_deltas),
+                             delta_str, self.master_key)
+        self._put_head(self.manifest.generation, self.manifest_deltas + 1, record)
 
     def update_key_and_name(self, master_key, manifest_name):
+        if self.manifest_cache is not None:
+            self.manifest_cache.invalidate(self.manifest_name)
         self.master_key = master_key
         self.manifest_name = manifest_name
-        self.distribute_manifest()
+        # the delta records under the old name are left behind with the old snapshot
+        self.manifest_deltas = None
+        self.distribute_manifest(snapshot=True)
         # TODO make sure this doesnt go to infinite loop on repeated distributes
 
     def reset(self):
         """
-        Refresh all files on the filesystem by re-encrypting, sharing, and distributing all files and manifest
+        Redistribute every file across the current providers with the current file_reconstruction_threshold,
+        then switch the whole system over to them
         To be called after changing either providers or file_reconstruction_threshold
-        Constructs a new FileDistributor object with the new parameters
+        The new providers and threshold are recorded in the manifest as a pending layout, and files are copied to it
+        a few at a time, holding at most RESET_MEMORY_BUDGET bytes of file contents in memory. Every
+        RESET_CHECKPOINT_INTERVAL files, the copies are committed to the manifest and the shares they replace are
+        deleted, so only the files copied since the last checkpoint take up space twice. If a reset fails part way,
+        calling it again with the same providers and threshold, even after reloading, only copies the remaining files
+        Deduplicated blocks are copied the same way as files
         Will not report failures on the old set of providers; rather, will only throw errors for fatal operations with new providers
-        NB: during the operation, the amount of space used on each provider doubles
+        Raises FatalOperationFailure if some file couldn't be copied or the manifest couldn't be distributed
         """
-        old_files = []
+        self._remember_providers(self.providers)
+        provider_strings = [provider.uuid for provider in self.providers]
+        layout_id = self.manifest.find_layout(provider_strings, self.file_reconstruction_threshold)
+        if layout_id is None:
+            layout_id = generate_random_name()
+            self.manifest.add_layout(layout_id, provider_strings, self.file_reconstruction_threshold)
+        new_distributor = self._layout_distributor(layout_id)
 
-        # we use num_providers = len(providers) here, because we want to reprovision with all current providers
-        new_distributor = FileDistributor(self.providers, len(self.providers), self.file_reconstruction_threshold)
-
-        def duplicate_file(file_node):
-            try:
-                filename = file_node.name
-                old_codename = file_node.code_name
-                old_key = file_node.key
-                size = file_node.size
-            except AttributeError:
-                # this is a directory
-                return
+        def copy_file(file_node):
+            source = self._distributor_for(file_node.layout)
+            codename = generate_random_name()
+            if file_node.chunk_size is None:
+                try:
+                    data = source.get(file_node.code_name, file_node.key, file_node.digests)
+                except exceptions.OperationFailure as e:
+                    # don't penalize for operations on the old distributor
+                    data = e.result
+                key, digests = new_distributor.put_with_digests(codename, data)
+            else:
+                # spool chunked files through disk rather than memory
+                with tempfile.TemporaryFile() as spool:
+                    try:
+                        source.get_stream(file_node.code_name, file_node.key, spool, file_node.num_chunks)
+                    except exceptions.OperationFailure:
+                        # don't penalize for operations on the old distributor
+                        pass
+                    spool.seek(0)
+                    key, _ = new_distributor.put_stream(codename, spool, chunk_size=file_node.chunk_size)
+                # stripes rely on their in-band share tags
+                digests = None
+            return codename, key, digests
 
+        def copy_block(block):
             try:
-                data = self.distributor.get(old_codename, old_key)
+                data = self._distributor_for(block.get("layout")).get(block["code_name"], block["key"], block["digests"])
             except exceptions.OperationFailure as e:
                 # don't penalize for operations on the old distributor
                 data = e.result
+            codename = generate_random_name()
+            key, digests = new_distributor.put_with_digests(codename, data)
+            return codename, key, digests
 
-            old_files.append(old_codename)
+        # the file nodes and block entries replaced since the last checkpoint
+        replaced = []
 
-            codename = generate_random_name()
-            key = new_distributor.put(codename, data)
-            # TODO this changes the manifest without being sure that distributor changes will work
-            # change this when implementing manifest caching
-            self.manifest.update_file(filename, codename, size, key)
+        def checkpoint():
+            # the copies must be committed before the shares they replace are deleted
+            self.distribute_manifest()
+
+            def delete_replaced(item):
+                if type(item) is dict:
+                    self._delete_block_shares(item)
+                else:
+                    self._delete_file_shares(self._distributor_for(item.layout), item)
+            # leftover shares are just garbage, so ignore failures
+            run_parallel(delete_replaced, map(lambda item: [item], replaced))
+            del replaced[:]
+
+        # the files with their own shares and the deduplicated blocks left to copy, as (path or block id, node or
+        # block entry) pairs
+        remaining = deque((path, node) for path, node in self.manifest.generate_nodes_under("")
+                          if hasattr(node, "code_name") and node.blocks is None and node.layout != layout_id)
+        remaining.extend((block_id, block) for block_id, block in self.manifest.blocks.items()
+                         if block.get("layout") != layout_id)
+        # map from each copy in progress to (path or block id, node or block entry, memory cost)
+        in_flight = {}
+        memory_used = 0
+        failures = []
+        try:
+            while len(remaining) > 0 or len(in_flight) > 0:
+                # start as many copies as the limits allow; a file too big for the memory budget is copied alone
+                while len(remaining) > 0 and len(in_flight) < self.RESET_PARALLELISM:
+                    path, node = remaining[0]
+                    is_block = type(node) is dict
+                    cost = node["size"] if is_block else self._copy_cost(node)
+                    if len(in_flight) > 0 and memory_used + cost > self.RESET_MEMORY_BUDGET:
+                        break
+                    remaining.popleft()
+                    in_flight[submit_task(copy_block if is_block else copy_file, node)] = (path, node, cost)
+                    memory_used += cost
 
-        dup_failures = run_parallel(duplicate_file, map(lambda (path, node): [node], self.manifest.generate_nodes_under("")))
+                done, _ = wait(in_flight.keys(), return_when=FIRST_COMPLETED)
+                for future in done:
+                    path, node, cost = in_flight.pop(future)
+                    memory_used -= cost
+                    try:
+                        codename, key, digests = future.result()
+                    except exceptions.FatalOperationFailure as e:
+                        # keep copying the other files, so a retry has less to do
+                        failures += e.failures
+                        continue
+                    if type(node) is dict:
+                        self.manifest.store_block(path, codename, key, node["size"], digests, layout_id)
+                    else:
+                        self.manifest.update_file(path, codename, node.size, key, node.chunk_size, digests, layout_id)
+                    replaced.append(node)
 
-        # combine all FatalOperation failures together
-        failures = [failure for fatal_failure in dup_failures for failure in fatal_failure.failures]
+                if len(replaced) >= self.RESET_CHECKPOINT_INTERVAL:
+                    checkpoint()
+        finally:
+            # don't leave copies running if a checkpoint failed
+            wait(in_flight.keys())
 
+        if len(replaced) > 0:
+            checkpoint()
         if len(failures) > 0:
             raise exceptions.FatalOperationFailure(failures)
 
-        old_distributor = self.distributor
+        # every file has been copied, so switch over to the new layout
+        self.manifest.adopt_layout(layout_id)
         self.distributor = new_distributor
+        self.distribute_manifest(snapshot=True)
 
-        self.manifest.set_providers(self.providers)
-        self.distribute_manifest()
-
-        # TODO doing this step at the end means that we double in size
-        # garbage collect
-        def delete_codename(codename):
-            old_distributor.delete(codename)
-
-        run_parallel(delete_codename, map(lambda codename: [codename], old_files))
+    def _copy_cost(self, file_node):
+        """
+        Returns roughly the most bytes of a file's contents that copying it holds in memory
+        """
+        if file_node.chunk_size is None:
+            return file_node.size
+        # chunked files are spooled through disk, a few stripes at a time in each direction
+        return min(file_node.size, 2 * file_node.chunk_size * (self.distributor.PIPELINE_DEPTH + 1))
 
     def path_generator(self):
         """
@@ -172,6 +621,50 @@ class FileManager:
         for node_path, _ in self.manifest.generate_nodes_under(""):
             yield node_path
 
+    def versions(self, paths=None):
+        """
+        Find the versions of files: a file's code name changes every time it is
+        written, and stays the same when it is moved.
+        Args:
+            paths: (optional) the paths to find the versions of; every file and
+                directory in the system by default
+        Returns: a map from each path that exists to the code name of the file
+                 at that path, or to None if it is a directory
+        """
+        def version_of(node):
+            try:
+                return node.code_name
+            except AttributeError:
+                # The node is a directory
+                return None
+
+        if paths is None:
+            return {node_path: version_of(node) for node_path, node in self.manifest.generate_nodes_under("")}
+        versions = {}
+        for path in paths:
+            try:
+                versions[path] = version_of(self.manifest.get(path))
+            except exceptions.InvalidPath:
+                pass
+        return versions
+
+    def holds_share(self, share_name):
+        """
+        Returns True if share_name names shares the manifest still refers to: those of a file, of a stripe of a
+        chunked file, or of a deduplicated block. The shares of a file that was overwritten, deleted or copied
+        by a reset are no longer referred to
+        """
+        if self.manifest is None:
+            return False
+        for _, node in self.manifest.generate_nodes_under(""):
+            if not hasattr(node, "code_name") or node.blocks is not None:
+                continue
+            if node.code_name == share_name:
+                return True
+            if node.chunk_size is not None and share_name.startswith(node.code_name + "-"):
+                return True
+        return any(block["code_name"] == share_name for block in self.manifest.blocks.values())
+
     def ls(self, path):
         """
         Lists information about the entries at the given path.  If the given
@@ -224,28 +717,291 @@ class FileManager:
         if len(self.missing_providers) > 0:
             raise exceptions.ReadOnlyMode
 
-    def put(self, name, data):
+    @staticmethod
+    def _delete_file_shares(distributor, file_node):
         """
-        Raises ReadOnlyMode if the system is in read only mode (there are some missing providers)
-        Raises FatalOperationFailure (from distributer.put) if any provider operation throws an exception
+        Delete the shares of a file, whether or not it was chunked
+        Raises FatalOperationFailure (from distributor) if any provider operation throws an exception
         """
-        self._check_read_only()
+        if file_node.blocks is not None:
+            # a deduplicated file has no shares of its own; its blocks are deleted once no file refers to them
+            return
+        if file_node.chunk_size is None:
+            distributor.delete(file_node.code_name)
+        else:
+            distributor.delete_stream(file_node.code_name, file_node.num_chunks)
 
-        codename = generate_random_name()
-        key = self.distributor.put(codename, data)
+    def _delete_block_shares(self, block):
+        """
+        Delete the shares of a deduplicated block, given its manifest entry
+        Raises FatalOperationFailure (from distributor) if any provider operation throws an exception
+        """
+        self._distributor_for(block.get("layout")).delete(block["code_name"])
+
+    def _delete_blocks(self, blocks):
+        """
+        Delete the shares of deduplicated blocks, given their manifest entries
+        Returns a list of ProviderFailures for the providers that failed to delete some share
+        """
+        delete_failures = run_parallel(self._delete_block_shares, map(lambda block: [block], blocks))
+        return [failure for fatal_failure in delete_failures for failure in fatal_failure.failures]
 
-        old_node = self.manifest.update_file(name, codename, len(data), key)
+    def _replace_file(self, name, codename, size, key, chunk_size=None, digests=None):
+        """
+        Point name at a newly distributed file, then garbage collect the file it replaced (if any)
+        Raises FatalOperationFailure (from distribute_manifest) if any provider operation throws an exception
+        Raises OperationFailure if the old file could not be deleted
+        """
+        old_node = self.manifest.update_file(name, codename, size, key, chunk_size, digests)
+        garbage_blocks = self.manifest.drop_unreferenced_blocks()
 
         # update the manifest
         self.distribute_manifest()
 
+        failures = self._delete_blocks(garbage_blocks)
         # we are performing a replacement
         if old_node is not None:
             try:
-                self.distributor.delete(old_node.code_name)
+                self._delete_file_shares(self._distributor_for(old_node.layout), old_node)
             except exceptions.FatalOperationFailure as e:
-                # this isn't actually fatal - we just have some extra garbage floating around
-                raise exceptions.OperationFailure(e.failures, None)
+                failures += e.failures
+        if len(failures) > 0:
+            # this isn't actually fatal - we just have some extra garbage floating around
+            raise exceptions.OperationFailure(failures, None)
+
+    def _upload_blocks(self, stream, uploads, uploads_lock):
+        """
+        Split a file into content-defined chunks, and start uploading the ones that aren't stored as blocks yet
+        A few uploads of the file are in flight at a time, so at most BLOCK_PIPELINE_DEPTH blocks of it are held
+        in memory beyond the chunk being read
+        Args:
+            stream: a file-like object holding the file's contents
+            uploads: a dict from block id to the future of the upload of that block, shared by the files being put
+                together, so that a block they have in common is uploaded once
+            uploads_lock: a lock guarding uploads
+        Returns (block_ids, size), the ids of the file's blocks in order and the file's size
+        """
+        def upload_block(data):
+            codename = generate_random_name()
+            # block shares are never overwritten, so they can be acknowledged at a quorum
+            key, digests = self.distributor.put_with_digests(codename, data, quorum=True)
+            return codename, key, len(data), digests
+
+        block_ids = []
+        size = 0
+        in_flight = deque()
+        for data in chunking.chunk_stream(stream):
+            block_id = encryption.keyed_digest(data, self.manifest.block_id_key)[:self.BLOCK_ID_SIZE].encode("hex")
+            block_ids.append(block_id)
+            size += len(data)
+
+            with uploads_lock:
+                stored = self.manifest.get_block(block_id) is not None and block_id not in self.damaged_blocks
+                if stored or block_id in uploads:
+                    continue
+                # claim the block, so no other file uploads it too
+                uploads[block_id] = None
+            future = uploads[block_id] = submit_task(upload_block, data)
+
+            in_flight.append(future)
+            if len(in_flight) > self.BLOCK_PIPELINE_DEPTH:
+                wait([in_flight.popleft()])
+        return block_ids, size
+
+    def _put_deduplicated(self, files):
+        """
+        Put files as deduplicated blocks, uploading only the blocks that aren't stored yet,
+        and commit all of their manifest updates in a single distribute_manifest
+        Args: files, a list of (name, stream) pairs; if a name appears more than once, the last one wins
+        Raises InvalidPath (from manifest.update_file) if any name conflicts with a directory; no files are put
+        Raises FatalOperationFailure if any provider operation throws an exception while distributing
+            the blocks or the manifest; if the blocks couldn't be distributed, no files are put
+        Raises OperationFailure if some garbage blocks or replaced files could not be deleted
+        """
+        if self.manifest.block_id_key is None:
+            self.manifest.set_block_id_key(encryption.generate_key())
+
+        # map from block id to the future of its upload
+        uploads = {}
+        uploads_lock = threading.Lock()
+        # the (block_ids, size) of each file, in the order of files
+        results = [None] * len(files)
+
+        def upload(index, stream):
+            results[index] = self._upload_blocks(stream, uploads, uploads_lock)
+
+        def delete_uploads():
+            uploaded = [future.result() for future in uploads.values() if future.exception() is None]
+            self._delete_blocks(map(lambda (codename, key, size, digests): {"code_name": codename}, uploaded))
+
+        failures = run_parallel(upload, map(lambda (index, (name, stream)): [index, stream], enumerate(files)))
+        wait(uploads.values())
+        failures += [future.exception() for future in uploads.values() if future.exception() is not None]
+        if len(failures) > 0:
+            delete_uploads()
+            for failure in failures:
+                if type(failure) is not exceptions.FatalOperationFailure:
+                    raise failure
+            raise exceptions.FatalOperationFailure([failure for fatal_failure in failures for failure in fatal_failure.failures])
+
+        # blocks that were uploaded again because they were damaged replace their old copies
+        garbage_blocks = []
+        for block_id, future in uploads.items():
+            old_block = self.manifest.store_block(block_id, *future.result())
+            if old_block is not None:
+                garbage_blocks.append(old_block)
+            self.damaged_blocks.discard(block_id)
+
+        def unchanged(name, block_ids):
+            try:
+                return getattr(self.manifest.get(name), "blocks", None) == block_ids
+            except exceptions.InvalidPath:
+                return False
+
+        old_nodes = []
+        try:
+            for (name, _), (block_ids, size) in zip(files, results):
+                if unchanged(name, block_ids):
+                    # the stored version has the same contents, so there's nothing to change
+                    continue
+                old_node = self.manifest.update_file(name, generate_random_name(), size, None, blocks=block_ids)
+                if old_node is not None:
+                    old_nodes.append(old_node)
+        except exceptions.InvalidPath:
+            # the manifest in memory now holds some of the files, so it must be reloaded
+            self.manifest_head = None
+            delete_uploads()
+            raise
+        garbage_blocks += self.manifest.drop_unreferenced_blocks()
+
+        self.distribute_manifest()
+
+        # garbage collect the replaced files and the blocks no file refers to any more
+        delete_failures = self._delete_blocks(garbage_blocks)
+
+        def delete_old_node(node):
+            self._delete_file_shares(self._distributor_for(node.layout), node)
+        for fatal_failure in run_parallel(delete_old_node, map(lambda node: [node], old_nodes)):
+            delete_failures += fatal_failure.failures
+        if len(delete_failures) > 0:
+            # this isn't actually fatal - we just have some extra garbage floating around
+            raise exceptions.OperationFailure(delete_failures, None)
+
+    def put(self, name, data):
+        """
+        Raises ReadOnlyMode if the system is in read only mode (there are some missing providers)
+        Raises FatalOperationFailure (from distributer.put) if any provider operation throws an exception
+        """
+        self._check_read_only()
+
+        if self.deduplicate:
+            self._put_deduplicated([(name, StringIO(data))])
+            return
+
+        codename = generate_random_name()
+        # file shares are never overwritten, so they can be acknowledged at a quorum
+        key, digests = self.distributor.put_with_digests(codename, data, quorum=True)
+
+        self._replace_file(name, codename, len(data), key, digests=digests)
+
+    def put_many(self, files):
+        """
+        Put several files, uploading them in parallel and committing all of their manifest updates
+        in a single distribute_manifest
+        Args: files, a list of (name, data) pairs; if a name appears more than once, the last one wins
+        Raises ReadOnlyMode if the system is in read only mode (there are some missing providers)
+        Raises InvalidPath (from manifest.update_file) if any name conflicts with a directory; no files are put
+        Raises FatalOperationFailure if any provider operation throws an exception while distributing
+            the files or the manifest; if the files couldn't be distributed, no files are put
+        Raises OperationFailure if some replaced files could not be deleted
+        """
+        self._check_read_only()
+
+        if self.deduplicate:
+            self._put_deduplicated(map(lambda (name, data): (name, StringIO(data)), files))
+            return
+
+        # the (codename, key, digests) of each uploaded file, in the order of files
+        uploads = [None] * len(files)
+
+        def upload(index, data):
+            codename = generate_random_name()
+            key, digests = self.distributor.put_with_digests(codename, data, quorum=True)
+            uploads[index] = (codename, key, digests)
+
+        def delete_uploads():
+            def delete_upload(upload):
+                self.distributor.delete(upload[0])
+            run_parallel(delete_upload, map(lambda upload: [upload], filter(None, uploads)))
+
+        upload_failures = run_parallel(upload, map(lambda (index, (name, data)): [index, data], enumerate(files)))
+        if len(upload_failures) > 0:
+            delete_uploads()
+            for failure in upload_failures:
+                if type(failure) is not exceptions.FatalOperationFailure:
+                    raise failure
+            raise exceptions.FatalOperationFailure([failure for fatal_failure in upload_failures for failure in fatal_failure.failures])
+
+        old_nodes = []
+        try:
+            for (name, data), (codename, key, digests) in zip(files, uploads):
+                old_node = self.manifest.update_file(name, codename, len(data), key, digests=digests)
+                if old_node is not None:
+                    old_nodes.append(old_node)
+        except exceptions.InvalidPath:
+            # the manifest in memory now holds some of the files, so it must be reloaded
+            self.manifest_head = None
+            delete_uploads()
+            raise
+        garbage_blocks = self.manifest.drop_unreferenced_blocks()
+
+        self.distribute_manifest()
+
+        # garbage collect the replaced files and the blocks no file refers to any more
+        delete_failures = self._delete_blocks(garbage_blocks)
+
+        def delete_old_node(node):
+            self._delete_file_shares(self._distributor_for(node.layout), node)
+        for fatal_failure in run_parallel(delete_old_node, map(lambda node: [node], old_nodes)):
+            delete_failures += fatal_failure.failures
+        if len(delete_failures) > 0:
+            # this isn't actually fatal - we just have some extra garbage floating around
+            raise exceptions.OperationFailure(delete_failures, None)
+
+    def put_stream(self, name, stream):
+        """
+        Put the contents of a file-like object, distributing it in fixed-size
+        chunks (or deduplicated blocks) so that the whole file is never held in memory
+        Raises ReadOnlyMode if the system is in read only mode (there are some missing providers)
+        Raises FatalOperationFailure (from distributer.put_stream) if any provider operation throws an exception
+        """
+        self._check_read_only()
+
+        if self.deduplicate:
+            self._put_deduplicated([(name, stream)])
+            return
+
+        codename = generate_random_name()
+        chunk_size = self.distributor.CHUNK_SIZE
+        key, size = self.distributor.put_stream(codename, stream, chunk_size=chunk_size, quorum=True)
+
+        self._replace_file(name, codename, size, key, chunk_size)
+
+    def put_delta(self, name, stream):
+        """
+        Put a new version of a file from a file-like object, uploading only what changed
+        The file is stored as deduplicated blocks whether or not deduplication is enabled (see set_deduplication),
+        so only the blocks that aren't already stored, e.g. as part of the file's previous version, are encrypted
+        and uploaded. If the file is already stored as the same blocks, nothing is uploaded and the manifest is
+        left unchanged
+        Raises ReadOnlyMode if the system is in read only mode (there are some missing providers)
+        Raises InvalidPath (from manifest.update_file) if name is a directory
+        Raises FatalOperationFailure if any provider operation throws an exception
+        Raises OperationFailure if the blocks of the replaced version could not be deleted
+        """
+        self._check_read_only()
+
+        self._put_deduplicated([(name, stream)])
 
     def mk_dir(self, path):
         """
@@ -271,27 +1027,119 @@ class FileManager:
         self.manifest.move(old_path, new_path)
         self.distribute_manifest()
 
-    def get(self, name):
+    def _get_file_node(self, name):
         """
-        attempt to get a file
-        Returns file contents
+        Returns the File node at name
         Raises FileNotFound if file does not exist
-        Raises OperationFailure with errors and file contents if recoverable (from distributor.get)
-        Raises FatalOperationFailure if unrecoverable (from distributor.get)
         """
         try:
             node = self.manifest.get(name)
         except exceptions.InvalidPath:
             raise exceptions.FileNotFound
 
-        try:
-            codename = node.code_name
-        except AttributeError:
+        if not hasattr(node, "code_name"):
             # This was a directory
             raise exceptions.FileNotFound
-        key = node.key
 
-        return self.distributor.get(codename, key)
+        return node
+
+    def get_code_name(self, name):
+        """
+        Returns the code name of a file's shares, which changes whenever the file is rewritten
+        Raises FileNotFound if file does not exist
+        """
+        return self._get_file_node(name).code_name
+
+    def _get_blocks(self, file_node, out):
+        """
+        Write the contents of a deduplicated file to a file-like object, fetching a few blocks ahead in a pipeline
+        Blocks that some provider failed to return a valid share for are uploaded again the next time a file
+        containing them is put, so a repair restores them
+        Raises OperationFailure with None result if any provider failed, after the whole file was written
+        Raises FatalOperationFailure if some block was unrecoverable (the file may have been partially written)
+        """
+        def get_block(block_id, block):
+            distributor = self._distributor_for(block.get("layout"))
+            try:
+                return distributor.get(block["code_name"], block["key"], block["digests"]), []
+            except exceptions.OperationFailure as e:
+                self.damaged_blocks.add(block_id)
+                return e.result, e.failures
+
+        blocks = [(block_id, self.manifest.get_block(block_id)) for block_id in file_node.blocks]
+        failures = []
+        in_flight = deque()
+        try:
+            for block_id, block in blocks:
+                in_flight.append(submit_task(get_block, block_id, block))
+                # write out the oldest block once the read-ahead window is full
+                if len(in_flight) > self.BLOCK_PIPELINE_DEPTH:
+                    data, block_failures = in_flight.popleft().result()
+                    out.write(data)
+                    failures += block_failures
+
+            while len(in_flight) > 0:
+                data, block_failures = in_flight.popleft().result()
+                out.write(data)
+                failures += block_failures
+        except exceptions.FatalOperationFailure as e:
+            # don't bother fetching blocks we won't use, and wait for the rest so none outlive this call
+            for future in in_flight:
+                future.cancel()
+            wait_for_failures([future for future in in_flight if not future.cancelled()])
+            raise exceptions.FatalOperationFailure(list(set(failures + e.failures)), e.message)
+
+        if len(failures) > 0:
+            raise exceptions.OperationFailure(list(set(failures)), None)
+
+    def get(self, name):
+        """
+        attempt to get a file
+        Returns file contents
+        Raises FileNotFound if file does not exist
+        Raises OperationFailure with errors and file contents if recoverable (from distributor.get)
+        Raises FatalOperationFailure if unrecoverable (from distributor.get)
+        """
+        node = self._get_file_node(name)
+        distributor = self._distributor_for(node.layout)
+
+        if node.chunk_size is None and node.blocks is None:
+            return distributor.get(node.code_name, node.key, node.digests)
+
+        out = StringIO()
+        try:
+            if node.blocks is not None:
+                self._get_blocks(node, out)
+            else:
+                distributor.get_stream(node.code_name, node.key, out, node.num_chunks)
+        except exceptions.OperationFailure as e:
+            raise exceptions.OperationFailure(e.failures, out.getvalue())
+        return out.getvalue()
+
+    def get_stream(self, name, out):
+        """
+        attempt to get a file, writing its contents to a file-like object
+        Chunked and deduplicated files are written a stripe or block at a time, so the whole file is never held in memory
+        Raises FileNotFound if file does not exist
+        Raises OperationFailure with errors and None result if recoverable (the file was fully written)
+        Raises FatalOperationFailure if unrecoverable (the file may have been partially written)
+        """
+        node = self._get_file_node(name)
+        distributor = self._distributor_for(node.layout)
+
+        if node.blocks is not None:
+            self._get_blocks(node, out)
+            return
+
+        if node.chunk_size is not None:
+            distributor.get_stream(node.code_name, node.key, out, node.num_chunks)
+            return
+
+        try:
+            out.write(distributor.get(node.code_name, node.key, node.digests))
+        except exceptions.OperationFailure as e:
+            out.write(e.result)
+            raise exceptions.OperationFailure(e.failures, None)
 
     def delete(self, name):
         """
@@ -304,6 +1152,7 @@ class FileManager:
         self._check_read_only()
 
         node = self.manifest.remove(name)
+        garbage_blocks = self.manifest.drop_unreferenced_blocks()
 
         try:
             self.distribute_manifest()
@@ -313,11 +1162,14 @@ class FileManager:
             # and then distribute it (handle when implementing caching)
             raise
 
+        failures = self._delete_blocks(garbage_blocks)
         try:
-            self.distributor.delete(node.code_name)
+            self._delete_file_shares(self._distributor_for(node.layout), node)
         except AttributeError:
             # We assumed node was a file, but it's actually a directory.
             pass
         except exceptions.FatalOperationFailure as e:
+            failures += e.failures
+        if len(failures) > 0:
             # some provider deletes failed, but it wasn't fatal
-            raise exceptions.OperationFailure(e.failures, None)
+            raise exceptions.OperationFailure(failures, None)
@@ -0,0 +1,131 @@
+import os
+import struct
+import tempfile
+import threading
+from appdirs import user_cache_dir
+from custom_exceptions import exceptions
+from tools import encryption
+from tools.utils import APP_NAME
+
+
+class ManifestCache:
+    """
+    A local copy of the most recently seen manifest, kept in memory and on disk.
+    Entries are encrypted under the master key and stored with the version of the manifest they hold,
+    so a client only needs to download the full manifest when the version on the providers has changed.
+    """
+    # the length prefix of the version in a cache entry
+    VERSION_HEADER = struct.Struct("!I")
+
+    def __init__(self, cache_dir=None, instance=None):
+        """
+        Create a ManifestCache
+        Args:
+            cache_dir: (optional) the directory in which to store cached manifests;
+                defaults to the user's cache directory
+            instance: (optional) a name for the installation whose manifests are cached. Each instance's
+                manifests are kept in a directory of their own under cache_dir, so clearing one instance's
+                entries leaves those of other instances sharing cache_dir alone
+        """
+        if cache_dir is None:
+            cache_dir = user_cache_dir(APP_NAME)
+        self.root_dir = cache_dir
+        self.cache_dir = cache_dir if instance is None else os.path.join(cache_dir, instance)
+        # map from manifest name to (version, content)
+        self.entries = {}
+        self.lock = threading.RLock()
+
+    def for_instance(self, instance):
+        """
+        Returns a ManifestCache for the named instance, kept in the same directory as this one
+        """
+        return ManifestCache(self.root_dir, instance)
+
+    def _path(self, manifest_name):
+        return os.path.join(self.cache_dir, manifest_name)
+
+    @staticmethod
+    def _cache_key(master_key):
+        return encryption.derive_key(master_key, "manifest-cache")
+
+    def load(self, manifest_name, master_key):
+        """
+        Args:
+            manifest_name: the name of the manifest on the providers
+            master_key: the master key the manifest is encrypted with
+        Returns:
+            (version, content) for the cached manifest, or None if there is no usable entry
+        """
+        with self.lock:
+            if manifest_name in self.entries:
+                return self.entries[manifest_name]
+
+            try:
+                with open(self._path(manifest_name), "rb") as cache_file:
+                    plaintext = encryption.decrypt(cache_file.read(), self._cache_key(master_key))
+            except (IOError, exceptions.DecryptError, exceptions.LibraryException):
+                # a missing or corrupt cache is just a cache miss
+                return None
+
+            try:
+                (version_size,) = self.VERSION_HEADER.unpack_from(plaintext)
+            except struct.error:
+                return None
+            version_end = self.VERSION_HEADER.size + version_size
+            entry = (plaintext[self.VERSION_HEADER.size:version_end], plaintext[version_end:])
+            self.entries[manifest_name] = entry
+            return entry
+
+    def store(self, manifest_name, master_key, version, content):
+        """
+        Cache a manifest, replacing any previous entry with the same name
+        Args:
+            manifest_name: the name of the manifest on the providers
+            master_key: the master key the manifest is encrypted with
+            version: a string identifying the version of the manifest
+            content: the serialized manifest
+        """
+        with self.lock:
+            self.entries[manifest_name] = (version, content)
+            plaintext = self.VERSION_HEADER.pack(len(version)) + version + content
+            ciphertext = encryption.encrypt(plaintext, self._cache_key(master_key))
+            try:
+                if not os.path.isdir(self.cache_dir):
+                    os.makedirs(self.cache_dir, 0o700)
+                # write to a temporary file first so readers never see a partial entry
+                fd, temp_path = tempfile.mkstemp(dir=self.cache_dir)
+                with os.fdopen(fd, "wb") as temp_file:
+                    temp_file.write(ciphertext)
+                os.rename(temp_path, self._path(manifest_name))
+            except (IOError, OSError):
+                # the in-memory entry is still usable
+                pass
+
+    def invalidate(self, manifest_name):
+        """
+        Discard any cached copy of the named manifest
+        """
+        with self.lock:
+            self.entries.pop(manifest_name, None)
+            try:
+                os.remove(self._path(manifest_name))
+            except OSError:
+                pass
+
+    def clear(self):
+        """
+        Discard every manifest cached for this cache's instance
+        """
+        with self.lock:
+            self.entries = {}
+            try:
+                names = os.listdir(self.cache_dir)
+            except OSError:
+                # nothing was ever cached
+                return
+            for name in names:
+                try:
+                    # other instances' directories can't be removed this way, so they're left alone
+                    os.remove(self._path(name))
+                except OSError:
+                    pass
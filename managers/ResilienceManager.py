@@ -1,9 +1,12 @@
 from custom_exceptions import exceptions
 from tools.encryption import generate_key
-from tools.utils import generate_random_name
+from tools.utils import generate_random_name, call_later
 from managers.BootstrapManager import Bootstrap
 from providers.BaseProvider import ProviderStatus, BaseProvider
+from collections import deque
 import logging
+import threading
+import time
 
 
 logger = logging.getLogger("daruma")
@@ -11,6 +14,22 @@ logger = logging.getLogger("daruma")
 
 class ResilienceManager:
     DECAY_RATE = .7
+    # a provider is slow if its median latency is this many times the median latency across providers
+    SLOW_LATENCY_FACTOR = 3
+    # the fewest successful operations on a provider needed to judge its latency
+    MIN_LATENCY_SAMPLES = 10
+    # how long a read waits on a provider without enough history before asking another provider, in seconds
+    DEFAULT_HEDGE_DELAY = 1.0
+    # the shortest time a read waits on a provider before asking another provider, in seconds
+    MIN_HEDGE_DELAY = 0.05
+    # the number of times to try uploading a share that failed to upload after its write returned
+    REPAIR_ATTEMPTS = 5
+    # the time to wait before the first retry of a repair, in seconds; doubled for each retry after that
+    REPAIR_BACKOFF = 1.0
+    # the most repairs to hold at once; the shares of repairs beyond this stay missing until the file is rewritten
+    MAX_PENDING_REPAIRS = 1024
+    # the most bytes of shares to hold for repairs at once; repairs beyond this are dropped like those above
+    MAX_PENDING_REPAIR_BYTES = 256 * 1024 * 1024
 
     def __init__(self, providers, file_manager, bootstrap_manager):
         """
@@ -19,20 +38,150 @@ class ResilienceManager:
         self.file_manager = file_manager
         self.bootstrap_manager = bootstrap_manager
         self.providers = providers
+        self.file_manager.set_straggler_handler(self.log_straggler_result)
+        self.share_check = None
+        # guards the providers' scores, which reads, stragglers, repairs and writes update alongside each other
+        self.score_lock = threading.RLock()
+
+        # (provider, filename, share, attempt) of the repairs ready to run
+        self.repairs = deque()
+        # the number of repairs that are ready, running, or waiting to retry, and the total size of their shares
+        self.unfinished_repairs = 0
+        self.unfinished_repair_bytes = 0
+        self.repair_condition = threading.Condition()
+        self.repair_thread = None
 
     def _log_provider_success(self, provider):
         """
         Update the provider to reflect a successful operation
         """
         # 1 success should bring the provider out of red, and never over 1
-        provider.score = min(1, max(self.DECAY_RATE * provider.score + (1-self.DECAY_RATE), BaseProvider.RED_THRESHOLD + .1))
+        with self.score_lock:
+            provider.score = min(1, max(self.DECAY_RATE * provider.score + (1-self.DECAY_RATE), BaseProvider.RED_THRESHOLD + .1))
+
+    def _log_provider_failure(self, failure):
+        """
+        Update the provider of a failure to reflect the failed operation
+        """
+        if type(failure) is exceptions.AuthFailure:
+            # don't punish for AuthFailures
+            failure.provider.authenticated = False
+        else:
+            # TODO implement average of window method
+            # score = alpha*score + (1-alpha)*(new_score=0)
+            try:
+                with self.score_lock:
+                    failure.provider.score = self.DECAY_RATE * failure.provider.score
+            except:
+                logger.error("Error parsing failure in diagnose")
+
+    def log_straggler_result(self, provider, failure):
+        """
+        Update a provider to reflect the result of a read that finished after the file was already returned
+        Args: provider - the provider that finished late
+              failure - the ProviderFailure it raised, or None if it returned a valid share
+        """
+        if failure is None:
+            self._log_provider_success(provider)
+        else:
+            self._log_provider_failure(failure)
+
+    def set_share_check(self, share_check):
+        """
+        Check that a share is still needed before each attempt to repair it, so that repairs of files that have
+        since been overwritten, deleted or copied elsewhere are dropped rather than uploading garbage
+        Args: share_check - a function called with the name of a share, returning whether it is still needed
+              (see FileManager.holds_share)
+        """
+        self.share_check = share_check
+
+    def queue_repair(self, provider, filename, share, failure):
+        """
+        Upload a share in the background after its upload failed, retrying with exponential backoff
+        Used as the repair_handler of writes that returned at a quorum (see FileDistributor)
+        Args: provider - the provider that failed to store the share
+              filename - the name of the share on the provider
+              share - the share
+              failure - the ProviderFailure the upload raised
+        """
+        self._log_provider_failure(failure)
+        with self.repair_condition:
+            if self.unfinished_repairs >= self.MAX_PENDING_REPAIRS or \
+               self.unfinished_repair_bytes + len(share) > self.MAX_PENDING_REPAIR_BYTES:
+                logger.warning("Too many pending repairs; not repairing %s on %s", filename, provider)
+                return
+            self.unfinished_repairs += 1
+            self.unfinished_repair_bytes += len(share)
+            self._ready_repair(provider, filename, share, 0)
+
+    def _ready_repair(self, provider, filename, share, attempt):
+        with self.repair_condition:
+            self.repairs.append((provider, filename, share, attempt))
+            if self.repair_thread is None:
+                self.repair_thread = threading.Thread(target=self._run_repairs, name="repairs")
+                self.repair_thread.daemon = True
+                self.repair_thread.start()
+            self.repair_condition.notify_all()
+
+    def _run_repairs(self):
+        while True:
+            with self.repair_condition:
+                while len(self.repairs) == 0:
+                    self.repair_condition.wait()
+                provider, filename, share, attempt = self.repairs.popleft()
+
+            try:
+                if self.share_check is not None and not self.share_check(filename):
+                    logger.info("Not repairing %s on %s, which is no longer needed", filename, provider)
+                else:
+                    provider.put_async(filename, share).result()
+                    self._log_provider_success(provider)
+            except exceptions.ProviderFailure as failure:
+                self._log_provider_failure(failure)
+                if attempt + 1 < self.REPAIR_ATTEMPTS:
+                    # retry later without holding up repairs on other providers
+                    call_later(self.REPAIR_BACKOFF * 2 ** attempt, self._ready_repair, provider, filename, share, attempt + 1)
+                    continue
+                logger.warning("Giving up repairing %s on %s", filename, provider)
+            except Exception:
+                logger.exception("Unexpected error repairing %s on %s", filename, provider)
+
+            with self.repair_condition:
+                self.unfinished_repairs -= 1
+                self.unfinished_repair_bytes -= len(share)
+                self.repair_condition.notify_all()
+
+    def pending_repairs(self):
+        """
+        Returns the number of repairs that haven't finished or given up yet
+        """
+        with self.repair_condition:
+            return self.unfinished_repairs
+
+    def wait_for_repairs(self, timeout=None):
+        """
+        Wait until every queued repair has finished or given up
+        Args: timeout - (optional) the most seconds to wait
+        Returns True if no repairs are pending
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self.repair_condition:
+            while self.unfinished_repairs > 0:
+                if deadline is None:
+                    self.repair_condition.wait()
+                elif deadline <= time.time():
+                    return False
+                else:
+                    self.repair_condition.wait(deadline - time.time())
+            return True
 
     def log_success(self):
         """
         Update the providers to reflect a fully successful operation
         """
-        for provider in self.providers:
-            self._log_provider_success(provider)
+        with self.score_lock:
+            for provider in self.providers:
+                self._log_provider_success(provider)
 
     def diagnose(self, failures):
         """
@@ -45,27 +194,18 @@ class ResilienceManager:
         if len(failures) == 0:
             return True
         failed_providers = set()
-        for failure in failures:
-            if type(failure) is exceptions.AuthFailure:
-                # don't punish for AuthFailures
-                failure.provider.authenticated = False
-            else:
-                # TODO implement average of window method
-                # score = alpha*score + (1-alpha)*(new_score=0)
-                try:
-                    failure.provider.score = self.DECAY_RATE * failure.provider.score
-                except:
-                    logger.error("Error parsing failure in diagnose")
-            failed_providers.add(failure.provider)
-
         no_red_providers = True
+        with self.score_lock:
+            for failure in failures:
+                self._log_provider_failure(failure)
+                failed_providers.add(failure.provider)
 
-        for provider in self.providers:
-            if provider not in failed_providers:
-                self._log_provider_success(provider)
-            # NB, provider status is computed in real time
-            if provider.status not in [ProviderStatus.GREEN, ProviderStatus.YELLOW]:
-                no_red_providers = False
+            for provider in self.providers:
+                if provider not in failed_providers:
+                    self._log_provider_success(provider)
+                # NB, provider status is computed in real time
+                if provider.status not in [ProviderStatus.GREEN, ProviderStatus.YELLOW]:
+                    no_red_providers = False
 
         return no_red_providers
 
@@ -149,6 +289,69 @@ class ResilienceManager:
             # can't repair in ReadOnlyMode
             return
 
+    def get_provider_metrics(self):
+        """
+        Returns: a map from each provider to a summary of its recent operations (see ProviderMetrics.summary),
+            with an additional "slow" entry saying whether the provider is much slower than the others
+        """
+        summaries = {provider: provider.metrics.summary() for provider in self.providers}
+        slow = self._find_slow_providers(summaries)
+        for provider, summary in summaries.items():
+            summary["slow"] = provider in slow
+        return summaries
+
+    def _find_slow_providers(self, summaries):
+        latencies = {provider: summary["p50_latency"] for provider, summary in summaries.items()
+                     if summary["p50_latency"] is not None and
+                     summary["operations"] * (1 - summary["failure_rate"]) >= self.MIN_LATENCY_SAMPLES}
+        if len(latencies) < 2:
+            return set()
+        ordered = sorted(latencies.values())
+        typical = ordered[(len(ordered) - 1) / 2]
+        return set(provider for provider, latency in latencies.items() if latency > self.SLOW_LATENCY_FACTOR * typical)
+
+    def slow_providers(self):
+        """
+        Returns: a list of the providers that are working, but much slower than the others
+        """
+        slow = self._find_slow_providers({provider: provider.metrics.summary() for provider in self.providers})
+        return [provider for provider in self.providers if provider in slow]
+
+    def rank_providers(self, providers=None):
+        """
+        Args: providers, (optional) the providers to rank; defaults to all providers
+        Returns: the providers ordered from most to least preferred for latency-sensitive operations:
+            healthy before failing, then fastest first, with slow providers last.
+            Providers without enough history to judge count as fastest, so that they are tried and measured
+        """
+        if providers is None:
+            providers = self.providers
+        summaries = {provider: provider.metrics.summary() for provider in providers}
+        slow = self._find_slow_providers(summaries)
+
+        def preference(provider):
+            healthy = provider.status in [ProviderStatus.GREEN, ProviderStatus.YELLOW]
+            return (not healthy, provider in slow, summaries[provider]["p50_latency"] or 0)
+        return sorted(providers, key=preference)
+
+    def plan_reads(self, providers):
+        """
+        Plan which providers a read should fetch shares from (see FileDistributor)
+        Args: providers, the providers holding shares of the file
+        Returns: a list of (provider, hedge_delay) pairs, most preferred first.
+            hedge_delay is the provider's 95th percentile latency: a fetch taking longer than that is
+            unusually slow, and worth covering with a request to another provider
+        """
+        plan = []
+        for provider in self.rank_providers(providers):
+            summary = provider.metrics.summary()
+            if summary["p95_latency"] is None:
+                hedge_delay = self.DEFAULT_HEDGE_DELAY
+            else:
+                hedge_delay = max(self.MIN_HEDGE_DELAY, summary["p95_latency"])
+            plan.append((provider, hedge_delay))
+        return plan
+
     def garbage_collect(self):
         # TODO
         # requires provider ls support
@@ -0,0 +1,165 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from collections import namedtuple
+from appdirs import user_data_dir
+from tools.utils import APP_NAME
+
+# what a file looked like when it was last synced: its modification time, size, a hash of its contents (None if
+# the file was recorded without being read) and the code name of its version in daruma (None if unknown)
+FileState = namedtuple("FileState", ["mtime", "size", "hash", "code_name"])
+
+# matches a path and every path under it; paths are compared as blobs so that lengths are counted in bytes
+_PATH_AND_CHILDREN = "(path = ? OR substr(CAST(path AS BLOB), 1, ?) = CAST(? AS BLOB))"
+
+
+def _children_of(path):
+    # the parameters of _PATH_AND_CHILDREN
+    return path, len(path) + 1, path + os.sep
+
+
+def hash_file(path):
+    """
+    Returns the hex SHA-256 digest of the contents of the file at path, reading it a block at a time
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as src_file:
+        for block in iter(lambda: src_file.read(1024 * 1024), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class SyncState:
+    """
+    A local database of the files last synced between a folder and a daruma instance, kept in SQLite.
+    Each file is recorded with the modification time and size it had when it was synced, a hash of its
+    contents and the code name of its version in daruma, so a later sync can tell which files changed since,
+    on either side, without reading the ones that didn't.
+    Safe to use from several threads at once.
+    """
+    def __init__(self, db_path=None):
+        """
+        Create a SyncState
+        Args:
+            db_path: (optional) the file to keep the database in; defaults to one in the user's data directory
+        """
+        if db_path is None:
+            db_path = os.path.join(user_data_dir(APP_NAME), "sync_state.db")
+        try:
+            os.makedirs(os.path.dirname(db_path), 0o700)
+        except OSError:
+            # the directory already exists
+            pass
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(db_path, check_same_thread=False)
+        # paths are byte strings, which needn't be valid UTF-8
+        self.connection.text_factory = str
+        with self.lock:
+            self.connection.execute("CREATE TABLE IF NOT EXISTS files ("
+                                    "path TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL, hash TEXT, "
+                                    "code_name TEXT)")
+            columns = [row[1] for row in self.connection.execute("PRAGMA table_info(files)")]
+            if "code_name" not in columns:
+                # the database was made before code names were recorded
+                self.connection.execute("ALTER TABLE files ADD COLUMN code_name TEXT")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS owner (instance_id TEXT NOT NULL)")
+            self.connection.commit()
+
+    def claim(self, instance_id):
+        """
+        Make the recorded files belong to a daruma instance, forgetting them if they were synced with another
+        Args: instance_id, the id of the instance (see Daruma.get_instance_id)
+        Returns: True if the recorded files were synced with the instance
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT instance_id FROM owner").fetchone()
+            if row is not None and row[0] == instance_id:
+                return True
+            self.connection.execute("DELETE FROM files")
+            self.connection.execute("DELETE FROM owner")
+            self.connection.execute("INSERT INTO owner (instance_id) VALUES (?)", (instance_id,))
+            self.connection.commit()
+            return False
+
+    def get(self, path):
+        """
+        Returns the FileState recorded for path, or None if path isn't recorded
+        """
+        with self.lock:
+            row = self.connection.execute("SELECT mtime, size, hash, code_name FROM files WHERE path = ?",
+                                          (path,)).fetchone()
+        return FileState(*row) if row is not None else None
+
+    def record(self, path, mtime, size, file_hash, code_name):
+        """
+        Record that path was synced with the given modification time, size, content hash and code name
+        (either of which can be None)
+        """
+        self.record_many([(path, mtime, size, file_hash, code_name)])
+
+    def record_many(self, entries):
+        """
+        Record several synced files at once, in a single transaction
+        Args: entries, a list of (path, mtime, size, hash, code name) tuples
+        """
+        with self.lock:
+            self.connection.executemany("INSERT OR REPLACE INTO files (path, mtime, size, hash, code_name) "
+                                        "VALUES (?, ?, ?, ?, ?)", entries)
+            self.connection.commit()
+
+    def set_code_names(self, versions):
+        """
+        Update the code names of recorded files, e.g. after daruma stored them again without changing them
+        Args: versions, a map from path to code name; paths that aren't recorded are ignored
+        """
+        with self.lock:
+            self.connection.executemany("UPDATE files SET code_name = ? WHERE path = ?",
+                                        [(code_name, path) for path, code_name in versions.items()])
+            self.connection.commit()
+
+    def remove(self, path):
+        """
+        Forget path, and every path under it if it is a directory
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM files WHERE " + _PATH_AND_CHILDREN, _children_of(path))
+            self.connection.commit()
+
+    def move(self, path, destination):
+        """
+        Record path, and every path under it if it is a directory, under destination instead
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM files WHERE " + _PATH_AND_CHILDREN, _children_of(destination))
+            self.connection.execute("UPDATE files SET path = CAST(? || substr(CAST(path AS BLOB), ?) AS TEXT) "
+                                    "WHERE " + _PATH_AND_CHILDREN, (destination, len(path) + 1) + _children_of(path))
+            self.connection.commit()
+
+    def paths(self):
+        """
+        Returns a list of every recorded path
+        """
+        with self.lock:
+            return [row[0] for row in self.connection.execute("SELECT path FROM files")]
+
+    def items(self):
+        """
+        Returns a map from every recorded path to its FileState
+        """
+        with self.lock:
+            rows = self.connection.execute("SELECT path, mtime, size, hash, code_name FROM files").fetchall()
+        return {row[0]: FileState(*row[1:]) for row in rows}
+
+    def clear(self):
+        """
+        Forget every path
+        """
+        with self.lock:
+            self.connection.execute("DELETE FROM files")
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
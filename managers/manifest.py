@@ -8,6 +8,10 @@ class Attributes():
     CODE_NAME = "code_name"
     SIZE = "size"
     KEY = "key"
+    CHUNK_SIZE = "chunk_size"
+    DIGESTS = "digests"
+    LAYOUT = "layout"
+    BLOCKS = "blocks"
     CHILDREN = "children"
 
 
@@ -47,13 +51,24 @@ class File(_Node):
     Contains information about individual files.
     """
     @staticmethod
-    def from_values(name, code_name, size, key):
+    def from_values(name, code_name, size, key, chunk_size=None, digests=None, layout=None, blocks=None):
         """
         Args:
             name: string of true file name (not the path).
-            code_name: string of code name.
+            code_name: string of code name; for a deduplicated file, a name
+                identifying this version of the file.
             size: decimal value of file size.
-            key: byte representation of encryption key.
+            key: byte representation of encryption key, or None for a
+                deduplicated file.
+            chunk_size: decimal value of the stripe size if the file was
+                distributed in chunks, or None if it was distributed whole.
+            digests: list of keyed digests of the file's shares, or None.
+            layout: the id of the pending layout the file was distributed
+                with, or None if it was distributed with the manifest's
+                providers.
+            blocks: the ids of the deduplicated blocks the file is made of,
+                in order, or None if the file was distributed as its own
+                shares.
 
         Returns:
             A File object initialized with the given arguments.
@@ -64,6 +79,14 @@ class File(_Node):
             Attributes.SIZE: size,
             Attributes.KEY: key
         }
+        if chunk_size is not None:
+            attributes[Attributes.CHUNK_SIZE] = chunk_size
+        if digests is not None:
+            attributes[Attributes.DIGESTS] = digests
+        if layout is not None:
+            attributes[Attributes.LAYOUT] = layout
+        if blocks is not None:
+            attributes[Attributes.BLOCKS] = blocks
         return File(attributes)
 
     @property
@@ -78,6 +101,47 @@ class File(_Node):
     def size(self):
         return self.attributes[Attributes.SIZE]
 
+    @property
+    def chunk_size(self):
+        """
+        The size of each stripe of a chunked file, or None if the file is not
+        chunked.
+        """
+        return self.attributes.get(Attributes.CHUNK_SIZE)
+
+    @property
+    def digests(self):
+        """
+        The keyed digests of the file's shares, or None if they weren't recorded.
+        """
+        return self.attributes.get(Attributes.DIGESTS)
+
+    @property
+    def layout(self):
+        """
+        The id of the pending layout the file was distributed with, or None if
+        it was distributed with the manifest's providers.
+        """
+        return self.attributes.get(Attributes.LAYOUT)
+
+    @property
+    def blocks(self):
+        """
+        The ids of the deduplicated blocks the file is made of, in order, or
+        None if the file was distributed as its own shares.
+        """
+        return self.attributes.get(Attributes.BLOCKS)
+
+    @property
+    def num_chunks(self):
+        """
+        The number of stripes of a chunked file, or None if the file is not
+        chunked.
+        """
+        if self.chunk_size is None:
+            return None
+        return (self.size + self.chunk_size - 1) // self.chunk_size
+
 
 class Directory(_Node):
     """
@@ -184,6 +248,19 @@ class Manifest:
         Args: providers, a list of providers that will be using this Manifest, or None
         """
         self.root = Directory.from_values(Manifest.ROOT_DIRECTORY_NAME)
+        # the number of the snapshot this manifest was last serialized as
+        self.generation = 0
+        # map from the id of each pending layout (a set of providers and threshold that some files have been
+        # redistributed with, during a reprovision) to {"providers": provider strings, "threshold": threshold}
+        self.layouts = {}
+        # map from the id of each deduplicated block (a keyed digest of its contents) to
+        # {"code_name", "key", "size", "digests", "refs"} and "layout" if it was distributed with a pending layout,
+        # where refs is the number of times files refer to the block
+        self.blocks = {}
+        # the key block ids are derived with, or None if no block has been stored yet
+        self.block_id_key = None
+        # the BSON-serializable records of the changes made since take_journal was last called
+        self.journal = []
         # self.providers becomes a list of tuples that uniquely identify providers
         self.set_providers(providers)
 
@@ -200,7 +277,11 @@ class Manifest:
         """
         return bson.dumps({
             "tree": self.root.attributes,
-            "providers": self.providers
+            "providers": self.providers,
+            "generation": self.generation,
+            "layouts": self.layouts,
+            "blocks": self.blocks,
+            "block_id_key": self.block_id_key
         })
 
     @staticmethod
@@ -218,14 +299,99 @@ class Manifest:
             parsed_root = _node_from_attributes(data['tree'])
             parsed_providers = data['providers']
             parsed_providers = map(tuple, parsed_providers)
+            # manifests written before snapshots were numbered are generation 0
+            parsed_generation = data.get('generation', 0)
+            parsed_layouts = {}
+            for layout_id, layout in data.get('layouts', {}).items():
+                parsed_layouts[layout_id] = {"providers": map(tuple, layout["providers"]), "threshold": layout["threshold"]}
+            parsed_blocks = data.get('blocks', {})
+            parsed_block_id_key = data.get('block_id_key')
         except Exception:
             raise exceptions.ParseException
 
         manifest = Manifest()
         manifest.root = parsed_root
         manifest.providers = parsed_providers
+        manifest.generation = parsed_generation
+        manifest.layouts = parsed_layouts
+        manifest.blocks = parsed_blocks
+        manifest.block_id_key = parsed_block_id_key
         return manifest
 
+    def _record(self, operation, **args):
+        """
+        Append a change to the journal, so that it can be replayed by apply_journal
+        """
+        args["op"] = operation
+        self.journal.append(args)
+
+    def take_journal(self):
+        """
+        Returns:
+            A list of the changes made since the journal was last taken, and clears the journal.
+        """
+        journal = self.journal
+        self.journal = []
+        return journal
+
+    @staticmethod
+    def serialize_journal(journal):
+        """
+        Args:
+            journal: a list of changes returned by take_journal()
+        Returns:
+            The BSON representation of the changes.
+        """
+        return bson.dumps({"journal": journal})
+
+    def apply_journal(self, string):
+        """
+        Replays changes onto this manifest.  The replayed changes are not
+        themselves added to the journal.
+
+        Args:
+            string representation of a list of changes as output by serialize_journal().
+        Raises:
+            ParseException if the string cannot be parsed or replayed
+        """
+        try:
+            journal = bson.loads(string)["journal"]
+        except Exception:
+            raise exceptions.ParseException
+
+        try:
+            for change in journal:
+                operation = change["op"]
+                if operation == "update_file":
+                    self.update_file(change["path"], change["code_name"], change["size"], change["key"],
+                                     change.get("chunk_size"), change.get("digests"), change.get("layout"),
+                                     change.get("blocks"))
+                elif operation == "create_directory":
+                    self.create_directory(change["path"])
+                elif operation == "remove":
+                    self.remove(change["path"])
+                elif operation == "move":
+                    self.move(change["old_path"], change["new_path"])
+                elif operation == "set_providers":
+                    self._set_provider_strings(map(tuple, change["providers"]))
+                elif operation == "add_layout":
+                    self.add_layout(change["layout"], map(tuple, change["providers"]), change["threshold"])
+                elif operation == "adopt_layout":
+                    self.adopt_layout(change["layout"])
+                elif operation == "set_block_id_key":
+                    self.set_block_id_key(change["key"])
+                elif operation == "store_block":
+                    self.store_block(change["block"], change["code_name"], change["key"], change["size"],
+                                     change["digests"], change.get("layout"))
+                elif operation == "drop_unreferenced_blocks":
+                    self.drop_unreferenced_blocks()
+                else:
+                    raise exceptions.ParseException
+        except (KeyError, exceptions.InvalidPath):
+            raise exceptions.ParseException
+        finally:
+            self.journal = []
+
     @staticmethod
     def _tokenize_path(path):
         """
@@ -298,13 +464,16 @@ class Manifest:
 
         try:
             target_node = parent_node._remove_child(target_name)
-            return target_node
         except (KeyError, AttributeError):
             # The parent_node was a file, or didn't have the
             # specified child.
             raise exceptions.InvalidPath
 
-    def update_file(self, path, code_name, size, key):
+        self._reference_blocks(target_node, -1)
+        self._record("remove", path=path)
+        return target_node
+
+    def update_file(self, path, code_name, size, key, chunk_size=None, digests=None, layout=None, blocks=None):
         """
         Updates the manifest in place with a file.
         If the path already exists as a file, replace its properties.
@@ -316,6 +485,12 @@ class Manifest:
             code_name: string representing the new file code name
             size: decimal representation of size
             key: byte representation of the encryption key
+            chunk_size: the stripe size if the file is chunked, or None
+            digests: a list of keyed digests of the file's shares, or None
+            layout: the id of the pending layout the file was distributed
+                with, or None
+            blocks: the ids of the deduplicated blocks the file is made of,
+                which must have been stored with store_block, or None
 
         Returns:
             The node of the specified file before the update (or None if
@@ -324,14 +499,17 @@ class Manifest:
         Raises:
             InvalidPath if there are existing Files or Directories that
             conflict with the given path.
+            KeyError if some block has not been stored.
         """
         parent_directory_path, file_name = os.path.split(path)
         if file_name == "":
             raise exceptions.InvalidPath
-        else:
-            parent_directory = self.create_directory(parent_directory_path)
+        for block_id in blocks or []:
+            if block_id not in self.blocks:
+                raise KeyError(block_id)
+        parent_directory = self._create_directory(parent_directory_path)
 
-        new_file = File.from_values(file_name, code_name, size, key)
+        new_file = File.from_values(file_name, code_name, size, key, chunk_size, digests, layout, blocks)
         old_node = parent_directory._add_child(new_file)
 
         if type(old_node) is Directory:
@@ -339,6 +517,22 @@ class Manifest:
             parent_directory._add_child(old_node)
             raise exceptions.InvalidPath
 
+        # count the new references first, so blocks the old version shares with the new one are never unreferenced
+        self._reference_blocks(new_file, 1)
+        if old_node is not None:
+            self._reference_blocks(old_node, -1)
+
+        change = {"path": path, "code_name": code_name, "size": size, "key": key}
+        if chunk_size is not None:
+            change["chunk_size"] = chunk_size
+        if digests is not None:
+            change["digests"] = digests
+        if layout is not None:
+            change["layout"] = layout
+        if blocks is not None:
+            change["blocks"] = blocks
+        self._record("update_file", **change)
+
         return old_node
 
     def create_directory(self, path):
@@ -359,6 +553,15 @@ class Manifest:
             InvalidPath if there are existing Files that conflict with the
             given path.
         """
+        directory = self._create_directory(path)
+        self._record("create_directory", path=path)
+        return directory
+
+    def _create_directory(self, path):
+        """
+        Implements create_directory without journaling the change, for use by
+        operations that journal themselves.
+        """
         path_tokens = self._tokenize_path(path)
 
         current_node = self.root
@@ -406,9 +609,17 @@ class Manifest:
 
         moved_node_attributes[Attributes.NAME] = new_target
 
-        new_parent_directory = self.create_directory(new_parent)
+        try:
+            new_parent_directory = self._create_directory(new_parent)
+        except exceptions.InvalidPath:
+            # revert the change so that a failed move leaves the manifest untouched
+            moved_node_attributes[Attributes.NAME] = old_target
+            old_parent_directory._add_child(_Node(moved_node_attributes))
+            raise
         new_parent_directory._add_child(_Node(moved_node_attributes))
 
+        self._record("move", old_path=old_path, new_path=new_path)
+
     def generate_nodes_under(self, path):
         """
         Returns a generator for all files and directories in the manifest under
@@ -416,7 +627,14 @@ class Manifest:
         is a string relative to the given path and Node is a File or Directory
         object.
         """
-        frontier = [("", self.get(path))]
+        return self._generate_nodes_in(self.get(path))
+
+    @staticmethod
+    def _generate_nodes_in(directory):
+        """
+        Implements generate_nodes_under for a Directory node
+        """
+        frontier = [("", directory)]
         while len(frontier) > 0:
             target_path, target_node = frontier.pop(0)
             for child in target_node.get_children():
@@ -431,12 +649,125 @@ class Manifest:
         Args: A list of provider objects
         """
         if providers is None:
-            self.providers = []
+            self._set_provider_strings([])
         else:
-            self.providers = map(lambda provider: provider.uuid, providers)
+            self._set_provider_strings(map(lambda provider: provider.uuid, providers))
+
+    def _set_provider_strings(self, provider_strings):
+        """
+        Updates the manifest provider list
+        Args: A list of unique identifiers for providers
+        """
+        self.providers = provider_strings
+        self._record("set_providers", providers=provider_strings)
 
     def get_provider_strings(self):
         """
         Returns a set of unique identifiers for providers contained in this manifest
         """
         return self.providers[:]
+
+    def add_layout(self, layout_id, provider_strings, threshold):
+        """
+        Record a pending layout, which files can then be distributed with
+        Args: layout_id, a unique name for the layout
+              provider_strings, a list of unique identifiers for the layout's providers
+              threshold, the layout's file reconstruction threshold
+        """
+        self.layouts[layout_id] = {"providers": provider_strings, "threshold": threshold}
+        self._record("add_layout", layout=layout_id, providers=provider_strings, threshold=threshold)
+
+    def find_layout(self, provider_strings, threshold):
+        """
+        Returns the id of the pending layout with the given providers and threshold, or None if there is none
+        """
+        for layout_id, layout in self.layouts.items():
+            if layout["providers"] == provider_strings and layout["threshold"] == threshold:
+                return layout_id
+        return None
+
+    def adopt_layout(self, layout_id):
+        """
+        Make a pending layout the layout of the whole manifest: its providers become the manifest's providers,
+        files distributed with it are marked as distributed with the manifest's providers, and every pending
+        layout is forgotten. Every file should have been distributed with the layout first
+        Raises InvalidPath if some file or deduplicated block was not distributed with the layout
+        """
+        for _, node in self.generate_nodes_under(""):
+            if type(node) is File and node.blocks is None and node.layout != layout_id:
+                raise exceptions.InvalidPath
+        for block in self.blocks.values():
+            if block.get("layout") != layout_id:
+                raise exceptions.InvalidPath
+        for _, node in self.generate_nodes_under(""):
+            node.attributes.pop(Attributes.LAYOUT, None)
+        for block in self.blocks.values():
+            block.pop("layout", None)
+
+        self.providers = self.layouts[layout_id]["providers"]
+        self.layouts = {}
+        self._record("adopt_layout", layout=layout_id)
+
+    def set_block_id_key(self, key):
+        """
+        Set the key that the ids of deduplicated blocks are keyed digests under
+        """
+        self.block_id_key = key
+        self._record("set_block_id_key", key=key)
+
+    def get_block(self, block_id):
+        """
+        Returns the {"code_name", "key", "size", "digests", "refs"[, "layout"]} of a deduplicated block,
+        or None if it isn't stored
+        """
+        return self.blocks.get(block_id)
+
+    def store_block(self, block_id, code_name, key, size, digests, layout=None):
+        """
+        Record where a deduplicated block is stored. If the block was already stored, the files referring to it
+        now refer to the new copy
+        Args: block_id, the keyed digest of the block's contents
+              code_name, key, digests: the name, encryption key and share digests the block was distributed with
+              size, the length of the block's contents
+              layout, the id of the pending layout the block was distributed with, or None
+        Returns the block's previous entry (whose shares are now garbage), or None if it wasn't stored
+        """
+        old_block = self.blocks.get(block_id)
+        block = {"code_name": code_name, "key": key, "size": size, "digests": digests,
+                 "refs": old_block["refs"] if old_block is not None else 0}
+        if layout is not None:
+            block["layout"] = layout
+        self.blocks[block_id] = block
+
+        change = {"block": block_id, "code_name": code_name, "key": key, "size": size, "digests": digests}
+        if layout is not None:
+            change["layout"] = layout
+        self._record("store_block", **change)
+        return old_block
+
+    def _reference_blocks(self, node, count):
+        """
+        Add count to the references to the blocks of each deduplicated file at or under node
+        """
+        if type(node) is Directory:
+            nodes = [child for _, child in self._generate_nodes_in(node)]
+        else:
+            nodes = [node]
+        for file_node in nodes:
+            if type(file_node) is File and file_node.blocks is not None:
+                for block_id in file_node.blocks:
+                    self.blocks[block_id]["refs"] += count
+
+    def drop_unreferenced_blocks(self):
+        """
+        Forget the deduplicated blocks no file refers to
+        Returns a list of the entries of the forgotten blocks, whose shares are now garbage
+        """
+        dropped = []
+        for block_id, block in self.blocks.items():
+            if block["refs"] <= 0:
+                dropped.append(block)
+                del self.blocks[block_id]
+        if len(dropped) > 0:
+            self._record("drop_unreferenced_blocks")
+        return dropped
@@ -1,8 +1,12 @@
 from managers.Distributor import FileDistributor
+from tools import erasure_encoding
 from managers.CredentialManager import CredentialManager
 from custom_exceptions import exceptions
 from providers.LocalFilesystemProvider import LocalFilesystemProvider
 from tools.encryption import generate_key
+from StringIO import StringIO
+import threading
+import time
 import pytest
 
 cm = CredentialManager()
@@ -174,3 +178,463 @@ def test_missing_providers():
     key = FD.put("test", "data")
     FD = FileDistributor(providers[0:3], len(providers), 3)
     assert FD.get("test", key) == "data"
+
+
+def test_stream_roundtrip():
+    FD = FileDistributor(providers, len(providers), 3)
+    data = "".join(chr(i % 256) for i in xrange(1000))
+    key, size = FD.put_stream("test", StringIO(data), chunk_size=64)
+    assert size == len(data)
+
+    out = StringIO()
+    FD.get_stream("test", key, out, 16)
+    assert out.getvalue() == data
+
+
+def test_stream_empty():
+    FD = FileDistributor(providers, len(providers), 3)
+    key, size = FD.put_stream("test", StringIO(""), chunk_size=64)
+    assert size == 0
+
+    out = StringIO()
+    FD.get_stream("test", key, out, 0)
+    assert out.getvalue() == ""
+
+
+def test_stream_corrupt_recover():
+    FD = FileDistributor(providers, len(providers), 3)
+    key, _ = FD.put_stream("test", StringIO("data" * 100), chunk_size=64)
+    providers[0].wipe()
+    providers[2].wipe()
+
+    out = StringIO()
+    with pytest.raises(exceptions.OperationFailure) as excinfo:
+        FD.get_stream("test", key, out, 7)
+    assert out.getvalue() == "data" * 100
+    # failures are reported once per provider, not once per stripe
+    assert sorted([f.provider for f in excinfo.value.failures]) == sorted([providers[0], providers[2]])
+
+
+def test_stream_corrupt_fail():
+    FD = FileDistributor(providers, len(providers), 3)
+    key, _ = FD.put_stream("test", StringIO("data" * 100), chunk_size=64)
+    providers[0].wipe()
+    providers[1].wipe()
+    providers[2].wipe()
+
+    with pytest.raises(exceptions.FatalOperationFailure):
+        FD.get_stream("test", key, StringIO(), 7)
+
+
+def test_stream_reordered_chunks():
+    FD = FileDistributor(providers, len(providers), 3)
+    key, _ = FD.put_stream("test", StringIO("a" * 64 + "b" * 64), chunk_size=64)
+    # swap the two stripes on every provider
+    for provider in providers:
+        first, second = provider.get("test-0"), provider.get("test-1")
+        provider.put("test-0", second)
+        provider.put("test-1", first)
+
+    with pytest.raises(exceptions.FatalOperationFailure):
+        FD.get_stream("test", key, StringIO(), 2)
+
+
+def test_stream_delete():
+    FD = FileDistributor(providers, len(providers), 3)
+    key, _ = FD.put_stream("test", StringIO("data" * 100), chunk_size=64)
+    FD.delete_stream("test", 7)
+    with pytest.raises(exceptions.FatalOperationFailure):
+        FD.get_stream("test", key, StringIO(), 7)
+
+
+def test_stream_failure_deletes_stored_stripes(monkeypatch):
+    FD = FileDistributor(providers, len(providers), 3)
+    put = providers[0].put
+
+    def failing_put(filename, data):
+        if filename == "test-5":
+            raise exceptions.ProviderOperationFailure(providers[0])
+        put(filename, data)
+    monkeypatch.setattr(providers[0], "put", failing_put)
+
+    with pytest.raises(exceptions.FatalOperationFailure):
+        FD.put_stream("test", StringIO("data" * 100), chunk_size=64)
+    for provider in providers:
+        for index in xrange(7):
+            with pytest.raises(exceptions.ProviderOperationFailure):
+                provider.get("test-" + str(index))
+
+
+def flip_last_byte(provider, filename):
+    share = provider.get(filename)
+    provider.put(filename, share[:-1] + chr(ord(share[-1]) ^ 1))
+
+
+def test_tagged_corruption_located_with_one_decode(monkeypatch):
+    FD = FileDistributor(providers, len(providers), 3)
+    key = FD.put("test", "data")
+    flip_last_byte(providers[1], "test")
+    flip_last_byte(providers[4], "test")
+
+    decodes = []
+
+    def counting_reconstruct(*args):
+        decodes.append(args)
+        return reconstruct(*args)
+    reconstruct = erasure_encoding.reconstruct
+    monkeypatch.setattr(erasure_encoding, "reconstruct", counting_reconstruct)
+
+    with pytest.raises(exceptions.OperationFailure) as excinfo:
+        FD.get("test", key)
+    assert excinfo.value.result == "data"
+    assert sorted([f.provider for f in excinfo.value.failures]) == sorted([providers[1], providers[4]])
+    assert len(decodes) == 1
+
+
+def test_tagged_stale_share():
+    FD = FileDistributor(providers, len(providers), 3)
+    key = generate_key()
+    FD.put("test", "old data", key)
+    stale_share = providers[0].get("test")
+    FD.put("test", "new data", key)
+    # a provider replays a validly tagged share from an older version
+    providers[0].put("test", stale_share)
+
+    with pytest.raises(exceptions.OperationFailure) as excinfo:
+        FD.get("test", key)
+    assert excinfo.value.result == "new data"
+    assert [f.provider for f in excinfo.value.failures] == [providers[0]]
+
+
+def test_tagged_corruption_fail():
+    FD = FileDistributor(providers, len(providers), 3)
+    key = FD.put("test", "data")
+    for provider in providers[:3]:
+        flip_last_byte(provider, "test")
+
+    with pytest.raises(exceptions.FatalOperationFailure) as excinfo:
+        FD.get("test", key)
+    assert sorted([f.provider for f in excinfo.value.failures]) == sorted(providers[:3])
+
+
+def test_digests_roundtrip():
+    FD = FileDistributor(providers, len(providers), 3)
+    key, digests = FD.put_with_digests("test", "data")
+    assert len(digests) == len(providers)
+    assert FD.get("test", key, digests) == "data"
+
+
+def test_digests_reject_corrupt_shares(monkeypatch):
+    FD = FileDistributor(providers, len(providers), 3)
+    key, digests = FD.put_with_digests("test", "data")
+    flip_last_byte(providers[2], "test")
+
+    # rejected shares never reach the tag check
+    untagged = []
+
+    def recording_untag_share(tagged_share, tag_key):
+        untagged.append(tagged_share)
+        return untag_share(tagged_share, tag_key)
+    untag_share = FD._untag_share
+    monkeypatch.setattr(FD, "_untag_share", recording_untag_share)
+
+    with pytest.raises(exceptions.OperationFailure) as excinfo:
+        FD.get("test", key, digests)
+    assert excinfo.value.result == "data"
+    assert [f.provider for f in excinfo.value.failures] == [providers[2]]
+    assert len(untagged) == len(providers) - 1
+
+
+def test_digests_reject_stale_majority():
+    FD = FileDistributor(providers, len(providers), 2)
+    key = generate_key()
+    FD.put("test", "old data", key)
+    stale_shares = [provider.get("test") for provider in providers[:3]]
+    _, digests = FD.put_with_digests("test", "new data", key)
+
+    # a majority of providers replay validly tagged shares of the old version
+    for provider, stale_share in zip(providers, stale_shares):
+        provider.put("test", stale_share)
+
+    with pytest.raises(exceptions.OperationFailure) as excinfo:
+        FD.get("test", key, digests)
+    assert excinfo.value.result == "new data"
+    assert sorted([f.provider for f in excinfo.value.failures]) == sorted(providers[:3])
+
+
+def block_gets(monkeypatch, provider):
+    """
+    Make gets on provider wait until the returned event is set
+    """
+    release = threading.Event()
+    original_get = provider.get
+
+    def blocked_get(filename):
+        release.wait()
+        return original_get(filename)
+    monkeypatch.setattr(provider, "get", blocked_get)
+    return release
+
+
+def test_early_return_skips_stragglers(monkeypatch):
+    results = []
+    finished = threading.Event()
+
+    def straggler_handler(provider, failure):
+        results.append((provider, failure))
+        if provider is providers[4]:
+            finished.set()
+
+    FD = FileDistributor(providers, len(providers), 3, early_return=True, straggler_handler=straggler_handler)
+    key, digests = FD.put_with_digests("test", "data")
+    release = block_gets(monkeypatch, providers[4])
+
+    try:
+        assert FD.get("test", key, digests) == "data"
+        assert providers[4] not in [provider for provider, _ in results]
+    finally:
+        release.set()
+    assert finished.wait(5)
+    # other providers may also have been left behind
+    assert all(failure is None for _, failure in results)
+
+
+def test_early_return_reports_bad_stragglers(monkeypatch):
+    results = []
+    finished = threading.Event()
+
+    def straggler_handler(provider, failure):
+        results.append((provider, failure))
+        if provider is providers[4]:
+            finished.set()
+
+    FD = FileDistributor(providers, len(providers), 3, early_return=True, straggler_handler=straggler_handler)
+    key, digests = FD.put_with_digests("test", "data")
+    flip_last_byte(providers[4], "test")
+    release = block_gets(monkeypatch, providers[4])
+
+    try:
+        assert FD.get("test", key, digests) == "data"
+    finally:
+        release.set()
+    assert finished.wait(5)
+    failures = dict(results)
+    assert type(failures.pop(providers[4])) is exceptions.InvalidShareFailure
+    assert all(failure is None for failure in failures.values())
+
+
+def test_early_return_waits_past_failures():
+    FD = FileDistributor(providers, len(providers), 3, early_return=True)
+    key, digests = FD.put_with_digests("test", "data")
+    flip_last_byte(providers[0], "test")
+    providers[1].delete("test")
+
+    # failures that arrive after the early return aren't reported
+    try:
+        assert FD.get("test", key, digests) == "data"
+    except exceptions.OperationFailure as e:
+        assert e.result == "data"
+        assert set([f.provider for f in e.failures]) <= set(providers[:2])
+
+    flip_last_byte(providers[2], "test")
+    with pytest.raises(exceptions.FatalOperationFailure) as excinfo:
+        FD.get("test", key, digests)
+    assert sorted([f.provider for f in excinfo.value.failures]) == sorted(providers[:3])
+
+
+def fixed_plan(hedge_delay):
+    """
+    A read planner that prefers providers in list order
+    """
+    return lambda providers: [(provider, hedge_delay) for provider in providers]
+
+
+def asked_providers():
+    asked = [provider for provider in providers if any(sample.operation == "get" for sample in provider.metrics.samples)]
+    for provider in providers:
+        provider.metrics.samples.clear()
+    return asked
+
+
+def test_planned_read_asks_threshold_providers():
+    FD = FileDistributor(providers, len(providers), 3, read_planner=fixed_plan(10))
+    key, digests = FD.put_with_digests("test", "data")
+    asked_providers()
+
+    assert FD.get("test", key, digests) == "data"
+    assert asked_providers() == providers[:3]
+
+
+def test_planned_read_replaces_failures():
+    FD = FileDistributor(providers, len(providers), 3, read_planner=fixed_plan(10))
+    key, digests = FD.put_with_digests("test", "data")
+    providers[0].delete("test")
+    flip_last_byte(providers[1], "test")
+    asked_providers()
+
+    with pytest.raises(exceptions.OperationFailure) as excinfo:
+        FD.get("test", key, digests)
+    assert excinfo.value.result == "data"
+    assert sorted([f.provider for f in excinfo.value.failures]) == sorted(providers[:2])
+    assert asked_providers() == providers
+
+
+def test_planned_read_hedges_slow_fetches(monkeypatch):
+    results = []
+    finished = threading.Event()
+
+    def straggler_handler(provider, failure):
+        results.append((provider, failure))
+        finished.set()
+
+    FD = FileDistributor(providers, len(providers), 3, straggler_handler=straggler_handler, read_planner=fixed_plan(0.05))
+    key, digests = FD.put_with_digests("test", "data")
+    release = block_gets(monkeypatch, providers[0])
+    asked_providers()
+
+    try:
+        assert FD.get("test", key, digests) == "data"
+        assert providers[3] in asked_providers()
+    finally:
+        release.set()
+    assert finished.wait(5)
+    assert results == [(providers[0], None)]
+
+
+def test_planned_read_fails_without_threshold_shares():
+    FD = FileDistributor(providers, len(providers), 3, read_planner=fixed_plan(10))
+    key, digests = FD.put_with_digests("test", "data")
+    for provider in providers[:3]:
+        provider.delete("test")
+
+    with pytest.raises(exceptions.FatalOperationFailure) as excinfo:
+        FD.get("test", key, digests)
+    assert sorted([f.provider for f in excinfo.value.failures]) == sorted(providers[:3])
+
+
+def block_puts(monkeypatch, provider, fail=False):
+    """
+    Make puts on provider wait until the returned event is set, then fail if fail is set
+    """
+    release = threading.Event()
+    original_put = provider.put
+
+    def blocked_put(filename, data):
+        release.wait()
+        if fail:
+            raise exceptions.ConnectionFailure(provider)
+        return original_put(filename, data)
+    monkeypatch.setattr(provider, "put", blocked_put)
+    return release
+
+
+def test_quorum_put_returns_before_slow_providers(monkeypatch):
+    stored = threading.Event()
+    repairs = []
+
+    def straggler_handler(provider, failure):
+        stored.set()
+
+    FD = FileDistributor(providers, len(providers), 3, straggler_handler=straggler_handler, write_quorum=4,
+                         repair_handler=lambda *args: repairs.append(args))
+    release = block_puts(monkeypatch, providers[0])
+    try:
+        key, digests = FD.put_with_digests("test", "data", quorum=True)
+        with pytest.raises(exceptions.ProviderOperationFailure):
+            providers[0].get("test")
+    finally:
+        release.set()
+    assert stored.wait(5)
+    assert repairs == []
+    assert FD.get("test", key, digests) == "data"
+
+
+def test_quorum_put_repairs_late_failures(monkeypatch):
+    repaired = threading.Event()
+    repairs = []
+
+    def repair_handler(provider, filename, share, failure):
+        repairs.append((provider, filename, share, failure))
+        repaired.set()
+
+    FD = FileDistributor(providers, len(providers), 3, write_quorum=4, repair_handler=repair_handler)
+    release = block_puts(monkeypatch, providers[0], fail=True)
+    key, digests = FD.put_with_digests("test", "data", quorum=True)
+    release.set()
+    assert repaired.wait(5)
+
+    [(provider, filename, share, failure)] = repairs
+    assert (provider, filename) == (providers[0], "test")
+    assert isinstance(failure, exceptions.ConnectionFailure)
+    # the share handed over for repair is the one the provider should have stored
+    monkeypatch.undo()
+    providers[0].put(filename, share)
+    providers[1].delete("test")
+    providers[2].delete("test")
+    with pytest.raises(exceptions.OperationFailure) as excinfo:
+        FD.get("test", key, digests)
+    assert excinfo.value.result == "data"
+    assert sorted([f.provider for f in excinfo.value.failures]) == sorted(providers[1:3])
+
+
+def test_quorum_put_fails_without_quorum(monkeypatch):
+    repairs = []
+    FD = FileDistributor(providers, len(providers), 3, write_quorum=4, repair_handler=lambda *args: repairs.append(args))
+    for provider in providers[:2]:
+        block_puts(monkeypatch, provider, fail=True).set()
+
+    with pytest.raises(exceptions.FatalOperationFailure) as excinfo:
+        FD.put("test", "data", quorum=True)
+    assert sorted([f.provider for f in excinfo.value.failures]) == sorted(providers[:2])
+    assert repairs == []
+
+
+def test_put_without_quorum_waits_for_every_provider(monkeypatch):
+    FD = FileDistributor(providers, len(providers), 3, write_quorum=4, repair_handler=lambda *args: None)
+    block_puts(monkeypatch, providers[0], fail=True).set()
+    with pytest.raises(exceptions.FatalOperationFailure):
+        FD.put("test", "data")
+
+
+def test_queued_slow_provider_does_not_time_out(monkeypatch):
+    FD = FileDistributor(providers, len(providers), 3)
+    slow = providers[0]
+    original_put = slow.put
+
+    def slow_put(filename, data):
+        time.sleep(0.1)
+        return original_put(filename, data)
+    monkeypatch.setattr(slow, "put", slow_put)
+    monkeypatch.setattr(slow.request_limiter, "limit", 1)
+    monkeypatch.setattr(slow, "PUT_TIMEOUT", 0.2)
+
+    # each put is well within the deadline, though the last is queued behind the others for far longer
+    errors = []
+
+    def put(filename):
+        try:
+            FD.put(filename, "data")
+        except exceptions.FatalOperationFailure as e:
+            errors.append(e)
+    threads = [threading.Thread(target=put, args=("test" + str(i),)) for i in xrange(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    for i in xrange(5):
+        slow.get("test" + str(i))
+
+
+def test_put_times_out_hung_provider(monkeypatch):
+    FD = FileDistributor(providers, len(providers), 3)
+    release = block_puts(monkeypatch, providers[0])
+    monkeypatch.setattr(providers[0], "PUT_TIMEOUT", 0.05)
+    try:
+        with pytest.raises(exceptions.FatalOperationFailure) as excinfo:
+            FD.put("test", "data")
+        [failure] = excinfo.value.failures
+        assert isinstance(failure, exceptions.TimeoutFailure)
+        assert failure.provider == providers[0]
+    finally:
+        release.set()
@@ -1,10 +1,15 @@
 from managers.FileManager import FileManager
+from managers.ManifestCache import ManifestCache
 from managers.CredentialManager import CredentialManager
 from custom_exceptions import exceptions
 from providers.LocalFilesystemProvider import LocalFilesystemProvider
+from tools import chunking
 from tools.encryption import generate_key
 from tools.utils import generate_random_name
+from StringIO import StringIO
+from concurrent.futures import wait
 import os
+import random
 import pytest
 
 cm = CredentialManager()
@@ -246,6 +251,90 @@ def test_add_provider():
     assert excinfo.value.result == "data"
 
 
+def test_reset_nested_files():
+    FM = FileManager(providers[0:4], 4, 3, master_key, manifest_name, setup=True)
+    FM.load_manifest()
+    FM.put("dir/sub/test", "data")
+
+    FM.providers.append(providers[-1])
+    FM.reset()
+
+    FM.load_manifest()
+    assert FM.get("dir/sub/test") == "data"
+    assert sorted(FM.path_generator()) == ["dir", "dir/sub", "dir/sub/test"]
+
+
+def test_reset_within_memory_budget(monkeypatch):
+    monkeypatch.setattr(FileManager, "RESET_MEMORY_BUDGET", 10)
+    monkeypatch.setattr(FileManager, "RESET_CHECKPOINT_INTERVAL", 2)
+    FM = FileManager(providers[0:4], 4, 3, master_key, manifest_name, setup=True)
+    FM.load_manifest()
+    files = [("file" + str(i), "data" + str(i)) for i in xrange(5)] + [("big", "x" * 20)]
+    for name, data in files:
+        FM.put(name, data)
+    old_code_names = [FM.get_code_name(name) for name, _ in files]
+
+    FM.providers.append(providers[-1])
+    FM.reset()
+
+    FM.load_manifest()
+    for name, data in files:
+        assert FM.get(name) == data
+    # the old shares were deleted
+    for code_name in old_code_names:
+        with pytest.raises(exceptions.ProviderOperationFailure):
+            providers[0].get(code_name)
+
+
+def test_reset_resumes(monkeypatch):
+    monkeypatch.setattr(FileManager, "RESET_PARALLELISM", 1)
+    monkeypatch.setattr(FileManager, "RESET_CHECKPOINT_INTERVAL", 1)
+    FM = FileManager(providers[0:4], 4, 3, master_key, manifest_name, setup=True)
+    FM.load_manifest()
+    files = [("file" + str(i), "data" + str(i)) for i in xrange(3)]
+    for name, data in files:
+        FM.put(name, data)
+
+    # the new provider fails to store the second file copied
+    puts = []
+    original_put = providers[-1].put
+
+    def failing_put(filename, data):
+        puts.append(filename)
+        if len(puts) == 2:
+            raise exceptions.ProviderOperationFailure(providers[-1])
+        original_put(filename, data)
+    monkeypatch.setattr(providers[-1], "put", failing_put)
+
+    FM.providers.append(providers[-1])
+    with pytest.raises(exceptions.FatalOperationFailure):
+        FM.reset()
+    monkeypatch.undo()
+
+    # the copies made before the failure were checkpointed, and files are readable wherever they are
+    FM2 = FileManager(providers, 4, 3, master_key, manifest_name)
+    with pytest.raises(exceptions.OperationFailure) as excinfo:
+        # the new provider doesn't hold the manifest
+        FM2.load_manifest(discard_extra_providers=True)
+    assert set(failure.provider for failure in excinfo.value.failures) == set([providers[-1]])
+    assert FM2.providers == providers[0:4]
+    for name, data in files:
+        assert FM2.get(name) == data
+    copied = [name for name, _ in files if FM2.manifest.get(name).layout is not None]
+    assert len(copied) == 2
+    code_names = dict((name, FM2.get_code_name(name)) for name, _ in files)
+
+    # resuming only copies the remaining file
+    FM2.providers.append(providers[-1])
+    FM2.reset()
+    FM2.load_manifest()
+    for name, data in files:
+        assert FM2.get(name) == data
+        assert FM2.manifest.get(name).layout is None
+        assert (FM2.get_code_name(name) == code_names[name]) == (name in copied)
+    assert FM2.manifest.get_provider_strings() == [provider.uuid for provider in providers]
+
+
 def test_remove_provider_and_decrement_k():
     FM = FileManager(providers, 5, 4, master_key, manifest_name, setup=True)
     FM.load_manifest()
@@ -290,3 +379,485 @@ def test_path_generator():
     expected_paths = ["file1", "file2", "dir1", "dir1/file3", "dir1/dir2"]
 
     assert sorted(FM.path_generator()) == sorted(expected_paths)
+
+
+def test_versions():
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.load_manifest()
+
+    FM.put("file", "data")
+    FM.put("dir/file", "data")
+    versions = FM.versions()
+    assert sorted(versions) == ["dir", "dir/file", "file"]
+    assert versions["dir"] is None
+    assert versions["file"] is not None and versions["file"] != versions["dir/file"]
+    assert FM.versions(["file", "missing"]) == {"file": versions["file"]}
+
+    # the version changes when a file is written, and not when it is moved
+    FM.put("file", "new data")
+    assert FM.versions(["file"])["file"] != versions["file"]
+    FM.move("dir/file", "moved")
+    assert FM.versions(["moved"]) == {"moved": versions["dir/file"]}
+
+
+def test_holds_share():
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.load_manifest()
+    FM.distributor.CHUNK_SIZE = 16
+
+    FM.put("file", "data")
+    FM.put_stream("chunked", StringIO("x" * 40))
+    file_code_name = FM.get_code_name("file")
+    chunked_code_name = FM.get_code_name("chunked")
+    assert FM.holds_share(file_code_name)
+    assert FM.holds_share(chunked_code_name + "-2")
+    assert not FM.holds_share("missing")
+
+    # the shares of an overwritten file are no longer needed
+    FM.put("file", "new data")
+    assert not FM.holds_share(file_code_name)
+    assert FM.holds_share(FM.get_code_name("file"))
+
+
+def test_stream_roundtrip():
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.load_manifest()
+    FM.distributor.CHUNK_SIZE = 16
+
+    data = "some data that spans several chunks"
+    FM.put_stream("test", StringIO(data))
+    assert FM.ls("") == [{"name": "test", "is_directory": False, "size": len(data)}]
+    assert FM.manifest.get("test").num_chunks == 3
+
+    assert FM.get("test") == data
+    out = StringIO()
+    FM.get_stream("test", out)
+    assert out.getvalue() == data
+
+
+def test_stream_unchunked_file():
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.load_manifest()
+
+    FM.put("test", "data")
+    out = StringIO()
+    FM.get_stream("test", out)
+    assert out.getvalue() == "data"
+
+
+def test_stream_update_deletes_old_chunks():
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.load_manifest()
+    FM.distributor.CHUNK_SIZE = 16
+
+    FM.put_stream("test", StringIO("x" * 40))
+    old_file_code_name = FM.manifest.get("test").code_name
+
+    FM.put("test", "newdata")
+    assert FM.get("test") == "newdata"
+    for provider in providers:
+        for index in xrange(3):
+            with pytest.raises(exceptions.ProviderOperationFailure):
+                provider.get(old_file_code_name + "-" + str(index))
+
+
+def test_stream_reset():
+    FM = FileManager(providers[0:4], 4, 3, master_key, manifest_name, setup=True)
+    FM.load_manifest()
+    FM.distributor.CHUNK_SIZE = 16
+
+    FM.put_stream("test", StringIO("y" * 40))
+
+    FM.providers.append(providers[-1])
+    FM.reset()
+
+    FM.load_manifest()
+    assert FM.get("test") == "y" * 40
+    assert FM.manifest.get("test").chunk_size == 16
+
+
+def test_corrupt_share_rejected_by_digest():
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.load_manifest()
+
+    FM.put("test", "data")
+    code_name = FM.manifest.get("test").code_name
+    assert len(FM.manifest.get("test").digests) == len(providers)
+
+    share = providers[1].get(code_name)
+    providers[1].put(code_name, share[:-1] + chr(ord(share[-1]) ^ 1))
+
+    with pytest.raises(exceptions.OperationFailure) as excinfo:
+        FM.get("test")
+    assert excinfo.value.result == "data"
+    assert [f.provider for f in excinfo.value.failures] == [providers[1]]
+
+
+def test_cached_manifest_skips_download(tmpdir, monkeypatch):
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True,
+                     manifest_cache=ManifestCache(str(tmpdir)))
+    FM.put("test", "data")
+
+    # a fresh client with the same on-disk cache only has to fetch the changes since the cached snapshot
+    FM2 = FileManager(providers, len(providers), 3, master_key, manifest_name,
+                      manifest_cache=ManifestCache(str(tmpdir)))
+
+    fetched = []
+
+    def recording_get(filename, *args):
+        fetched.append(filename)
+        return get(filename, *args)
+    get = FM2.distributor.get
+    monkeypatch.setattr(FM2.distributor, "get", recording_get)
+    FM2.load_manifest()
+    assert FM2.ls("") == [{"name": "test", "is_directory": False, "size": 4}]
+    assert fetched == [FM2._delta_name(1, 0)]
+
+    # the delta was added to the cache, so a third client doesn't fetch anything
+    FM3 = FileManager(providers, len(providers), 3, master_key, manifest_name,
+                      manifest_cache=ManifestCache(str(tmpdir)))
+
+    def no_get(*args):
+        assert False
+    monkeypatch.setattr(FM3.distributor, "get", no_get)
+    FM3.load_manifest()
+    assert FM3.ls("") == [{"name": "test", "is_directory": False, "size": 4}]
+
+
+def test_cached_manifest_reloads_after_change(tmpdir):
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True,
+                     manifest_cache=ManifestCache(str(tmpdir.mkdir("first"))))
+    FM2 = FileManager(providers, len(providers), 3, master_key, manifest_name,
+                      manifest_cache=ManifestCache(str(tmpdir.mkdir("second"))))
+    FM2.load_manifest()
+    assert FM2.ls("") == []
+
+    FM.load_manifest()
+    FM.put("test", "data")
+
+    FM2.load_manifest()
+    assert FM2.get("test") == "data"
+
+
+def test_stale_manifest_head(tmpdir):
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True,
+                     manifest_cache=ManifestCache(str(tmpdir)))
+    stale_head = providers[0].get(FM._head_name())
+    FM.put("test", "data")
+    providers[0].put(FM._head_name(), stale_head)
+
+    with pytest.raises(exceptions.OperationFailure) as excinfo:
+        FM.load_manifest()
+    assert [f.provider for f in excinfo.value.failures] == [providers[0]]
+    assert FM.get("test") == "data"
+
+
+def test_manifest_head_split():
+    FM = FileManager(providers[:4], 4, 3, master_key, manifest_name, setup=True)
+    FM.put("old", "data")
+    old_head = providers[0].get(FM._head_name())
+    FM.put("new", "data")
+    # a head write that only reached half the providers
+    for provider in providers[:2]:
+        provider.put(FM._head_name(), old_head)
+
+    FM2 = FileManager(providers[:4], 4, 3, master_key, manifest_name)
+    with pytest.raises(exceptions.OperationFailure) as excinfo:
+        FM2.load_manifest()
+    assert sorted(f.provider for f in excinfo.value.failures) == sorted(providers[:2])
+    assert FM2.get("new") == "data"
+
+
+def test_manifest_head_without_record():
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.put("old", "data")
+    FM.put("new", "data")
+    # the record written alongside the newest head didn't reach enough providers
+    for provider in providers[:3]:
+        provider.delete(FM._delta_name(FM.manifest.generation, FM.manifest_deltas - 1))
+
+    FM2 = FileManager(providers, len(providers), 3, master_key, manifest_name)
+    with pytest.raises(exceptions.OperationFailure):
+        FM2.load_manifest()
+    assert FM2.get("old") == "data"
+    with pytest.raises(exceptions.FileNotFound):
+        FM2.get("new")
+
+
+def test_manifest_head_without_quorum(tmpdir):
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True,
+                     manifest_cache=ManifestCache(str(tmpdir)))
+    FM.put("test", "data")
+    # n - k + 1 providers lose their head, so no head is held by k providers
+    for provider in providers[:3]:
+        provider.put(FM._head_name(), "garbage")
+
+    FM2 = FileManager(providers, len(providers), 3, master_key, manifest_name,
+                      manifest_cache=ManifestCache(str(tmpdir)))
+    with pytest.raises(exceptions.FatalOperationFailure) as excinfo:
+        FM2.load_manifest()
+    assert sorted(f.provider for f in excinfo.value.failures) == sorted(providers[:3])
+
+
+def test_manifest_without_heads():
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    # a manifest from before heads were written is loaded from its snapshot
+    for provider in providers:
+        provider.delete(FM._head_name())
+
+    FM2 = FileManager(providers, len(providers), 3, master_key, manifest_name)
+    FM2.load_manifest()
+    assert FM2.ls("") == []
+
+
+def test_manifest_changes_are_deltas(monkeypatch):
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.put("test", "data")
+    FM.mk_dir("dir")
+    FM.move("test", "dir/moved")
+    FM.put("other", "data2")
+    FM.delete("other")
+
+    # the snapshot written at setup is never rewritten
+    def no_snapshot(filename, *args):
+        assert filename != manifest_name
+        return put(filename, *args)
+    put = FM.distributor.put
+    monkeypatch.setattr(FM.distributor, "put", no_snapshot)
+    FM.mk_dir("dir2")
+
+    FM2 = FileManager(providers, len(providers), 3, master_key, manifest_name)
+    FM2.load_manifest()
+    assert FM2.manifest == FM.manifest
+    assert FM2.get("dir/moved") == "data"
+    assert FM2.manifest_deltas == 6
+
+
+def test_manifest_compaction():
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.COMPACTION_THRESHOLD = 3
+    for i in xrange(5):
+        FM.mk_dir("dir" + str(i))
+
+    # the fourth change was written as a snapshot, and the deltas it replaced were deleted
+    assert FM.manifest.generation == 2
+    assert FM.manifest_deltas == 1
+    wait(FM.delta_cleanup)
+    for provider in providers:
+        with pytest.raises(exceptions.ProviderOperationFailure):
+            provider.get(FM._delta_name(1, 0))
+
+    FM2 = FileManager(providers, len(providers), 3, master_key, manifest_name)
+    FM2.load_manifest()
+    assert FM2.manifest == FM.manifest
+
+
+def test_put_many(monkeypatch):
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.put("test", "old data")
+    old_code_name = FM.manifest.get("test").code_name
+
+    distributes = []
+
+    def counting_distribute(*args):
+        distributes.append(args)
+        return distribute(*args)
+    distribute = FM.distribute_manifest
+    monkeypatch.setattr(FM, "distribute_manifest", counting_distribute)
+
+    files = [("test", "data"), ("dir/test2", "data2"), ("dir/test2", "data3")]
+    FM.put_many(files)
+    assert len(distributes) == 1
+
+    assert FM.get("test") == "data"
+    assert FM.get("dir/test2") == "data3"
+    # the replaced file and the overridden duplicate were garbage collected
+    for provider in providers:
+        with pytest.raises(exceptions.ProviderOperationFailure):
+            provider.get(old_code_name)
+    # the snapshot, the head, two deltas and two files
+    assert len(os.listdir(os.path.join("tmp", "0", "daruma"))) == 6
+
+    FM2 = FileManager(providers, len(providers), 3, master_key, manifest_name)
+    FM2.load_manifest()
+    assert FM2.get("dir/test2") == "data3"
+
+
+def test_put_many_invalid_path():
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.put("file", "data")
+
+    with pytest.raises(exceptions.InvalidPath):
+        FM.put_many([("new", "data"), ("file/child", "data")])
+
+    FM.load_manifest()
+    with pytest.raises(exceptions.FileNotFound):
+        FM.get("new")
+    # nothing but the snapshot, the head, one delta and the original file is left on the providers
+    assert len(os.listdir(os.path.join("tmp", "0", "daruma"))) == 4
+
+
+def test_put_many_unexpected_error(monkeypatch):
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    put_with_digests = FM.distributor.put_with_digests
+
+    def failing_put(codename, data, *args, **kwargs):
+        if data == "bad":
+            raise ValueError("unexpected")
+        return put_with_digests(codename, data, *args, **kwargs)
+    monkeypatch.setattr(FM.distributor, "put_with_digests", failing_put)
+
+    # the error itself is raised, rather than hidden behind an AttributeError
+    with pytest.raises(ValueError):
+        FM.put_many([("good", "data"), ("bad", "bad")])
+    # and the upload that succeeded was deleted
+    assert len(os.listdir(os.path.join("tmp", "0", "daruma"))) == 2
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(chunking, "MIN_SIZE", 64)
+    monkeypatch.setattr(chunking, "AVG_SIZE", 256)
+    monkeypatch.setattr(chunking, "MAX_SIZE", 1024)
+
+
+def provider_files():
+    return set(os.listdir(os.path.join("tmp", "0", "daruma")))
+
+
+def test_deduplicated_roundtrip(small_chunks):
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.set_deduplication(True)
+    data = os.urandom(20000)
+    FM.put("test", data)
+    assert len(FM.manifest.get("test").blocks) > 1
+    assert FM.get("test") == data
+    assert FM.ls("test") == [{"name": "test", "is_directory": False, "size": 20000}]
+    out = StringIO()
+    FM.get_stream("test", out)
+    assert out.getvalue() == data
+
+    FM2 = FileManager(providers, len(providers), 3, master_key, manifest_name)
+    FM2.load_manifest()
+    assert FM2.get("test") == data
+
+
+def test_deduplicated_blocks_are_shared(small_chunks):
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.set_deduplication(True)
+    generator = random.Random(0)
+    data = "".join(chr(generator.randrange(256)) for _ in xrange(20000))
+    FM.put("test", data)
+    num_blocks = len(FM.manifest.blocks)
+
+    # a copy of a file uploads no blocks, and an edit only uploads the blocks around it
+    before = provider_files()
+    FM.put_many([("copy", data), ("dir/edited", data[:10000] + "edit" + data[10000:])])
+    assert 0 < len(FM.manifest.blocks) - num_blocks <= 3
+    # the new blocks, a delta record and nothing else
+    assert len(provider_files() - before) == len(FM.manifest.blocks) - num_blocks + 1
+    assert FM.get("copy") == data
+    assert FM.get("dir/edited") == data[:10000] + "edit" + data[10000:]
+
+    # blocks are deleted once no file refers to them
+    FM.delete("test")
+    FM.delete("dir")
+    assert len(FM.manifest.blocks) == num_blocks
+    FM.delete("copy")
+    assert len(FM.manifest.blocks) == 0
+    assert FM.ls("") == []
+    # only the manifest is left on the providers
+    for name in provider_files():
+        assert name.startswith(FM.manifest_name)
+
+
+def test_deduplicated_update_deletes_unused_blocks(small_chunks):
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.set_deduplication(True)
+    FM.put("test", os.urandom(5000))
+    old_code_names = [block["code_name"] for block in FM.manifest.blocks.values()]
+
+    FM.put("test", "new data")
+    assert FM.get("test") == "new data"
+    assert len(FM.manifest.blocks) == 1
+    for code_name in old_code_names:
+        with pytest.raises(exceptions.ProviderOperationFailure):
+            providers[0].get(code_name)
+
+    # a deduplicated file can be replaced by one with its own shares and back
+    FM.set_deduplication(False)
+    FM.put("test", "plain data")
+    assert FM.manifest.blocks == {}
+    FM.set_deduplication(True)
+    FM.put_stream("test", StringIO("blocks again"))
+    assert FM.get("test") == "blocks again"
+
+
+def test_deduplicated_damaged_block_is_uploaded_again(small_chunks):
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    FM.set_deduplication(True)
+    data = os.urandom(5000)
+    FM.put("test", data)
+    block_id = FM.manifest.get("test").blocks[0]
+    old_code_name = FM.manifest.get_block(block_id)["code_name"]
+    providers[0].put(old_code_name, "corrupt")
+
+    with pytest.raises(exceptions.OperationFailure) as excinfo:
+        FM.get("test")
+    assert excinfo.value.result == data
+    assert FM.damaged_blocks == set([block_id])
+
+    # putting the file again, as a repair does, replaces the damaged block
+    FM.put("test", data)
+    assert FM.manifest.get_block(block_id)["code_name"] != old_code_name
+    assert FM.damaged_blocks == set()
+    assert FM.get("test") == data
+
+
+def test_deduplicated_reset(small_chunks):
+    FM = FileManager(providers[0:4], 4, 3, master_key, manifest_name, setup=True)
+    FM.set_deduplication(True)
+    data = os.urandom(5000)
+    FM.put_many([("test", data), ("dir/copy", data)])
+    FM.set_deduplication(False)
+    FM.put("plain", "data")
+
+    FM.providers.append(providers[-1])
+    FM.reset()
+
+    FM.load_manifest()
+    assert FM.get("test") == data
+    assert FM.get("dir/copy") == data
+    assert FM.get("plain") == "data"
+    for block in FM.manifest.blocks.values():
+        assert "layout" not in block
+        assert len(providers[-1].get(block["code_name"])) > 0
+
+
+def test_put_delta(small_chunks):
+    FM = FileManager(providers, len(providers), 3, master_key, manifest_name, setup=True)
+    generator = random.Random(1)
+    data = "".join(chr(generator.randrange(256)) for _ in xrange(20000))
+    # the first version was stored with its own shares, so all of it is uploaded
+    FM.put("test", data)
+    FM.put_delta("test", StringIO(data))
+    assert FM.get("test") == data
+    num_blocks = len(FM.manifest.blocks)
+    assert num_blocks == len(FM.manifest.get("test").blocks)
+
+    # an edit only uploads the blocks around it, and the file points at the new blocks
+    edited = data[:5000] + "edit" + data[5000:]
+    before = provider_files()
+    FM.put_delta("test", StringIO(edited))
+    assert FM.get("test") == edited
+    new_files = provider_files() - before
+    # the new blocks and a delta record
+    assert 1 < len(new_files) <= 4
+    assert len(FM.manifest.blocks) == num_blocks
+
+    # putting the same contents again changes nothing
+    code_name = FM.get_code_name("test")
+    before = provider_files()
+    FM.put_delta("test", StringIO(edited))
+    assert provider_files() == before
+    assert FM.get_code_name("test") == code_name
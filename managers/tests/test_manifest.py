@@ -460,3 +460,186 @@ def test_dont_break_on_absolute_paths():
 
     with pytest.raises(exceptions.InvalidPath):
         manifest.get("/usr/bin/yes")
+
+
+def test_chunked_file_serialization():
+    manifest = Manifest()
+    manifest.update_file("BIG.ISO", codename1, 100, generate_key(), 30)
+    manifest.update_file("SMALL.TXT", codename2, 10, generate_key())
+
+    reconstructed_manifest = Manifest.deserialize(manifest.serialize())
+    assert manifest == reconstructed_manifest
+    assert reconstructed_manifest.get("BIG.ISO").chunk_size == 30
+    assert reconstructed_manifest.get("BIG.ISO").num_chunks == 4
+    assert reconstructed_manifest.get("SMALL.TXT").chunk_size is None
+    assert reconstructed_manifest.get("SMALL.TXT").num_chunks is None
+
+
+def test_digests_serialization():
+    manifest = Manifest()
+    manifest.update_file("FILE.TXT", codename1, 10, generate_key(), digests=["\x00\x01", "\xff\xfe"])
+
+    reconstructed_manifest = Manifest.deserialize(manifest.serialize())
+    assert manifest == reconstructed_manifest
+    assert reconstructed_manifest.get("FILE.TXT").digests == ["\x00\x01", "\xff\xfe"]
+
+
+def test_journal_replay():
+    manifest = Manifest()
+    manifest.update_file("dir/FILE.TXT", codename1, 10, generate_key(), digests=["\x00\x01"])
+    snapshot = manifest.serialize()
+    manifest.take_journal()
+
+    manifest.update_file("BIG.ISO", codename2, 100, generate_key(), 30)
+    manifest.create_directory("empty/dir")
+    manifest.move("dir", "empty/moved")
+    manifest.remove("empty/dir")
+    delta = Manifest.serialize_journal(manifest.take_journal())
+
+    reconstructed_manifest = Manifest.deserialize(snapshot)
+    reconstructed_manifest.apply_journal(delta)
+    assert manifest == reconstructed_manifest
+    assert reconstructed_manifest.get("BIG.ISO").chunk_size == 30
+    assert reconstructed_manifest.get("empty/moved/FILE.TXT").digests == ["\x00\x01"]
+    assert reconstructed_manifest.take_journal() == []
+
+
+def test_journal_skips_failed_changes():
+    manifest = Manifest()
+    manifest.update_file("file", codename1, 3, generate_key())
+    manifest.take_journal()
+
+    with pytest.raises(exceptions.InvalidPath):
+        manifest.remove("missing")
+    with pytest.raises(exceptions.InvalidPath):
+        manifest.update_file("file/child", codename2, 3, generate_key())
+    assert manifest.take_journal() == []
+
+
+def test_journal_replays_provider_changes():
+    cm = CredentialManager()
+    cm.load()
+    providers = []
+    for i in xrange(5):
+        providers.append(LocalFilesystemProvider(cm))
+        providers[-1].connect("tmp/" + str(i))
+
+    # the providers a manifest starts with are journaled like any later change
+    manifest = Manifest(providers[:3])
+    reconstructed_manifest = Manifest()
+    reconstructed_manifest.apply_journal(Manifest.serialize_journal(manifest.take_journal()))
+    assert reconstructed_manifest.providers == [provider.uuid for provider in providers[:3]]
+
+    snapshot = manifest.serialize()
+    manifest.set_providers(providers)
+    manifest.update_file("file", codename1, 3, generate_key())
+    delta = Manifest.serialize_journal(manifest.take_journal())
+
+    reconstructed_manifest = Manifest.deserialize(snapshot)
+    reconstructed_manifest.apply_journal(delta)
+    assert reconstructed_manifest.providers == [provider.uuid for provider in providers]
+    assert reconstructed_manifest == manifest
+
+
+def test_failed_move_is_reverted():
+    manifest = Manifest()
+    manifest.update_file("file", codename1, 3, generate_key())
+    manifest.update_file("dir/other", codename2, 3, generate_key())
+    node = manifest.get("dir")
+
+    with pytest.raises(exceptions.InvalidPath):
+        manifest.move("dir", "file/dir")
+    assert manifest.get("dir") == node
+
+
+def test_generation_serialization():
+    manifest = Manifest()
+    manifest.generation = 7
+    assert Manifest.deserialize(manifest.serialize()).generation == 7
+
+
+def test_layouts():
+    manifest = Manifest()
+    manifest.update_file("old", codename1, 3, generate_key())
+    snapshot = manifest.serialize()
+    manifest.take_journal()
+
+    providers = [("test", "a"), ("test", "b")]
+    manifest.add_layout("layout", providers, 2)
+    assert manifest.find_layout(providers, 2) == "layout"
+    assert manifest.find_layout(providers, 3) is None
+    manifest.update_file("new", codename2, 3, generate_key(), layout="layout")
+    assert manifest.get("new").layout == "layout"
+    assert manifest.get("old").layout is None
+    delta = Manifest.serialize_journal(manifest.take_journal())
+
+    # pending layouts survive serialization and journal replay
+    assert Manifest.deserialize(manifest.serialize()).layouts == manifest.layouts
+    reconstructed_manifest = Manifest.deserialize(snapshot)
+    reconstructed_manifest.apply_journal(delta)
+    assert reconstructed_manifest.find_layout(providers, 2) == "layout"
+    assert reconstructed_manifest.get("new").layout == "layout"
+
+    # a layout can only be adopted once every file uses it
+    with pytest.raises(exceptions.InvalidPath):
+        manifest.adopt_layout("layout")
+    manifest.update_file("old", codename3, 3, generate_key(), layout="layout")
+    manifest.adopt_layout("layout")
+    assert manifest.layouts == {}
+    assert manifest.get_provider_strings() == providers
+    assert manifest.get("old").layout is None
+    assert manifest.get("new").layout is None
+
+
+def test_blocks():
+    manifest = Manifest()
+    manifest.set_block_id_key(generate_key())
+    snapshot = manifest.serialize()
+    manifest.take_journal()
+
+    manifest.store_block("a", codename1, generate_key(), 3, ["digest"])
+    manifest.store_block("b", codename2, generate_key(), 3, ["digest"])
+    manifest.update_file("dir/file1", codename3, 6, None, blocks=["a", "b"])
+    manifest.update_file("file2", codename4, 6, None, blocks=["a", "a"])
+    assert manifest.get("dir/file1").blocks == ["a", "b"]
+    assert manifest.get_block("a")["refs"] == 3
+    assert manifest.get_block("b")["refs"] == 1
+    with pytest.raises(KeyError):
+        manifest.update_file("file3", codename5, 3, None, blocks=["c"])
+
+    # replacing a file releases its old blocks, but not the ones the new version still uses
+    manifest.update_file("file2", codename5, 3, None, blocks=["b"])
+    assert manifest.get_block("a")["refs"] == 1
+    assert manifest.get_block("b")["refs"] == 2
+    assert manifest.drop_unreferenced_blocks() == []
+
+    # removing a directory releases the blocks of the files under it
+    manifest.remove("dir")
+    dropped = manifest.drop_unreferenced_blocks()
+    assert [block["code_name"] for block in dropped] == [codename1]
+    assert manifest.get_block("a") is None
+    assert manifest.get_block("b")["refs"] == 1
+
+    # blocks survive serialization and journal replay
+    delta = Manifest.serialize_journal(manifest.take_journal())
+    assert Manifest.deserialize(manifest.serialize()).blocks == manifest.blocks
+    reconstructed_manifest = Manifest.deserialize(snapshot)
+    reconstructed_manifest.apply_journal(delta)
+    assert reconstructed_manifest.blocks == manifest.blocks
+    assert reconstructed_manifest.block_id_key == manifest.block_id_key
+
+
+def test_adopt_layout_with_blocks():
+    manifest = Manifest()
+    manifest.store_block("a", codename1, generate_key(), 3, ["digest"])
+    manifest.update_file("file", codename2, 3, None, blocks=["a"])
+    manifest.add_layout("layout", [("test", "a")], 1)
+
+    # deduplicated files have no shares of their own to copy, but their blocks do
+    with pytest.raises(exceptions.InvalidPath):
+        manifest.adopt_layout("layout")
+    old_block = manifest.store_block("a", codename3, generate_key(), 3, ["digest"], "layout")
+    assert old_block["code_name"] == codename1
+    assert manifest.get_block("a")["refs"] == 1
+    manifest.adopt_layout("layout")
+    assert "layout" not in manifest.get_block("a")
@@ -0,0 +1,65 @@
+from managers.ManifestCache import ManifestCache
+from tools.encryption import generate_key
+import os
+
+master_key = generate_key()
+version = "1:0"
+
+
+def test_roundtrip(tmpdir):
+    cache = ManifestCache(str(tmpdir))
+    assert cache.load("manifest", master_key) is None
+    cache.store("manifest", master_key, version, "content")
+    assert cache.load("manifest", master_key) == (version, "content")
+
+
+def test_persistent(tmpdir):
+    ManifestCache(str(tmpdir)).store("manifest", master_key, version, "content")
+    assert ManifestCache(str(tmpdir)).load("manifest", master_key) == (version, "content")
+
+
+def test_encrypted(tmpdir):
+    ManifestCache(str(tmpdir)).store("manifest", master_key, version, "content")
+    with open(os.path.join(str(tmpdir), "manifest"), "rb") as cache_file:
+        assert "content" not in cache_file.read()
+    assert ManifestCache(str(tmpdir)).load("manifest", generate_key()) is None
+
+
+def test_corrupt(tmpdir):
+    ManifestCache(str(tmpdir)).store("manifest", master_key, version, "content")
+    with open(os.path.join(str(tmpdir), "manifest"), "wb") as cache_file:
+        cache_file.write("garbage")
+    assert ManifestCache(str(tmpdir)).load("manifest", master_key) is None
+
+
+def test_invalidate(tmpdir):
+    cache = ManifestCache(str(tmpdir))
+    cache.store("manifest", master_key, version, "content")
+    cache.invalidate("manifest")
+    assert cache.load("manifest", master_key) is None
+    assert ManifestCache(str(tmpdir)).load("manifest", master_key) is None
+    # invalidating a missing entry does nothing
+    cache.invalidate("manifest")
+
+
+def test_clear(tmpdir):
+    cache = ManifestCache(str(tmpdir.join("cache")))
+    # clearing a cache that was never stored to does nothing
+    cache.clear()
+    cache.store("manifest", master_key, version, "content")
+    cache.store("other", master_key, version, "other content")
+    cache.clear()
+    assert cache.load("manifest", master_key) is None
+    assert cache.load("other", master_key) is None
+    assert os.listdir(str(tmpdir.join("cache"))) == []
+
+
+def test_clear_instance(tmpdir):
+    cache = ManifestCache(str(tmpdir), "instance")
+    other = cache.for_instance("other")
+    cache.store("manifest", master_key, version, "content")
+    other.store("manifest", master_key, version, "other content")
+    cache.clear()
+    assert cache.load("manifest", master_key) is None
+    # clearing one instance's entries leaves other instances sharing the directory alone
+    assert ManifestCache(str(tmpdir), "other").load("manifest", master_key) == (version, "other content")
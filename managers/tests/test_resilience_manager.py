@@ -3,7 +3,9 @@ from custom_exceptions import exceptions
 from managers.CredentialManager import CredentialManager
 from providers.TestProvider import TestProvider, TestProviderState
 from providers.BaseProvider import ProviderStatus
+from managers.ResilienceManager import ResilienceManager
 import pytest
+import threading
 
 
 cm = CredentialManager()
@@ -163,3 +165,105 @@ def test_attempt_repair_in_read_only():
     daruma, _ = Daruma.load(providers[:4])
 
     assert daruma.get("test") == "data"
+
+
+def test_provider_metrics():
+    daruma = Daruma.provision(providers, 3, 3)
+    daruma.put("test", "data")
+    metrics = daruma.get_provider_metrics()
+    assert set(metrics.keys()) == set(providers)
+    for summary in metrics.values():
+        assert summary["operations"] > 0
+        assert summary["slow"] is False
+
+
+def test_slow_providers():
+    daruma = Daruma.provision(providers, 3, 3)
+    for provider in providers:
+        provider.metrics.samples.clear()
+        latency = 1 if provider is providers[2] else 0.01
+        for i in xrange(ResilienceManager.MIN_LATENCY_SAMPLES):
+            provider.metrics.record("get", latency, 10, True)
+
+    assert daruma.resilience_manager.slow_providers() == [providers[2]]
+    assert daruma.resilience_manager.rank_providers()[-1] == providers[2]
+    assert daruma.get_provider_metrics()[providers[2]]["slow"]
+
+
+def test_plan_reads():
+    daruma = Daruma.provision(providers, 3, 3, latency_aware_reads=True)
+    daruma.put("test", "data")
+    for provider in providers:
+        provider.metrics.samples.clear()
+        latency = 1 if provider is providers[0] else 0.01
+        for i in xrange(ResilienceManager.MIN_LATENCY_SAMPLES):
+            provider.metrics.record("get", latency, 10, True)
+    providers[1].set_state(TestProviderState.FAILING)
+    providers[1].score = 0
+
+    plan = daruma.resilience_manager.plan_reads(providers)
+    assert [provider for provider, _ in plan][-2:] == [providers[0], providers[1]]
+    assert dict(plan)[providers[2]] == ResilienceManager.MIN_HEDGE_DELAY
+    assert dict(plan)[providers[0]] == 1
+
+    assert daruma.get("test") == "data"
+
+
+def test_quorum_write_repairs_lagging_provider(monkeypatch):
+    monkeypatch.setattr(ResilienceManager, "REPAIR_BACKOFF", 0.01)
+    daruma = Daruma.provision(providers, 3, 3, write_margin=1)
+    # fail the file upload, but not its retry
+    providers[0].set_state(TestProviderState.FAILING, 2)
+
+    daruma.put("test", "data")
+    assert daruma.resilience_manager.wait_for_repairs(5)
+    assert daruma.resilience_manager.pending_repairs() == 0
+
+    # check that the 0th provider holds its share
+    providers[3].set_state(TestProviderState.OFFLINE)
+    providers[4].set_state(TestProviderState.OFFLINE)
+    assert daruma.get("test") == "data"
+
+
+def test_repairs_skip_shares_no_longer_needed(monkeypatch):
+    monkeypatch.setattr(ResilienceManager, "REPAIR_BACKOFF", 0.01)
+    daruma = Daruma.provision(providers, 3, 3, write_margin=1)
+    daruma.put("test", "data")
+    code_name = daruma.file_manager.get_code_name("test")
+
+    failure = exceptions.ProviderOperationFailure(providers[0])
+    daruma.resilience_manager.queue_repair(providers[0], "overwritten", "share", failure)
+    daruma.resilience_manager.queue_repair(providers[0], code_name, "share", failure)
+    assert daruma.resilience_manager.wait_for_repairs(5)
+
+    assert providers[0].get(code_name) == "share"
+    with pytest.raises(exceptions.ProviderOperationFailure):
+        providers[0].get("overwritten")
+
+
+def test_pending_repairs_bounded_by_size(monkeypatch):
+    monkeypatch.setattr(ResilienceManager, "MAX_PENDING_REPAIR_BYTES", 10)
+    daruma = Daruma.provision(providers, 3, 3, write_margin=1)
+    resilience_manager = daruma.resilience_manager
+    # hold the repairs until every one has been queued
+    release = threading.Event()
+    resilience_manager.set_share_check(lambda share_name: release.wait(5))
+
+    failure = exceptions.ProviderOperationFailure(providers[0])
+    resilience_manager.queue_repair(providers[0], "first", "x" * 8, failure)
+    resilience_manager.queue_repair(providers[0], "too big", "x" * 8, failure)
+    assert resilience_manager.pending_repairs() == 1
+    resilience_manager.queue_repair(providers[0], "second", "x" * 2, failure)
+    assert resilience_manager.pending_repairs() == 2
+
+    release.set()
+    assert resilience_manager.wait_for_repairs(5)
+    assert providers[0].get("first") == "x" * 8
+    assert providers[0].get("second") == "x" * 2
+    with pytest.raises(exceptions.ProviderOperationFailure):
+        providers[0].get("too big")
+
+
+def test_invalid_write_margin():
+    with pytest.raises(ValueError):
+        Daruma.provision(providers, 3, 3, write_margin=-1)
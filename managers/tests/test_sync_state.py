@@ -0,0 +1,97 @@
+from managers.SyncState import SyncState, FileState, hash_file
+import hashlib
+import os
+import sqlite3
+import pytest
+
+
+@pytest.fixture
+def sync_state(tmpdir):
+    state = SyncState(str(tmpdir.join("state", "sync_state.db")))
+    yield state
+    state.close()
+
+
+def test_record_and_get(sync_state):
+    assert sync_state.get("a") is None
+    sync_state.record("a", 1.5, 10, "hash", "code")
+    assert sync_state.get("a") == FileState(1.5, 10, "hash", "code")
+    sync_state.record("a", 2.5, 11, None, None)
+    assert sync_state.get("a") == FileState(2.5, 11, None, None)
+    assert sync_state.items() == {"a": FileState(2.5, 11, None, None)}
+
+
+def test_remove_directory(sync_state):
+    sync_state.record_many([("dir", 0, 0, None, None), ("dir/a", 0, 0, None, None), ("dir/sub/b", 0, 0, None, None),
+                            ("directory", 0, 0, None, None)])
+    sync_state.remove("dir")
+    assert sync_state.paths() == ["directory"]
+
+
+def test_move(sync_state):
+    sync_state.record_many([("dir/a", 1, 1, "a", "1"), ("dir/sub/b", 2, 2, "b", "2"), ("directory", 3, 3, "c", "3"),
+                            ("new/stale", 4, 4, "d", "4")])
+    sync_state.move("dir", "new")
+    assert sorted(sync_state.paths()) == ["directory", "new/a", "new/sub/b"]
+    assert sync_state.get("new/sub/b") == FileState(2, 2, "b", "2")
+
+
+def test_non_ascii_paths(sync_state):
+    directory = "\xe2\x98\x83\xff"
+    sync_state.record_many([(directory + "/a", 0, 0, None, None), ("other", 0, 0, None, None)])
+    sync_state.move(directory, "moved")
+    assert sorted(sync_state.paths()) == ["moved/a", "other"]
+    sync_state.move("moved", directory)
+    sync_state.remove(directory)
+    assert sync_state.paths() == ["other"]
+
+
+def test_persistent(tmpdir):
+    db_path = str(tmpdir.join("sync_state.db"))
+    state = SyncState(db_path)
+    state.record("a", 1, 2, "hash", "code")
+    state.close()
+    state = SyncState(db_path)
+    assert state.get("a") == FileState(1, 2, "hash", "code")
+    state.clear()
+    assert state.paths() == []
+    state.close()
+
+
+def test_set_code_names(sync_state):
+    sync_state.record_many([("a", 1, 1, "a", "old"), ("b", 2, 2, "b", "kept")])
+    sync_state.set_code_names({"a": "new", "unrecorded": "code"})
+    assert sync_state.items() == {"a": FileState(1, 1, "a", "new"), "b": FileState(2, 2, "b", "kept")}
+
+
+def test_claim(sync_state):
+    assert not sync_state.claim("instance")
+    sync_state.record("a", 1, 1, None, "code")
+    assert sync_state.claim("instance")
+    assert sync_state.paths() == ["a"]
+    # files synced with another instance are forgotten
+    assert not sync_state.claim("other instance")
+    assert sync_state.paths() == []
+    assert sync_state.claim("other instance")
+
+
+def test_adds_code_names_to_old_database(tmpdir):
+    db_path = str(tmpdir.join("sync_state.db"))
+    connection = sqlite3.connect(db_path)
+    connection.execute("CREATE TABLE files (path TEXT PRIMARY KEY, mtime REAL NOT NULL, size INTEGER NOT NULL, hash TEXT)")
+    connection.execute("INSERT INTO files VALUES ('a', 1, 2, 'hash')")
+    connection.commit()
+    connection.close()
+
+    state = SyncState(db_path)
+    assert state.get("a") == FileState(1, 2, "hash", None)
+    state.record("b", 3, 4, None, "code")
+    assert state.get("b") == FileState(3, 4, None, "code")
+    state.close()
+
+
+def test_hash_file(tmpdir):
+    data = os.urandom(3 * 1024 * 1024 + 5)
+    path = tmpdir.join("file")
+    path.write(data, mode="wb")
+    assert hash_file(str(path)) == hashlib.sha256(data).hexdigest()
@@ -1,7 +1,10 @@
 import logging
+from collections import deque
 from tools.utils import APP_NAME
 from custom_exceptions import exceptions
-from tools.utils import run_parallel
+from tools.utils import run_parallel, ConcurrencyLimiter
+from tools import tracing
+from tools.metrics import ProviderMetrics
 
 logger = logging.getLogger("daruma")
 
@@ -19,9 +22,21 @@ class ProviderStatus:
 class BaseProvider(object):
     """
     Stub for a provider
+    Subclasses implement the blocking operations (get, put, delete, wipe); the asynchronous ones (get_async, etc.)
+    run them on a thread pool through _dispatch
     """
     RED_THRESHOLD = .5
     YELLOW_THRESHOLD = .95
+    # the most operations to run on this provider at once; any more wait their turn
+    MAX_CONCURRENT_REQUESTS = 8
+    # the most seconds an operation may take once its turn comes, before it fails with a TimeoutFailure, so a hung
+    # request can't stall the operation waiting on it; None to wait forever
+    OPERATION_TIMEOUT = 60
+    # the same for puts, which by default wait forever: a put that timed out would keep running, and could land
+    # after a later put of the same file (e.g. the manifest head), and how long a put takes grows with its size
+    PUT_TIMEOUT = None
+    # the number of recent errors to keep for diagnosis
+    ERROR_LOG_SIZE = 64
 
     ROOT_DIR = APP_NAME
 
@@ -64,11 +79,15 @@ class BaseProvider(object):
         Args: credential_manager, a credential_manager to store user credentials
         """
         self.credential_manager = credential_manager
+        self.request_limiter = ConcurrencyLimiter(self.MAX_CONCURRENT_REQUESTS,
+                                                  timeout_error=lambda: exceptions.TimeoutFailure(self))
         # metadata for diagnosis
         # TODO maybe factor this out into a provider manager?
         # TODO maybe get this score from a cached file if available?
         self.score = 1
-        self.error_log = []
+        self.error_log = deque(maxlen=self.ERROR_LOG_SIZE)
+        # the latency, size and outcome of recent operations
+        self.metrics = ProviderMetrics()
 
         # whether the system is currently authenticated
         self.authenticated = True
@@ -108,6 +127,66 @@ class BaseProvider(object):
         """
         raise NotImplementedError
 
+    def _dispatch(self, timeout, function, *args):
+        """
+        Start running a blocking provider operation on the process-wide I/O executor, running at most
+        MAX_CONCURRENT_REQUESTS operations at once and failing any that take longer than timeout seconds once
+        started with a TimeoutFailure
+        Every provider's SDK only offers blocking calls, so every provider goes through this adapter; a provider
+        with a native asynchronous API could override it
+        Returns a future for the result of function(*args)
+        """
+        return self.request_limiter.submit_with_timeout(timeout, function, *args)
+
+    def _instrumented(self, operation, function, size=0, result_bytes=False):
+        """
+        Returns function, recording each call in the provider's metrics, and as a span if tracing is enabled
+        Args:
+            operation: the name of the operation, e.g. "get"
+            function: the function performing the operation
+            size: the number of bytes sent
+            result_bytes: whether the length of the function's result is the number of bytes received
+        """
+        function = self.metrics.timed(operation, function, size, result_bytes)
+        if not tracing.enabled():
+            return function
+        attributes = {"provider": self.uid}
+        if size > 0:
+            attributes["bytes"] = size
+        return tracing.wrap(function, "provider." + operation, result_bytes, **attributes)
+
+    def get_async(self, filename):
+        """
+        Starts getting a file from the provider
+        Args: filename, the file to retrieve
+        Returns: a future for the result of get
+        """
+        return self._dispatch(self.OPERATION_TIMEOUT, self._instrumented("get", self.get, result_bytes=True), filename)
+
+    def put_async(self, filename, data):
+        """
+        Starts putting a file on the provider
+        Args: filename, the file to put
+              data, the content of the file
+        Returns: a future for the result of put
+        """
+        return self._dispatch(self.PUT_TIMEOUT, self._instrumented("put", self.put, len(data)), filename, data)
+
+    def delete_async(self, filename):
+        """
+        Starts deleting a file from the provider
+        Args: filename, the file to delete
+        Returns: a future for the result of delete
+        """
+        return self._dispatch(self.OPERATION_TIMEOUT, self._instrumented("delete", self.delete), filename)
+
+    def wipe_async(self):
+        """
+        Starts deleting all files on the provider
+        Returns: a future for the result of wipe
+        """
+        return self._dispatch(self.OPERATION_TIMEOUT, self._instrumented("wipe", self.wipe))
+
     # TODO ls?
 
     def log_error(self, exception):
@@ -0,0 +1,218 @@
+import math
+import os
+import random
+import threading
+import time
+from custom_exceptions import exceptions
+from providers.LocalFilesystemProvider import LocalFilesystemProvider
+
+
+class FixedLatency(object):
+    """
+    Every request takes the same time
+    """
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+    def sample(self):
+        return self.seconds
+
+
+class UniformLatency(object):
+    """
+    Request times are spread evenly between low and high seconds
+    """
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+
+    def sample(self):
+        return random.uniform(self.low, self.high)
+
+
+class LogNormalLatency(object):
+    """
+    Request times cluster around a median with a long tail of slow requests, as with real cloud APIs
+    """
+    def __init__(self, median, sigma):
+        """
+        Args:
+            median: the median request time, in seconds
+            sigma: the spread of the distribution; the 99th percentile is about median * e^(2.3 * sigma)
+        """
+        self.median = median
+        self.sigma = sigma
+
+    def sample(self):
+        return random.lognormvariate(math.log(self.median), self.sigma)
+
+
+class TokenBucket(object):
+    """
+    Allows rate requests per second on average, with bursts of up to burst requests
+    """
+    def __init__(self, rate, burst):
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last_refill = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """
+        Take a token if one is available
+        Returns: 0 if a token was taken, otherwise the number of seconds until the next token is available
+        """
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+
+class SimulatedProvider(LocalFilesystemProvider):
+    """
+    A LocalFilesystemProvider that behaves like a remote cloud provider: requests take a sampled latency,
+    transfers share a capped amount of bandwidth, requests beyond a rate limit are throttled,
+    and writes may take a while to become visible to reads
+    """
+    # rough approximations of the behaviour of real providers, as keyword arguments to the constructor
+    CLOUD_PROFILES = {
+        "dropbox": dict(latency=LogNormalLatency(0.25, 0.5), bandwidth=8 * 1024 * 1024,
+                        requests_per_second=10, burst=20),
+        "googledrive": dict(latency=LogNormalLatency(0.3, 0.6), bandwidth=10 * 1024 * 1024,
+                            requests_per_second=10, burst=10, consistency_window=1),
+        "onedrive": dict(latency=LogNormalLatency(0.35, 0.7), bandwidth=6 * 1024 * 1024,
+                         requests_per_second=5, burst=15, consistency_window=2)
+    }
+
+    @classmethod
+    def provider_identifier(cls):
+        return "simulated"
+
+    @classmethod
+    def provider_name(cls):
+        return "Simulated Cloud"
+
+    @classmethod
+    def from_profile(cls, credential_manager, profile_name, **kwargs):
+        """
+        Create a SimulatedProvider that behaves like one of CLOUD_PROFILES
+        Args:
+            credential_manager: a credential_manager to store user credentials
+            profile_name: a key of CLOUD_PROFILES
+            kwargs: any settings to override from the profile
+        """
+        settings = dict(cls.CLOUD_PROFILES[profile_name])
+        settings.update(kwargs)
+        return cls(credential_manager, **settings)
+
+    def __init__(self, credential_manager, latency=None, bandwidth=None, requests_per_second=None, burst=1,
+                 consistency_window=0, failure_rate=0, max_concurrent_requests=None):
+        """
+        Args:
+            credential_manager: a credential_manager to store user credentials
+            latency: (optional) the distribution of the time each request takes before any data is transferred;
+                an object with a sample() method returning seconds. Defaults to no latency
+            bandwidth: (optional) the bytes per second shared by all of this provider's transfers; unlimited if None
+            requests_per_second: (optional) the sustained request rate, beyond which requests fail with a
+                RateLimitFailure; unlimited if None
+            burst: the number of requests that can be made at once before the rate limit applies
+            consistency_window: the most seconds after a put or delete during which gets may still see
+                the previous version of the file
+            failure_rate: the probability that a request fails with a ProviderOperationFailure
+            max_concurrent_requests: (optional) overrides MAX_CONCURRENT_REQUESTS for this provider
+        """
+        if max_concurrent_requests is not None:
+            self.MAX_CONCURRENT_REQUESTS = max_concurrent_requests
+        super(SimulatedProvider, self).__init__(credential_manager)
+        self.latency = latency if latency is not None else FixedLatency(0)
+        self.bandwidth = bandwidth
+        self.rate_limiter = TokenBucket(requests_per_second, burst) if requests_per_second is not None else None
+        self.consistency_window = consistency_window
+        self.failure_rate = failure_rate
+
+        # the time at which the link will have finished every transfer started so far
+        self.link_free_at = 0
+        # map from filename to (time the latest write becomes visible, the content before it or None)
+        self.stale_versions = {}
+        self.lock = threading.Lock()
+
+    def _request(self, size=0):
+        """
+        Simulate the network part of a request that transfers size bytes
+        Raises:
+            RateLimitFailure if the request was throttled
+            ProviderOperationFailure if the request failed at random
+        """
+        if self.rate_limiter is not None:
+            retry_after = self.rate_limiter.take()
+            if retry_after > 0:
+                raise exceptions.RateLimitFailure(self, retry_after)
+
+        delay = self.latency.sample()
+        if self.bandwidth is not None and size > 0:
+            # transfers queue up behind one another on the provider's link
+            with self.lock:
+                start = max(time.time() + delay, self.link_free_at)
+                self.link_free_at = start + float(size) / self.bandwidth
+                delay = self.link_free_at - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+        if random.random() < self.failure_rate:
+            raise exceptions.ProviderOperationFailure(self)
+
+    def _record_write(self, filename):
+        """
+        Remember the current content of filename, which gets may keep returning during the consistency window
+        """
+        if self.consistency_window <= 0:
+            return
+        previous = None
+        if os.path.isfile(self._get_translated_filepath(filename)):
+            previous = super(SimulatedProvider, self).get(filename)
+        with self.lock:
+            if filename in self.stale_versions and self.stale_versions[filename][0] > time.time():
+                # an earlier write is still propagating; reads may see the version before it
+                previous = self.stale_versions[filename][1]
+            self.stale_versions[filename] = (time.time() + random.uniform(0, self.consistency_window), previous)
+
+    def get(self, filename):
+        with self.lock:
+            visible_at, previous = self.stale_versions.get(filename, (0, None))
+            if 0 < visible_at <= time.time():
+                del self.stale_versions[filename]
+        if time.time() < visible_at:
+            self._request(len(previous) if previous is not None else 0)
+            if previous is None:
+                raise exceptions.ProviderOperationFailure(self)
+            return previous
+
+        try:
+            result = super(SimulatedProvider, self).get(filename)
+        except exceptions.ProviderOperationFailure:
+            # a missing file still costs a round trip
+            self._request()
+            raise
+        self._request(len(result))
+        return result
+
+    def put(self, filename, data):
+        self._request(len(data))
+        self._record_write(filename)
+        super(SimulatedProvider, self).put(filename, data)
+
+    def delete(self, filename):
+        self._request()
+        self._record_write(filename)
+        super(SimulatedProvider, self).delete(filename)
+
+    def wipe(self):
+        self._request()
+        with self.lock:
+            self.stale_versions = {}
+        super(SimulatedProvider, self).wipe()
@@ -65,3 +65,18 @@ def test_multiple_sessions():
     providers, _ = LocalFilesystemProvider.load_cached_providers(cm)
     FS = providers[0]
     assert FS.get("file1") == "abc"
+
+
+def test_async_roundtrip():
+    FS = LocalFilesystemProvider(cm)
+    FS.connect("tmp")
+    assert FS.put_async("file1", "abc").result() is None
+    assert FS.get_async("file1").result() == "abc"
+
+    FS.delete_async("file1").result()
+    with pytest.raises(exceptions.ProviderOperationFailure):
+        FS.get_async("file1").result()
+
+    FS.put("file2", "def")
+    FS.wipe_async().result()
+    assert len(os.listdir("tmp/" + FS.ROOT_DIR)) == 0
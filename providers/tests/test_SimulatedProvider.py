@@ -0,0 +1,91 @@
+from providers.SimulatedProvider import SimulatedProvider, FixedLatency, LogNormalLatency, TokenBucket
+from providers.LocalFilesystemProvider import LocalFilesystemProvider
+from managers.CredentialManager import CredentialManager
+from custom_exceptions import exceptions
+import pytest
+import time
+
+cm = CredentialManager()
+cm.load()
+
+
+def teardown_function(function):
+    cm.clear_user_credentials()
+
+
+def make_provider(**kwargs):
+    provider = SimulatedProvider(cm, **kwargs)
+    provider.connect("tmp/simulated")
+    LocalFilesystemProvider.wipe(provider)
+    return provider
+
+
+def test_roundtrip():
+    provider = make_provider()
+    provider.put_async("file1", "abc").result()
+    assert provider.get_async("file1").result() == "abc"
+
+
+def test_latency():
+    provider = make_provider(latency=FixedLatency(0.05))
+    start = time.time()
+    provider.put("file1", "abc")
+    assert time.time() - start >= 0.05
+
+
+def test_bandwidth_is_shared():
+    provider = make_provider(bandwidth=100 * 1024)
+    start = time.time()
+    futures = [provider.put_async("file" + str(i), "a" * 10 * 1024) for i in xrange(2)]
+    for future in futures:
+        future.result()
+    # two 10 KiB transfers over a 100 KiB/s link take at least 0.2 seconds together
+    assert time.time() - start >= 0.2
+
+
+def test_rate_limit():
+    provider = make_provider(requests_per_second=1, burst=2)
+    provider.put("file1", "abc")
+    provider.put("file2", "abc")
+    with pytest.raises(exceptions.RateLimitFailure) as excinfo:
+        provider.get("file1")
+    assert excinfo.value.provider == provider
+    assert 0 < excinfo.value.retry_after <= 1
+
+
+def test_token_bucket_refills():
+    bucket = TokenBucket(100, 1)
+    assert bucket.take() == 0
+    assert bucket.take() > 0
+    time.sleep(0.02)
+    assert bucket.take() == 0
+
+
+def test_eventual_consistency():
+    provider = make_provider(consistency_window=60)
+    provider.put("file1", "old")
+    # the first version of the file may not be visible yet
+    with pytest.raises(exceptions.ProviderOperationFailure):
+        provider.get("file1")
+    provider.stale_versions.clear()
+    provider.put("file1", "new")
+    assert provider.get("file1") == "old"
+
+
+def test_consistency_window_expires():
+    provider = make_provider(consistency_window=0.05)
+    provider.put("file1", "abc")
+    time.sleep(0.05)
+    assert provider.get("file1") == "abc"
+
+
+def test_failure_rate():
+    provider = make_provider(failure_rate=1)
+    with pytest.raises(exceptions.ProviderOperationFailure):
+        provider.put("file1", "abc")
+
+
+def test_from_profile():
+    provider = SimulatedProvider.from_profile(cm, "dropbox", latency=LogNormalLatency(0.001, 0.1), max_concurrent_requests=2)
+    assert provider.bandwidth == SimulatedProvider.CLOUD_PROFILES["dropbox"]["bandwidth"]
+    assert provider.request_limiter.limit == 2
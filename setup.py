@@ -34,6 +34,10 @@ base_setup = dict(
             "wxPython==3.0.2.0",
             "wxPython-common==3.0.2.0"
         ],
+        "demo": [
+            "flask>=0.10.1",
+            "waitress>=1.0"
+        ],
         ":sys_platform == 'darwin'": [
             'pyobjc==3.0.4'
         ]
@@ -0,0 +1,118 @@
+"""
+Content-defined chunking with FastCDC
+
+A file is split wherever a rolling hash of its last few bytes matches a mask, so chunk boundaries depend only on
+nearby content: an insertion or deletion changes the chunks around it, and every other chunk of the file is the
+same as before. Identical regions of different files or different versions of a file give identical chunks,
+which are stored once.
+
+The hash is a gear hash (one shift and one add per byte). Boundaries are never placed in the first MIN_SIZE bytes
+of a chunk, a harder mask is used until AVG_SIZE bytes and an easier one after it, which keeps chunk sizes close
+to AVG_SIZE, and a chunk is always cut at MAX_SIZE.
+See Xia et al., "FastCDC: a Fast and Efficient Content-Defined Chunking Approach for Data Deduplication".
+"""
+import hashlib
+import struct
+from cStringIO import StringIO
+
+MIN_SIZE = 256 * 1024
+AVG_SIZE = 1024 * 1024
+MAX_SIZE = 4 * 1024 * 1024
+
+_HASH_BITS = 32
+_HASH_MASK = (1 << _HASH_BITS) - 1
+
+# a fixed table of random 32 bit values, one per byte value; it must never change, or the chunks of existing
+# files would no longer match the chunks of new ones
+GEAR = [struct.unpack("<I", hashlib.sha256("daruma gear " + str(i)).digest()[:4])[0] for i in xrange(256)]
+
+
+def _mask(bits):
+    # the highest bits of a gear hash depend on the most bytes
+    return ((1 << bits) - 1) << (_HASH_BITS - bits)
+
+
+def _sizes(min_size, avg_size, max_size):
+    return (MIN_SIZE if min_size is None else min_size, AVG_SIZE if avg_size is None else avg_size,
+            MAX_SIZE if max_size is None else max_size)
+
+
+def cut_point(data, min_size=None, avg_size=None, max_size=None):
+    """
+    Args:
+        data: a string, the start of the data left to chunk
+        min_size, avg_size, max_size: the smallest, target and largest size of a chunk;
+            MIN_SIZE, AVG_SIZE and MAX_SIZE by default
+    Returns:
+        the length of the first chunk of data
+    """
+    min_size, avg_size, max_size = _sizes(min_size, avg_size, max_size)
+    length = min(len(data), max_size)
+    if length <= min_size:
+        return length
+    bits = max(avg_size.bit_length() - 1, 3)
+    hard_mask = _mask(min(bits + 2, _HASH_BITS))
+    easy_mask = _mask(bits - 2)
+    normal_size = min(avg_size, length)
+
+    gear = GEAR
+    fingerprint = 0
+    position = min_size
+    window = bytearray(data[min_size:length])
+    for byte in window[:normal_size - min_size]:
+        fingerprint = ((fingerprint << 1) + gear[byte]) & _HASH_MASK
+        position += 1
+        if not fingerprint & hard_mask:
+            return position
+    for byte in window[normal_size - min_size:]:
+        fingerprint = ((fingerprint << 1) + gear[byte]) & _HASH_MASK
+        position += 1
+        if not fingerprint & easy_mask:
+            return position
+    return length
+
+
+def chunk_stream(stream, min_size=None, avg_size=None, max_size=None):
+    """
+    Args:
+        stream: a file-like object to read the data from
+        min_size, avg_size, max_size: the smallest, target and largest size of a chunk;
+            MIN_SIZE, AVG_SIZE and MAX_SIZE by default
+    Returns:
+        a generator of the chunks of the data, in order; at most max_size bytes of the data are buffered at once
+        besides the chunk being returned. Empty data has no chunks.
+    Raises:
+        ValueError if the sizes are inconsistent
+    """
+    min_size, avg_size, max_size = _sizes(min_size, avg_size, max_size)
+    if not 0 < min_size <= avg_size <= max_size:
+        raise ValueError("chunk sizes must satisfy 0 < min_size <= avg_size <= max_size")
+
+    def generate():
+        buffer = ""
+        end_of_stream = False
+        while True:
+            while not end_of_stream and len(buffer) < max_size:
+                block = stream.read(max_size - len(buffer))
+                if block == "":
+                    end_of_stream = True
+                else:
+                    buffer += block
+            if buffer == "":
+                return
+            length = cut_point(buffer, min_size, avg_size, max_size)
+            yield buffer[:length]
+            buffer = buffer[length:]
+    return generate()
+
+
+def chunk(data, min_size=None, avg_size=None, max_size=None):
+    """
+    Args:
+        data: a string
+        min_size, avg_size, max_size: the smallest, target and largest size of a chunk;
+            MIN_SIZE, AVG_SIZE and MAX_SIZE by default
+    Returns:
+        a list of the chunks of data, in order
+    """
+    return list(chunk_stream(StringIO(data), min_size, avg_size, max_size))
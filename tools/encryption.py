@@ -1,10 +1,14 @@
+import hashlib
+import hmac
 import logging
 import nacl.secret
 import nacl.utils
 import nacl.exceptions
 from custom_exceptions import exceptions
+from tools import tracing
 
 KEY_SIZE = nacl.secret.SecretBox.KEY_SIZE
+DIGEST_SIZE = hashlib.sha256().digest_size
 
 
 def generate_key():
@@ -22,6 +26,44 @@ def generate_key():
         raise exceptions.LibraryException
 
 
+def derive_key(key, context):
+    """
+    Deterministically derive a new secret key from an existing one, so that
+    one key can safely be used for several purposes.
+
+    Args:
+        key: a key returned by the generate_key function
+        context: a string identifying the purpose of the derived key; distinct
+            contexts yield independent keys
+    Returns:
+        A secret key suitable to be passed to the encrypt function.
+    """
+    return hmac.new(key, str(context), hashlib.sha256).digest()
+
+
+def keyed_digest(data, key):
+    """
+    Compute a message authentication code for some data.
+
+    Args:
+        data: a string or other byte representation of the data to authenticate.
+        key: a key returned by the generate_key or derive_key functions
+    Returns:
+        A DIGEST_SIZE byte string, which cannot be computed without the key.
+    """
+    return hmac.new(key, data, hashlib.sha256).digest()
+
+
+def verify_digest(data, digest, key):
+    """
+    Check a message authentication code computed by keyed_digest, in constant time.
+
+    Returns:
+        True if digest authenticates data under key, False otherwise.
+    """
+    return hmac.compare_digest(keyed_digest(data, key), digest)
+
+
 def encrypt(plaintext, key):
     """
     Encrypt the given plaintext with key generated with generate_key
@@ -35,13 +77,14 @@ def encrypt(plaintext, key):
         LibraryException: An exception occurred in the backing cryptographic library.
     """
     try:
-        box = nacl.secret.SecretBox(key)
+        with tracing.span("encryption.encrypt", bytes=len(plaintext)):
+            box = nacl.secret.SecretBox(key)
 
-        # A new random nonce is selected for each encryption - this may not be
-        # necessary, since we also generate new random keys for each encryption.
-        nonce = nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE)
+            # A new random nonce is selected for each encryption - this may not be
+            # necessary, since we also generate new random keys for each encryption.
+            nonce = nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE)
 
-        ciphertext = box.encrypt(plaintext, nonce)
+            ciphertext = box.encrypt(plaintext, nonce)
 
         return ciphertext
 
@@ -67,10 +110,11 @@ def decrypt(ciphertext, key):
         LibraryException: An exception occurred in the backing cryptographic library.
     """
     try:
-        box = nacl.secret.SecretBox(key)
+        with tracing.span("encryption.decrypt", bytes=len(ciphertext)):
+            box = nacl.secret.SecretBox(key)
 
-        # Note that the nonce is automatically bundled with the ciphertext
-        plaintext = box.decrypt(ciphertext)
+            # Note that the nonce is automatically bundled with the ciphertext
+            plaintext = box.decrypt(ciphertext)
 
         return plaintext
 
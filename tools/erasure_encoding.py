@@ -5,19 +5,32 @@ from pyeclib.ec_iface import ECInsufficientFragments
 from pyeclib.ec_iface import ECInvalidFragmentMetadata
 from pyeclib.ec_iface import ECDriverError
 from custom_exceptions import exceptions
-from tools.utils import sandbox_function
+from tools import tracing
+from tools.utils import SandboxPool
 
 EXIT_CODE_DECODE_ERROR = 2
 
+# The RS library runs in long-lived sandbox processes, so that we don't pay for
+# a fork (and a new ECDriver) on every call
+_sandbox_pool = SandboxPool()
+
+# ECDriver instances cached by (k, m); only ever populated inside the sandbox
+_ec_drivers = {}
+
 
 def _get_ecdriver(threshold, total_shares):
-    return ECDriver(k=threshold, m=total_shares - threshold, ec_type='liberasurecode_rs_vand')
+    k, m = threshold, total_shares - threshold
+    ec_driver = _ec_drivers.get((k, m))
+    if ec_driver is None:
+        ec_driver = ECDriver(k=k, m=m, ec_type='liberasurecode_rs_vand')
+        _ec_drivers[(k, m)] = ec_driver
+    return ec_driver
 
 
 def _do_sharing(message, threshold, total_shares):
     """
     This function calls into the RS C library and has a propensity to segfault.
-    Do NOT call it outside of the sandbox_function.
+    Do NOT call it outside of the sandbox.
     """
     ec_driver = _get_ecdriver(threshold, total_shares)
     shares = ec_driver.encode(message)
@@ -27,7 +40,7 @@ def _do_sharing(message, threshold, total_shares):
 def _do_reconstruction(shares, threshold, total_shares):
     """
     This function calls into the RS C library and has a propensity to segfault.
-    Do NOT call it outside of the sandbox_function.  Its peculiar return type
+    Do NOT call it outside of the sandbox.  Its peculiar return type
     and exit behavior are specific to the sandbox implementation.
     """
     try:
@@ -53,7 +66,8 @@ def share(message, threshold, total_shares):
         LibraryException: An exception occurred in the backing erasure encoding library.
     """
     try:
-        shares = sandbox_function(_do_sharing, message, threshold, total_shares)
+        with tracing.span("erasure_encoding.share", bytes=len(message), threshold=threshold, total_shares=total_shares):
+            shares = _sandbox_pool.run(_do_sharing, message, threshold, total_shares)
         return shares
     except exceptions.SandboxProcessFailure:
         logging.exception("Exception encountered during Reed-Solomon share creation")
@@ -78,7 +92,9 @@ def reconstruct(shares, threshold, total_shares):
         LibraryException: An exception occurred in the backing erasure encoding library.
     """
     try:
-        message = sandbox_function(_do_reconstruction, shares, threshold, total_shares)
+        with tracing.span("erasure_encoding.reconstruct", threshold=threshold, total_shares=total_shares) as current:
+            message = _sandbox_pool.run(_do_reconstruction, shares, threshold, total_shares)
+            current.set("bytes", len(message[0]))
         return message[0]
     except exceptions.SandboxProcessFailure as e:
         if e.exitcode is EXIT_CODE_DECODE_ERROR or e.exitcode < 0:
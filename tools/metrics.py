@@ -0,0 +1,83 @@
+import math
+import time
+from collections import deque, namedtuple
+
+# one provider operation: when it finished, what it was, how long it took, how much data it moved, and whether it worked
+Sample = namedtuple("Sample", ["timestamp", "operation", "seconds", "bytes", "succeeded"])
+
+
+def percentile(values, fraction):
+    """
+    Args:
+        values: a non-empty list of numbers
+        fraction: the percentile to find, between 0 and 1
+    Returns:
+        the smallest value that is at least as large as the given fraction of the values (nearest rank)
+    """
+    ordered = sorted(values)
+    rank = max(int(math.ceil(fraction * len(ordered))), 1)
+    return ordered[rank - 1]
+
+
+class ProviderMetrics(object):
+    """
+    The outcomes of a provider's most recent operations
+    Only the last WINDOW operations are kept, so memory use is bounded and the statistics follow the provider's
+    current behaviour. Recording is a single deque append, which is atomic, so no lock is needed.
+    """
+    WINDOW = 256
+
+    def __init__(self, window=WINDOW):
+        self.samples = deque(maxlen=window)
+
+    def record(self, operation, seconds, size, succeeded):
+        """
+        Args:
+            operation: the name of the operation, e.g. "get"
+            seconds: how long the operation took
+            size: the number of bytes transferred
+            succeeded: whether the operation completed without an error
+        """
+        self.samples.append(Sample(time.time(), operation, seconds, size, succeeded))
+
+    def timed(self, operation, function, size=0, result_bytes=False):
+        """
+        Args:
+            operation: the name of the operation, e.g. "get"
+            function: the function performing the operation
+            size: the number of bytes sent
+            result_bytes: whether to count the length of the function's result as bytes received
+        Returns: a function that calls function and records its outcome
+        """
+        def timed_function(*args):
+            start = time.time()
+            try:
+                result = function(*args)
+            except Exception:
+                self.record(operation, time.time() - start, 0, False)
+                raise
+            self.record(operation, time.time() - start, len(result) if result_bytes else size, True)
+            return result
+        return timed_function
+
+    def summary(self):
+        """
+        Returns: a dict of statistics over the recorded operations:
+            operations: the number of operations recorded
+            failure_rate: the fraction of them that failed
+            p50_latency, p95_latency: the median and 95th percentile time of successful operations, in seconds
+            throughput: bytes per second over successful transfers
+            Statistics with no operations to measure are None
+        """
+        samples = list(self.samples)
+        succeeded = [sample for sample in samples if sample.succeeded]
+        latencies = [sample.seconds for sample in succeeded]
+        transfers = [sample for sample in succeeded if sample.bytes > 0]
+        transfer_time = sum(sample.seconds for sample in transfers)
+        return {
+            "operations": len(samples),
+            "failure_rate": float(len(samples) - len(succeeded)) / len(samples) if len(samples) > 0 else None,
+            "p50_latency": percentile(latencies, 0.5) if len(latencies) > 0 else None,
+            "p95_latency": percentile(latencies, 0.95) if len(latencies) > 0 else None,
+            "throughput": sum(sample.bytes for sample in transfers) / transfer_time if transfer_time > 0 else None
+        }
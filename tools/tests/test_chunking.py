@@ -0,0 +1,61 @@
+from tools import chunking
+from StringIO import StringIO
+import os
+import random
+import pytest
+
+# small sizes, so tests chunk little data
+SIZES = dict(min_size=64, avg_size=256, max_size=1024)
+
+
+def seeded_data(size, seed=0):
+    generator = random.Random(seed)
+    return "".join(chr(generator.randrange(256)) for _ in xrange(size))
+
+
+def test_roundtrip():
+    data = os.urandom(50000)
+    chunks = chunking.chunk(data, **SIZES)
+    assert "".join(chunks) == data
+    assert len(chunks) > 1
+    assert all(64 <= len(chunk) <= 1024 for chunk in chunks[:-1])
+    assert 0 < len(chunks[-1]) <= 1024
+
+
+def test_empty():
+    assert chunking.chunk("", **SIZES) == []
+
+
+def test_small_data_is_one_chunk():
+    assert chunking.chunk("data", **SIZES) == ["data"]
+
+
+def test_deterministic():
+    data = os.urandom(20000)
+    assert chunking.chunk(data, **SIZES) == chunking.chunk(data, **SIZES)
+
+
+def test_uniform_data_is_cut_at_max_size():
+    chunks = chunking.chunk("\0" * 5000, **SIZES)
+    assert map(len, chunks) == [1024] * 4 + [904]
+
+
+def test_edit_only_changes_nearby_chunks():
+    data = seeded_data(50000)
+    edited = data[:25000] + "inserted" + data[25000:]
+    chunks = chunking.chunk(data, **SIZES)
+    edited_chunks = chunking.chunk(edited, **SIZES)
+    new_chunks = set(edited_chunks) - set(chunks)
+    # the boundaries resynchronize after the insertion, so almost every chunk is unchanged
+    assert 0 < len(new_chunks) <= 3
+    assert sum(len(chunk) for chunk in new_chunks) < 3 * 1024 + len("inserted")
+
+
+def test_stream_matches_string():
+    data = os.urandom(20000)
+    assert list(chunking.chunk_stream(StringIO(data), **SIZES)) == chunking.chunk(data, **SIZES)
+
+
+def test_invalid_sizes():
+    with pytest.raises(ValueError):
+        chunking.chunk_stream(StringIO("data"), min_size=512, avg_size=256, max_size=1024)
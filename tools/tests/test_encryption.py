@@ -53,3 +53,28 @@ def test_short_encryption_key():
 
     with pytest.raises(exceptions.LibraryException):
         tools.encryption.encrypt(plaintext, short_key)
+
+
+def test_derive_key():
+    key = tools.encryption.generate_key()
+    derived_key = tools.encryption.derive_key(key, "context")
+
+    assert len(derived_key) == tools.encryption.KEY_SIZE
+    assert derived_key == tools.encryption.derive_key(key, "context")
+    assert derived_key != tools.encryption.derive_key(key, "other context")
+    assert derived_key != tools.encryption.derive_key(tools.encryption.generate_key(), "context")
+
+    ciphertext = tools.encryption.encrypt("FOO BAR WOOHOO!", derived_key)
+    assert tools.encryption.decrypt(ciphertext, derived_key) == "FOO BAR WOOHOO!"
+    with pytest.raises(exceptions.DecryptError):
+        tools.encryption.decrypt(ciphertext, key)
+
+
+def test_keyed_digest():
+    key = tools.encryption.generate_key()
+    digest = tools.encryption.keyed_digest("FOO BAR WOOHOO!", key)
+
+    assert len(digest) == tools.encryption.DIGEST_SIZE
+    assert tools.encryption.verify_digest("FOO BAR WOOHOO!", digest, key)
+    assert not tools.encryption.verify_digest("FOO BAR woohoo!", digest, key)
+    assert not tools.encryption.verify_digest("FOO BAR WOOHOO!", digest, tools.encryption.generate_key())
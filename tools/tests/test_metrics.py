@@ -0,0 +1,82 @@
+from providers.LocalFilesystemProvider import LocalFilesystemProvider
+from managers.CredentialManager import CredentialManager
+from custom_exceptions import exceptions
+from tools.metrics import ProviderMetrics, percentile
+import pytest
+
+cm = CredentialManager()
+cm.load()
+
+
+def teardown_function(function):
+    cm.clear_user_credentials()
+
+
+def test_percentile():
+    assert percentile([3, 1, 2], 0.5) == 2
+    assert percentile(range(1, 101), 0.95) == 95
+
+
+def test_empty_summary():
+    summary = ProviderMetrics().summary()
+    assert summary["operations"] == 0
+    assert summary["failure_rate"] is None
+    assert summary["p50_latency"] is None
+    assert summary["throughput"] is None
+
+
+def test_summary():
+    metrics = ProviderMetrics()
+    metrics.record("put", 1.0, 100, True)
+    metrics.record("get", 3.0, 500, True)
+    metrics.record("delete", 2.0, 0, True)
+    metrics.record("get", 10.0, 0, False)
+    summary = metrics.summary()
+    assert summary["operations"] == 4
+    assert summary["failure_rate"] == 0.25
+    assert summary["p50_latency"] == 2.0
+    assert summary["p95_latency"] == 3.0
+    # only successful transfers count toward throughput
+    assert summary["throughput"] == 150.0
+
+
+def test_window_is_bounded():
+    metrics = ProviderMetrics(window=3)
+    for i in xrange(10):
+        metrics.record("get", i, 0, True)
+    assert [sample.seconds for sample in metrics.samples] == [7, 8, 9]
+
+
+def test_timed():
+    metrics = ProviderMetrics()
+    assert metrics.timed("get", lambda name: "data", result_bytes=True)("file") == "data"
+    metrics.timed("put", lambda name, data: None, 3)("file", "abc")
+
+    def fail():
+        raise ValueError
+    with pytest.raises(ValueError):
+        metrics.timed("delete", fail)()
+
+    get, put, delete = metrics.samples
+    assert (get.operation, get.bytes, get.succeeded) == ("get", 4, True)
+    assert (put.operation, put.bytes, put.succeeded) == ("put", 3, True)
+    assert (delete.operation, delete.succeeded) == ("delete", False)
+
+
+def test_provider_records_operations():
+    provider = LocalFilesystemProvider(cm)
+    provider.connect("tmp")
+    provider.put_async("file1", "abc").result()
+    provider.get_async("file1").result()
+    with pytest.raises(exceptions.ProviderOperationFailure):
+        provider.get_async("missing").result()
+    assert [(sample.operation, sample.bytes, sample.succeeded) for sample in provider.metrics.samples] == \
+        [("put", 3, True), ("get", 3, True), ("get", 0, False)]
+
+
+def test_error_log_is_bounded():
+    provider = LocalFilesystemProvider(cm)
+    provider.connect("tmp")
+    for i in xrange(provider.ERROR_LOG_SIZE + 10):
+        exceptions.ProviderOperationFailure(provider)
+    assert len(provider.error_log) == provider.ERROR_LOG_SIZE
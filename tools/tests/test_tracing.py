@@ -0,0 +1,137 @@
+import json
+import os
+from providers.LocalFilesystemProvider import LocalFilesystemProvider
+from managers.CredentialManager import CredentialManager
+from tools import encryption, tracing
+from tools.utils import submit_task
+import pytest
+
+cm = CredentialManager()
+cm.load()
+
+
+@pytest.fixture
+def exporter():
+    exporter = tracing.RingBufferExporter()
+    tracing.add_exporter(exporter)
+    yield exporter
+    tracing.remove_exporter(exporter)
+
+
+def teardown_function(function):
+    cm.clear_user_credentials()
+
+
+def test_disabled():
+    assert not tracing.enabled()
+    with tracing.span("stage", bytes=3) as span:
+        span.set("key", "value")
+    assert tracing.current_span() is span
+
+    def function():
+        pass
+    assert tracing.propagate(function) is function
+    assert tracing.wrap(function, "stage") is function
+
+
+def test_nested_spans(exporter):
+    with tracing.span("outer", bytes=3) as outer:
+        with tracing.span("inner") as inner:
+            assert tracing.current_span() is inner
+            inner.set("key", "value")
+        assert tracing.current_span() is outer
+
+    inner, outer = exporter.spans()
+    assert outer.name == "outer"
+    assert outer.attributes == {"bytes": 3}
+    assert outer.parent_id is None
+    assert outer.trace_id == outer.span_id
+    assert inner.attributes == {"key": "value"}
+    assert inner.parent_id == outer.span_id
+    assert inner.trace_id == outer.trace_id
+    assert 0 <= inner.duration <= outer.duration
+
+
+def test_span_records_errors(exporter):
+    with pytest.raises(ValueError):
+        with tracing.span("failing"):
+            raise ValueError
+    assert exporter.spans()[0].error == "ValueError"
+
+
+def test_traced(exporter):
+    @tracing.traced("decorated")
+    def decorated(value):
+        return value + 1
+    assert decorated(1) == 2
+    assert decorated.__name__ == "decorated"
+    assert [span.name for span in exporter.spans()] == ["decorated"]
+
+
+def test_propagate_to_task_pool(exporter):
+    with tracing.span("outer") as outer:
+        future = submit_task(tracing.wrap(lambda data: data, "task", result_bytes=True), "abcd")
+        assert future.result() == "abcd"
+    task = exporter.spans("task")[0]
+    assert task.parent_id == outer.span_id
+    assert task.attributes == {"bytes": 4}
+
+
+def test_provider_spans(exporter):
+    provider = LocalFilesystemProvider(cm)
+    provider.connect("tmp")
+    with tracing.span("outer") as outer:
+        provider.put_async("file1", "abc").result()
+        assert provider.get_async("file1").result() == "abc"
+    put, get = exporter.spans("provider.put") + exporter.spans("provider.get")
+    assert put.attributes == {"provider": provider.uid, "bytes": 3}
+    assert get.attributes == {"provider": provider.uid, "bytes": 3}
+    assert put.parent_id == outer.span_id
+
+
+def test_encryption_spans(exporter):
+    key = encryption.generate_key()
+    encryption.decrypt(encryption.encrypt("data", key), key)
+    assert exporter.spans("encryption.encrypt")[0].attributes == {"bytes": 4}
+    assert len(exporter.spans("encryption.decrypt")) == 1
+
+
+def test_ring_buffer_capacity():
+    exporter = tracing.RingBufferExporter(capacity=2)
+    tracing.add_exporter(exporter)
+    try:
+        for name in ["a", "b", "c"]:
+            with tracing.span(name):
+                pass
+    finally:
+        tracing.remove_exporter(exporter)
+    assert [span.name for span in exporter.spans()] == ["b", "c"]
+
+
+def test_json_file_exporter(tmpdir):
+    path = os.path.join(str(tmpdir), "trace.json")
+    exporter = tracing.JSONFileExporter(path)
+    tracing.add_exporter(exporter)
+    try:
+        with tracing.span("stage", bytes=3):
+            pass
+    finally:
+        tracing.remove_exporter(exporter)
+    with open(path) as trace_file:
+        record = json.loads(trace_file.readline())
+    assert record["name"] == "stage"
+    assert record["attributes"] == {"bytes": 3}
+
+
+def test_exporter_errors_are_contained(exporter):
+    class BrokenExporter(object):
+        def export(self, span):
+            raise IOError
+    broken = BrokenExporter()
+    tracing.add_exporter(broken)
+    try:
+        with tracing.span("stage"):
+            pass
+    finally:
+        tracing.remove_exporter(broken)
+    assert len(exporter.spans("stage")) == 1
@@ -1,9 +1,38 @@
 import sys
+import threading
+import time
 from custom_exceptions import exceptions
 import tools.utils
 import pytest
 
 
+# sandbox pool functions must be defined at the top level so they can be pickled
+def upper_name(name):
+    return [name, name.upper()]
+
+
+def divide_by_zero(name):
+    return 1 / 0
+
+
+def exit_with_seven(name):
+    sys.exit(7)
+
+
+def cause_segfault():
+    """
+    Crashes Python using an example from https://wiki.python.org/moin/CrashingPython
+    """
+    import ctypes
+    i = ctypes.c_char('a')
+    j = ctypes.pointer(i)
+    c = 0
+    while True:
+            j[c] = 'a'
+            c += 1
+    j
+
+
 def test_successful_sandbox():
     def good_function(name):
         return [name, name.upper()]
@@ -63,3 +92,230 @@ def test_parallel():
     assert len(exceptions) == 1
     with pytest.raises(ValueError):
         raise exceptions[0]
+
+
+def test_successful_sandbox_pool():
+    pool = tools.utils.SandboxPool(2)
+    for test_name in ["fred", "george"]:
+        assert pool.run(upper_name, test_name) == [test_name, test_name.upper()]
+
+
+def test_sandbox_pool_with_exception():
+    pool = tools.utils.SandboxPool(1)
+    with pytest.raises(exceptions.SandboxProcessFailure) as excinfo:
+        pool.run(divide_by_zero, "fred")
+    assert excinfo.value.exitcode == 1
+    # the worker survives the exception
+    assert pool.run(upper_name, "fred") == ["fred", "FRED"]
+
+
+def test_sandbox_pool_with_exit_code():
+    pool = tools.utils.SandboxPool(1)
+    with pytest.raises(exceptions.SandboxProcessFailure) as excinfo:
+        pool.run(exit_with_seven, "fred")
+    assert excinfo.value.exitcode == 7
+
+
+def test_sandbox_pool_with_segfault():
+    pool = tools.utils.SandboxPool(1)
+    with pytest.raises(exceptions.SandboxProcessFailure) as excinfo:
+        pool.run(cause_segfault)
+    assert excinfo.value.exitcode < 0
+    # the crashed worker is replaced
+    assert pool.run(upper_name, "fred") == ["fred", "FRED"]
+
+
+def test_nested_parallel_is_bounded():
+    threads = set()
+    lock = threading.Lock()
+
+    def leaf(x):
+        with lock:
+            threads.add(threading.current_thread())
+
+    def inner(x):
+        assert tools.utils.run_parallel(leaf, [[i] for i in xrange(50)]) == []
+
+    # this would need thousands of threads if every call had its own pool
+    assert tools.utils.run_parallel(inner, [[i] for i in xrange(50)]) == []
+    assert len(threads) <= tools.utils.TASK_WORKERS + 1
+
+
+def test_submit_task():
+    assert tools.utils.submit_task(lambda x, y: x + y, 1, 2).result() == 3
+    with pytest.raises(ZeroDivisionError):
+        tools.utils.submit_task(lambda: 1 / 0).result()
+
+
+def test_concurrency_limiter():
+    limiter = tools.utils.ConcurrencyLimiter(2)
+    lock = threading.Lock()
+    release = threading.Event()
+    started = threading.Semaphore(0)
+    running = [0]
+    most_running = [0]
+
+    def f(x):
+        with lock:
+            running[0] += 1
+            most_running[0] = max(most_running[0], running[0])
+        started.release()
+        release.wait(5)
+        with lock:
+            running[0] -= 1
+        return x
+
+    futures = [limiter.submit(f, x) for x in xrange(6)]
+    # let the calls finish once the first two are running at once
+    started.acquire()
+    started.acquire()
+    release.set()
+    assert [future.result() for future in futures] == range(6)
+    assert most_running[0] == 2
+
+    with pytest.raises(ZeroDivisionError):
+        limiter.submit(lambda: 1 / 0).result()
+
+
+def test_concurrency_limiter_timeout():
+    limiter = tools.utils.ConcurrencyLimiter(1, timeout=0.05, timeout_error=lambda: ValueError("timed out"))
+    release = threading.Event()
+    ran = []
+
+    hung = limiter.submit(release.wait, 5)
+    # the deadline runs from when a call starts, so one stuck behind the hung call waits for its turn
+    queued = limiter.submit(ran.append, "queued")
+    with pytest.raises(ValueError):
+        hung.result(5)
+    # the hung call keeps its place until it returns, so later calls still can't run
+    time.sleep(0.1)
+    assert not queued.done()
+    assert ran == []
+
+    release.set()
+    assert queued.result(5) is None
+    assert ran == ["queued"]
+    assert limiter.submit(lambda: 2).result(5) == 2
+    # a call submitted without a timeout waits however long it takes
+    assert limiter.submit_with_timeout(None, lambda: time.sleep(0.1) or 3).result(5) == 3
+
+
+def test_concurrency_limiter_timeout_ignores_queueing():
+    limiter = tools.utils.ConcurrencyLimiter(1, timeout=0.2, timeout_error=lambda: ValueError("timed out"))
+    # each call is well within the deadline, though the last is only done long after it was submitted
+    futures = [limiter.submit(lambda x: time.sleep(0.1) or x, x) for x in xrange(5)]
+    assert [future.result(5) for future in futures] == range(5)
+
+
+def test_concurrency_limiter_timeout_bounds_executor_threads():
+    executor = tools.utils.ThreadPoolExecutor(max_workers=2)
+    limiter = tools.utils.ConcurrencyLimiter(1, executor=executor, timeout=0.05,
+                                             timeout_error=lambda: ValueError("timed out"))
+    release = threading.Event()
+    hung = [limiter.submit(release.wait, 5) for _ in xrange(4)]
+    with pytest.raises(ValueError):
+        hung[0].result(5)
+    # however many calls hang, the limiter only ever holds one of the executor's threads
+    assert executor.submit(lambda: 3).result(5) == 3
+    assert not any(future.done() for future in hung[1:])
+    release.set()
+    assert [future.result(5) for future in hung[1:]] == [True] * 3
+    executor.shutdown()
+
+
+def test_call_later():
+    called = threading.Event()
+    order = []
+    tools.utils.call_later(0.05, lambda: order.append(2) or called.set())
+    tools.utils.call_later(0, order.append, 1)
+    assert called.wait(5)
+    assert order == [1, 2]
+
+
+def test_read_write_lock_shares_reads():
+    lock = tools.utils.ReadWriteLock()
+    both_reading = threading.Event()
+    readers = threading.Semaphore(0)
+
+    def read():
+        with lock.read_locked():
+            readers.release()
+            assert both_reading.wait(5)
+
+    thread = threading.Thread(target=read)
+    thread.start()
+    readers.acquire()
+    with lock.read_locked():
+        # reentrant, even while another thread reads
+        with lock.read_locked():
+            both_reading.set()
+    thread.join(5)
+    assert not thread.is_alive()
+
+
+def test_read_write_lock_excludes_writes():
+    lock = tools.utils.ReadWriteLock()
+    events = []
+    reading = threading.Event()
+    release = threading.Event()
+
+    def read():
+        with lock.read_locked():
+            reading.set()
+            release.wait(5)
+            events.append("read")
+
+    def write():
+        with lock.write_locked():
+            # reentrant, and writers may also read
+            with lock.write_locked():
+                with lock.read_locked():
+                    events.append("write")
+
+    reader = threading.Thread(target=read)
+    reader.start()
+    assert reading.wait(5)
+    writer = threading.Thread(target=write)
+    writer.start()
+    # the writer waits for the reader to finish
+    writer.join(0.05)
+    assert events == []
+    release.set()
+    reader.join(5)
+    writer.join(5)
+    assert events == ["read", "write"]
+
+    # the lock is free again
+    with lock.write_locked():
+        pass
+
+
+def test_read_write_lock_refuses_upgrade():
+    lock = tools.utils.ReadWriteLock()
+    with lock.read_locked():
+        with pytest.raises(RuntimeError):
+            lock.acquire_write()
+    with lock.write_locked():
+        pass
+
+
+def test_completed_future():
+    future = tools.utils.completed_future(lambda x: x + 1, 1)
+    assert future.done()
+    assert future.result() == 2
+
+    future = tools.utils.completed_future(lambda: 1 / 0)
+    assert future.done()
+    with pytest.raises(ZeroDivisionError):
+        future.result()
+
+
+def test_wait_for_failures():
+    def f(x):
+        return 1 / x
+
+    futures = [tools.utils.io_executor().submit(f, x) for x in [1, 0, 2]]
+    failures = tools.utils.wait_for_failures(futures)
+    assert len(failures) == 1
+    assert type(failures[0]) is ZeroDivisionError
+    assert tools.utils.io_executor() is tools.utils.io_executor()
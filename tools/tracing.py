@@ -0,0 +1,263 @@
+"""
+Timed spans for finding where the time in an operation goes
+
+A span records the name, duration and attributes (e.g. provider uuid, byte counts) of one stage of an operation.
+Spans nest: a span started while another is open on the same thread becomes its child, and functions wrapped
+with propagate or wrap carry the open span with them to the threads they run on.
+Finished spans are handed to every registered exporter. With no exporters registered, tracing is disabled and
+each span costs a single check.
+
+Usage:
+    exporter = RingBufferExporter()
+    add_exporter(exporter)
+    with span("stage", bytes=len(data)):
+        ...
+"""
+import itertools
+import json
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger("daruma")
+
+_exporters = []
+_exporters_lock = threading.Lock()
+_local = threading.local()
+_span_ids = itertools.count(1)
+
+
+def enabled():
+    """
+    Returns True if any exporter is registered
+    """
+    return len(_exporters) > 0
+
+
+def add_exporter(exporter):
+    """
+    Start sending finished spans to exporter
+    Args: exporter, an object with an export(span) method
+    """
+    global _exporters
+    with _exporters_lock:
+        # replace rather than mutate the list, so spans being exported don't need the lock
+        _exporters = _exporters + [exporter]
+
+
+def remove_exporter(exporter):
+    """
+    Stop sending finished spans to exporter
+    """
+    global _exporters
+    with _exporters_lock:
+        _exporters = [existing for existing in _exporters if existing is not exporter]
+
+
+def _stack():
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    return stack
+
+
+class Span(object):
+    """
+    A timed stage of an operation
+    """
+    def __init__(self, name, parent, attributes):
+        self.name = name
+        self.span_id = next(_span_ids)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.trace_id = parent.trace_id if parent is not None else self.span_id
+        self.attributes = attributes
+        self.thread = threading.current_thread().name
+        self.start = None
+        self.duration = None
+        self.error = None
+
+    def set(self, key, value):
+        """
+        Attach an attribute to the span
+        """
+        self.attributes[key] = value
+
+    def __enter__(self):
+        _stack().append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        self.duration = time.time() - self.start
+        if exception_type is not None:
+            self.error = exception_type.__name__
+        _stack().pop()
+        for exporter in _exporters:
+            try:
+                exporter.export(self)
+            except Exception:
+                logger.exception("Error exporting span %s", self.name)
+        return False
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "trace_id": self.trace_id,
+            "thread": self.thread,
+            "start": self.start,
+            "duration": self.duration,
+            "error": self.error,
+            "attributes": self.attributes
+        }
+
+
+class _NullSpan(object):
+    """
+    Stands in for a span when tracing is disabled
+    """
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception, traceback):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+
+def current_span():
+    """
+    Returns the innermost open span on this thread, or a span that discards attributes if there is none
+    """
+    if not _exporters:
+        return _NULL_SPAN
+    stack = _stack()
+    return stack[-1] if len(stack) > 0 else _NULL_SPAN
+
+
+def span(name, **attributes):
+    """
+    Returns a context manager timing a stage of an operation as a child of the current span
+    Args:
+        name: the name of the stage
+        attributes: values to attach to the span
+    """
+    if not _exporters:
+        return _NULL_SPAN
+    stack = _stack()
+    return Span(name, stack[-1] if len(stack) > 0 else None, attributes)
+
+
+def traced(name):
+    """
+    A decorator that records each call of the decorated function as a span
+    """
+    def decorator(function):
+        def traced_function(*args, **kwargs):
+            if not _exporters:
+                return function(*args, **kwargs)
+            with span(name):
+                return function(*args, **kwargs)
+        traced_function.__name__ = function.__name__
+        traced_function.__doc__ = function.__doc__
+        return traced_function
+    return decorator
+
+
+def propagate(function):
+    """
+    Args: function, a function that may be run on another thread
+    Returns: a function that runs function with the currently open span as its parent;
+        function itself if tracing is disabled or no span is open
+    """
+    if not _exporters:
+        return function
+    stack = _stack()
+    if len(stack) == 0:
+        return function
+    parent = stack[-1]
+
+    def propagated_function(*args, **kwargs):
+        stack = _stack()
+        stack.append(parent)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            stack.pop()
+    return propagated_function
+
+
+def wrap(function, name, result_bytes=False, **attributes):
+    """
+    Args:
+        function: a function that may be run on another thread
+        name: the name of the span to record for each call
+        result_bytes: whether to record the length of the function's result as the span's bytes attribute
+        attributes: values to attach to the span
+    Returns: a function that records each call of function as a child of the currently open span;
+        function itself if tracing is disabled
+    """
+    if not _exporters:
+        return function
+
+    def wrapped_function(*args, **kwargs):
+        with span(name, **attributes) as current:
+            result = function(*args, **kwargs)
+            if result_bytes:
+                current.set("bytes", len(result))
+            return result
+    return propagate(wrapped_function)
+
+
+class LoggingExporter(object):
+    """
+    Writes each finished span to a logger
+    """
+    def __init__(self, log=logger, level=logging.DEBUG):
+        self.log = log
+        self.level = level
+
+    def export(self, finished_span):
+        self.log.log(self.level, "span %s took %.6fs %s", finished_span.name, finished_span.duration,
+                     finished_span.attributes)
+
+
+class JSONFileExporter(object):
+    """
+    Appends each finished span to a file as a line of JSON
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, finished_span):
+        line = json.dumps(finished_span.to_dict(), sort_keys=True) + "\n"
+        with self.lock:
+            with open(self.path, "a") as trace_file:
+                trace_file.write(line)
+
+
+class RingBufferExporter(object):
+    """
+    Keeps the most recent finished spans in memory
+    """
+    def __init__(self, capacity=1024):
+        self.buffer = deque(maxlen=capacity)
+
+    def export(self, finished_span):
+        self.buffer.append(finished_span)
+
+    def spans(self, name=None):
+        """
+        Args: name, (optional) only return spans with this name
+        Returns: a list of the buffered spans, oldest first
+        """
+        return [buffered for buffered in list(self.buffer) if name is None or buffered.name == name]
+
+    def clear(self):
+        self.buffer.clear()
@@ -1,10 +1,20 @@
-from multiprocessing import Process, Pipe
+from multiprocessing import Process, Pipe, cpu_count
+import heapq
+import itertools
+import logging
 import os
+import Queue
+import struct
 import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
 from uuid import uuid4
 from urlparse import urlparse, parse_qs
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import Future, ThreadPoolExecutor
 from custom_exceptions.exceptions import SandboxProcessFailure
+from tools import tracing
 
 APP_NAME = "daruma"
 INTERNAL_SERVER_HOST = "localhost"
@@ -12,6 +22,14 @@ INTERNAL_SERVER_PORT = 28962  # This should be a free port
 
 FILENAME_SIZE = 32
 
+EXIT_SUCCESS = 0
+EXIT_FAILURE = 1
+
+# the number of threads shared by all parallel tasks (see submit_task)
+TASK_WORKERS = 32
+# the number of threads shared by all blocking provider operations
+IO_WORKERS = 64
+
 
 def get_resource_path(path):
     """
@@ -54,22 +72,305 @@ def parse_url(url):
     return {k: v[0] for k, v in params.items()}
 
 
-def run_parallel(func, args_list, workers=20):
+def run_parallel(func, args_list):
     """
-    Run a function several times in parallel.
+    Run a function several times in parallel, on the process-wide task pool.
     Discards return values
     Args:
         func: the function to execute.
         args_list: a list of lists of positional arguments to pass to the function
-        workers: (optional) the max number of functions to run at a time
     Returns: exceptions, the exceptions (if any) thrown by the functions
     """
-    with ThreadPoolExecutor(max_workers=workers) as tpe:
-        futures = map(lambda args: tpe.submit(func, *args), args_list)
+    return wait_for_failures([submit_task(func, *args) for args in args_list])
+
+
+_task_executor = None
+_task_executor_lock = threading.Lock()
+# one slot per task pool worker; a task only enters the pool while it can start right away
+_task_slots = threading.BoundedSemaphore(TASK_WORKERS)
+
+
+def _run_task(function, args):
+    try:
+        return function(*args)
+    finally:
+        _task_slots.release()
+
+
+def submit_task(function, *args):
+    """
+    Start running a function on the process-wide task pool, which has TASK_WORKERS threads.
+    If every worker is busy, the function is run in the calling thread instead.  This keeps the
+    number of threads bounded however deeply calls are nested, and since no task ever waits in a
+    queue behind its own caller, nested calls can't deadlock.
+    Returns: a future for the result of function(*args)
+    """
+    global _task_executor
+    if not _task_slots.acquire(False):
+        return completed_future(function, *args)
+
+    with _task_executor_lock:
+        if _task_executor is None:
+            _task_executor = ThreadPoolExecutor(max_workers=TASK_WORKERS)
+    return _task_executor.submit(_run_task, tracing.propagate(function), args)
+
+
+_io_executor = None
+_io_executor_lock = threading.Lock()
+
+
+def io_executor():
+    """
+    Returns the process-wide executor used to run blocking provider operations.
+    It is created on first use and lives as long as the process.
+    """
+    global _io_executor
+    with _io_executor_lock:
+        if _io_executor is None:
+            _io_executor = ThreadPoolExecutor(max_workers=IO_WORKERS)
+        return _io_executor
+
+
+class _DeadlineScheduler(object):
+    """
+    Runs functions at given times on a single background thread
+    """
+    def __init__(self):
+        # (time, sequence number, function, args), earliest first
+        self.heap = []
+        self.sequence = itertools.count()
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def call_later(self, delay, function, *args):
+        with self.condition:
+            heapq.heappush(self.heap, (time.time() + delay, next(self.sequence), function, args))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="deadline_scheduler")
+                self.thread.daemon = True
+                self.thread.start()
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while len(self.heap) == 0 or self.heap[0][0] > time.time():
+                    self.condition.wait(self.heap[0][0] - time.time() if len(self.heap) > 0 else None)
+                _, _, function, args = heapq.heappop(self.heap)
+            try:
+                function(*args)
+            except Exception:
+                logging.exception("Exception in scheduled call")
+
+_deadline_scheduler = _DeadlineScheduler()
+
+
+def call_later(delay, function, *args):
+    """
+    Run function(*args) on a background thread once delay seconds have passed.
+    The function should be quick, since it delays any other calls due at the same time.
+    """
+    _deadline_scheduler.call_later(delay, function, *args)
 
+
+class ConcurrencyLimiter(object):
+    """
+    Runs functions on a shared executor, with at most a fixed number of them running at once.
+    Calls over the limit wait in a queue of their own instead of occupying the executor's threads,
+    so one busy user of the executor can't starve the others.
+    """
+    def __init__(self, limit, executor=None, timeout=None, timeout_error=None):
+        """
+        Args:
+            limit: the most calls to run at once
+            executor: (optional) the executor to run calls on; defaults to io_executor()
+            timeout: (optional) the most seconds a call submitted with submit may take from when it gets one of the
+                limit places, so time spent queued behind other calls doesn't count. Once a call has taken that
+                long, its future fails with timeout_error() and its result is discarded. A call that is running
+                can't be stopped, so it keeps its place until it returns: a user whose calls hang holds at most
+                limit of the executor's threads
+            timeout_error: a function returning the exception to fail timed out calls with
+        """
+        self.limit = limit
+        self.executor = executor
+        self.timeout = timeout
+        self.timeout_error = timeout_error
+        self.running = 0
+        # (future, function, args, timeout, settled) for calls waiting for one of the running calls to finish
+        self.pending = deque()
+        self.lock = threading.Lock()
+
+    def submit(self, function, *args):
+        """
+        Start running function(*args) once fewer than limit calls are running, with the limiter's timeout
+        Returns: a future for the result
+        """
+        return self.submit_with_timeout(self.timeout, function, *args)
+
+    def submit_with_timeout(self, timeout, function, *args):
+        """
+        Like submit, but with the given timeout in seconds instead of the limiter's; None never times out
+        """
+        future = Future()
+        function = tracing.propagate(function)
+        # whether the call has finished or timed out, whichever happened first; guarded by self.lock
+        settled = [False]
+        with self.lock:
+            if self.running >= self.limit:
+                self.pending.append((future, function, args, timeout, settled))
+                return future
+            self.running += 1
+        self._start(future, function, args, timeout, settled)
+        return future
+
+    def _start(self, future, function, args, timeout, settled):
+        if timeout is not None:
+            call_later(timeout, self._expire, future, settled)
+        executor = self.executor if self.executor is not None else io_executor()
+        executor.submit(self._run, future, function, args, settled)
+
+    def _run(self, future, function, args, settled):
+        try:
+            with self.lock:
+                # a call that timed out or was cancelled before it started isn't run at all
+                start = not settled[0] and future.set_running_or_notify_cancel()
+            if not start:
+                self._finish()
+                return
+        except Exception:
+            self._finish()
+            raise
+
+        try:
+            result, error = function(*args), None
+        except Exception as e:
+            result, error = None, e
+
+        with self.lock:
+            timed_out = settled[0]
+            settled[0] = True
+        if not timed_out:
+            if error is None:
+                future.set_result(result)
+            else:
+                future.set_exception(error)
+        # the call's place is only given away once it has returned
+        self._finish()
+
+    def _expire(self, future, settled):
+        with self.lock:
+            if settled[0] or future.cancelled():
+                return
+            settled[0] = True
+        future.set_exception(self.timeout_error())
+
+    def _finish(self):
+        with self.lock:
+            if len(self.pending) == 0:
+                self.running -= 1
+                return
+            next_call = self.pending.popleft()
+        self._start(*next_call)
+
+
+def completed_future(function, *args):
+    """
+    Run a function in the calling thread.
+    Returns: a future that already holds the function's result or exception
+    """
+    future = Future()
+    try:
+        future.set_result(function(*args))
+    except Exception as e:
+        future.set_exception(e)
+    return future
+
+
+def wait_for_failures(futures):
+    """
+    Wait for several futures to finish.
+    Args:
+        futures: a list of futures
+    Returns: exceptions, the exceptions (if any) raised by the futures' calls, in the order of futures
+    """
     return [future.exception() for future in futures if future.exception() is not None]
 
 
+class ReadWriteLock(object):
+    """
+    A reentrant lock that any number of threads can hold for reading at once, or one thread can hold for writing
+    Waiting writers go before threads that don't already hold the lock, so a stream of reads can't starve writes.
+    A thread holding the write lock may also take the read lock, but a thread holding only the read lock can't
+    take the write lock, since two readers waiting for each other to finish would deadlock.
+    """
+    def __init__(self):
+        self.condition = threading.Condition(threading.Lock())
+        # map from the ident of each thread holding the read lock to the number of times it holds it
+        self.readers = {}
+        self.writer = None
+        self.writer_depth = 0
+        self.waiting_writers = 0
+
+    def acquire_read(self):
+        me = threading.current_thread().ident
+        with self.condition:
+            if self.writer != me and me not in self.readers:
+                while self.writer is not None or self.waiting_writers > 0:
+                    self.condition.wait()
+            self.readers[me] = self.readers.get(me, 0) + 1
+
+    def release_read(self):
+        me = threading.current_thread().ident
+        with self.condition:
+            self.readers[me] -= 1
+            if self.readers[me] == 0:
+                del self.readers[me]
+                self.condition.notify_all()
+
+    def acquire_write(self):
+        """
+        Raises RuntimeError if this thread holds only the read lock
+        """
+        me = threading.current_thread().ident
+        with self.condition:
+            if self.writer == me:
+                self.writer_depth += 1
+                return
+            if me in self.readers:
+                raise RuntimeError("Can't take the write lock while holding the read lock")
+            self.waiting_writers += 1
+            try:
+                while self.writer is not None or len(self.readers) > 0:
+                    self.condition.wait()
+            finally:
+                self.waiting_writers -= 1
+            self.writer = me
+            self.writer_depth = 1
+
+    def release_write(self):
+        with self.condition:
+            self.writer_depth -= 1
+            if self.writer_depth == 0:
+                self.writer = None
+                self.condition.notify_all()
+
+    @contextmanager
+    def read_locked(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_locked(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
 def sandbox_function(function, *args):
     """
     Runs a function liable to cause a crash in a separate process.
@@ -86,8 +387,6 @@ def sandbox_function(function, *args):
         SandboxProcessFailure: the process the function was running in exited
             with a non-zero status (the exit code is included in the exception)
     """
-    EXIT_SUCCESS = 0
-
     def function_wrapper(function, pipe_receiver, pipe_sender, args):
         """
         This function calls the user's function and then sends the returned
@@ -126,3 +425,154 @@ def sandbox_function(function, *args):
         raise SandboxProcessFailure(process.exitcode)
 
     return results
+
+
+# network-endian status code, number of results
+_SANDBOX_HEADER_FORMAT = "!ii"
+
+# how often (in seconds) an idle sandbox worker checks that its parent is alive
+_SANDBOX_POLL_INTERVAL = 1
+
+
+def _sandbox_worker_main(pipe, parent_pid):
+    """
+    The main loop of a long-lived sandbox worker process.  Receives
+    (function, args) requests on the pipe, and replies with a header followed
+    by the strings returned by the function.
+
+    SystemExit and uncaught exceptions are reported back as status codes, just
+    as they would have been reported by the exit code of a one-shot sandbox
+    process.  A crash simply kills the worker.
+    """
+    while True:
+        while not pipe.poll(_SANDBOX_POLL_INTERVAL):
+            # don't outlive the process that we are serving
+            if os.getppid() != parent_pid:
+                return
+        try:
+            function, args = pipe.recv()
+        except EOFError:
+            return
+
+        try:
+            results = function(*args)
+            status = EXIT_SUCCESS
+        except SystemExit as e:
+            results = []
+            if e.code is None:
+                status = EXIT_SUCCESS
+            elif isinstance(e.code, int):
+                status = e.code
+            else:
+                status = EXIT_FAILURE
+        except Exception:
+            results = []
+            status = EXIT_FAILURE
+
+        # The reply is sent as raw bytes rather than pickled, because the
+        # worker handles untrusted data and must not be able to make the
+        # parent unpickle arbitrary objects.
+        pipe.send_bytes(struct.pack(_SANDBOX_HEADER_FORMAT, status, len(results)))
+        for result in results:
+            pipe.send_bytes(result)
+
+
+class _SandboxWorker(object):
+    """
+    A handle on a single long-lived sandbox process.
+    """
+    def __init__(self):
+        self.pipe, child_pipe = Pipe()
+        self.process = Process(target=_sandbox_worker_main, args=(child_pipe, os.getpid()))
+        self.process.daemon = True
+        self.process.start()
+        child_pipe.close()
+
+    def run(self, function, args):
+        """
+        Runs function(*args) in the worker process.
+        Returns the array of strings returned by the function.
+        Raises SandboxProcessFailure if the function exited unsuccessfully or
+        the worker crashed.
+        """
+        try:
+            self.pipe.send((function, args))
+            status, num_results = struct.unpack(_SANDBOX_HEADER_FORMAT, self.pipe.recv_bytes())
+            results = [self.pipe.recv_bytes() for _ in xrange(num_results)]
+        except (EOFError, IOError):
+            # the worker crashed mid-request
+            self.process.join()
+            raise SandboxProcessFailure(self.process.exitcode)
+
+        if status != EXIT_SUCCESS:
+            raise SandboxProcessFailure(status)
+
+        return results
+
+    def is_alive(self):
+        return self.process.is_alive()
+
+    def terminate(self):
+        self.pipe.close()
+        self.process.terminate()
+        self.process.join()
+
+
+class SandboxPool(object):
+    """
+    A pool of long-lived processes for running functions liable to cause a
+    crash.  This behaves like sandbox_function, but avoids the cost of forking a
+    new process on every call.  Workers are started lazily, and a worker that
+    crashes is replaced on the next call.
+
+    Any state cached by a function (e.g. in module-level variables) persists in
+    the worker between calls.
+    """
+    def __init__(self, size=None):
+        """
+        Args:
+            size: (optional) the max number of worker processes; defaults to
+                the number of CPUs
+        """
+        if size is None:
+            size = cpu_count()
+        # None is a placeholder for a worker that hasn't been started yet
+        self.idle_workers = Queue.Queue()
+        for _ in xrange(size):
+            self.idle_workers.put(None)
+
+    def run(self, function, *args):
+        """
+        Runs a function in one of the pool's sandbox processes.
+
+        Args:
+            function: the function to run.  It must be picklable (i.e. defined
+                at the top level of a module), and must return an array of
+                strings OR exit with a non-zero status.
+            args...: the arguments to be passed to the function
+
+        Returns:
+            The array of strings returned by the function.
+
+        Raises:
+            SandboxProcessFailure: the function exited with a non-zero status
+                or crashed its process (the exit code is included in the
+                exception)
+        """
+        worker = self.idle_workers.get()
+        try:
+            if worker is None:
+                worker = _SandboxWorker()
+            return worker.run(function, args)
+        except SandboxProcessFailure:
+            if worker is not None and not worker.is_alive():
+                worker = None
+            raise
+        except BaseException:
+            # we can't be sure what state the worker is in; replace it
+            if worker is not None:
+                worker.terminate()
+                worker = None
+            raise
+        finally:
+            self.idle_workers.put(worker)